@@ -0,0 +1,89 @@
+""" Upfront checks of the census tables for all areas, predicting where the solvers will fail before calling them """
+
+import itertools
+import numpy as np
+
+def _subsets(n):
+  """ Returns the nonempty subsets of n items as a boolean array (2^n-1 x n) """
+  return np.array([s for s in itertools.product([False, True], repeat=n) if any(s)], dtype=bool).reshape(-1, n)
+
+def transport_feasible(support, rows, cols, strict=False):
+  """
+  Returns whether there is a nonnegative matrix, nonzero only where support is true, with row sums rows and column sums
+  cols (vectorised over any leading dimensions). By the supply-demand theorem this holds if the totals agree and the demand
+  of every set of rows can be met by the columns they have support in. If strict, every such set of (nonzero) rows must
+  also have spare supply unless it reaches all the (nonzero) columns, so the matrix can be positive on its support, which
+  is what iterative fitting needs to converge
+  """
+  support = np.asarray(support, dtype=bool)
+  if strict:
+    support = support & (rows[..., :, None] > 0) & (cols[..., None, :] > 0)
+  masks = _subsets(rows.shape[-1])
+  demand = np.einsum("...i,si->...s", rows, masks.astype(rows.dtype))
+  reach = np.einsum("si,...ij->...sj", masks.astype(int), support.astype(int)) > 0
+  supply = np.einsum("...sj,...j->...s", reach.astype(cols.dtype), cols)
+  feasible = (rows.sum(axis=-1) == cols.sum(axis=-1)) & (demand <= supply).all(axis=-1)
+  if strict:
+    # sets of nonzero rows that do not reach every nonzero column must not use up the columns they reach
+    nonzero = ~(masks & ~(rows[..., None, :] > 0)).any(axis=-1)
+    covers = (reach | ~(cols[..., None, :] > 0)).all(axis=-1)
+    feasible &= ~(nonzero & ~covers & (demand >= supply)).any(axis=-1)
+  return feasible
+
+def _report(flags, areas, reason, problems):
+  if flags.any():
+    problems.append(reason + ": " + ", ".join(str(a) for a in np.asarray(areas)[flags]))
+
+def analyse(areas, m4404, m4405, m4408, m4402, m4202, observed, structural, scotland=False):
+  """
+  Checks the tables (tensors indexed by area then tenure, see Household) for every area at once.
+  Raises RuntimeError listing the areas that no seed can satisfy, i.e. where table totals by tenure disagree, where the
+  bedrooms cannot be fitted within the rooms, or where the household types cannot be fitted to the occupants.
+  Returns a boolean array flagging the areas that should use the structural seed (all possible states equally likely)
+  rather than the survey seed, because some of their nonzero table cells have no support in the survey.
+  observed and structural are boolean T R O B H tensors of the states seen in the survey and the possible states
+  """
+  problems = []
+
+  # totals by tenure (the Scottish LC4202 has no usable tenure)
+  tenure = m4404.sum(axis=(2, 3))
+  for name, table in [("LC4405", m4405), ("LC4408", m4408), ("LC4402", m4402)]:
+    _report((table.reshape(table.shape[:2] + (-1,)).sum(axis=2) != tenure).any(axis=1), areas,
+            name + " tenure totals differ from LC4404", problems)
+  if scotland:
+    _report(m4202.sum(axis=tuple(range(1, m4202.ndim))) != tenure.sum(axis=1), areas, "LC4202 totals differ from LC4404",
+            problems)
+  else:
+    _report((m4202.sum(axis=(2, 3)) != tenure).any(axis=1), areas, "LC4202 tenure totals differ from LC4404", problems)
+
+  # permitted rooms-bedrooms and occupants-household type combinations
+  rooms_beds = structural.any(axis=(0, 2, 4))
+  occ_type = structural.any(axis=(0, 1, 3))
+
+  # bedrooms (rows) within rooms (columns), for each area, tenure and number of occupants
+  beds = np.moveaxis(m4405, 3, 2)
+  rooms = np.moveaxis(m4404, 3, 2)
+  feasible = transport_feasible(rooms_beds.T, beds, rooms)
+  _report(~feasible.all(axis=(1, 2)), areas, "bedrooms cannot be fitted within rooms", problems)
+
+  # household type (columns) by occupants (rows), by tenure unless Scottish
+  occupants = m4404.sum(axis=2)
+  hhtypes = m4408
+  if scotland:
+    occupants = occupants.sum(axis=1)[:, None, :]
+    hhtypes = hhtypes.sum(axis=1)[:, None, :]
+  feasible = transport_feasible(occ_type, occupants, hhtypes)
+  _report(~feasible.all(axis=1), areas, "household types cannot be fitted to occupants", problems)
+
+  if problems:
+    raise RuntimeError("Inconsistent census tables:\n" + "\n".join(problems))
+
+  cover_4404 = observed.any(axis=(3, 4))
+  cover_4405 = np.moveaxis(observed.any(axis=(1, 4)), 2, 1)
+  cover_4408 = observed.any(axis=(1, 2, 3))
+  if scotland:
+    cover_4408 = cover_4408.any(axis=0)
+    m4408 = m4408.sum(axis=1)
+  unsupported = ((m4404 > 0) & ~cover_4404).any(axis=(1, 2, 3)) | ((m4405 > 0) & ~cover_4405).any(axis=(1, 2, 3)) \
+              | ((m4408 > 0) & ~cover_4408).reshape(len(areas), -1).any(axis=1)
+  return unsupported
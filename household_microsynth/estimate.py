@@ -0,0 +1,96 @@
+""" Runtime and memory cost model of household microsyntheses, calibrated from past runs, for sizing and packing jobs """
+
+import json
+import heapq
+import numpy as np
+import pandas as pd
+
+# what the cost of a region is modelled on: number of areas, dwellings (incl. communal and unoccupied), communal
+# establishments, and areas that use the structural seed (these are slower to converge)
+FEATURES = ["areas", "dwellings", "communal", "structural"]
+
+def runs(events):
+  """
+  Extracts the completed household runs from progress events (see progress.read_events; an events file may hold several
+  runs). Returns a DataFrame of the region, resolution, features, duration (s) and peak memory (bytes) of each run
+  """
+  rows = []
+  run = None
+  for record in events:
+    if record["target"] != "households":
+      continue
+    if record["event"] == "start":
+      run = {"region": record.get("region"), "resolution": record.get("resolution"), "areas": record["total"], "dwellings": 0,
+             "communal": 0, "structural": 0}
+    elif run is not None and record["event"] == "area_end":
+      run["dwellings"] += record["dwellings"]
+      run["communal"] += record.get("communal", 0)
+      run["structural"] += record.get("seed") == "structural"
+    elif run is not None and record["event"] == "finish":
+      run["time"] = record["duration"]
+      run["memory"] = record.get("peak_rss", np.nan)
+      rows.append(run)
+      run = None
+  return pd.DataFrame(rows, columns=["region", "resolution"] + FEATURES + ["time", "memory"])
+
+def calibrate(history):
+  """
+  Fits (least squares) a linear model of the time and peak memory of a run to its features, from a DataFrame of past runs
+  (see runs). Returns the model (a dict of the coefficients, constant first)
+  """
+  if len(history) <= len(FEATURES):
+    raise ValueError("at least %d runs are needed to calibrate the model, got %d" % (len(FEATURES) + 1, len(history)))
+  design = np.column_stack([np.ones(len(history))] + [history[f].values.astype(float) for f in FEATURES])
+  model = {"features": FEATURES, "runs": len(history)}
+  for cost in ["time", "memory"]:
+    known = ~np.isnan(history[cost].values.astype(float))
+    if known.sum() <= len(FEATURES):
+      raise ValueError("at least %d runs with %s are needed to calibrate the model" % (len(FEATURES) + 1, cost))
+    coefs, _, _, _ = np.linalg.lstsq(design[known], history[cost].values[known].astype(float), rcond=None)
+    model[cost] = list(coefs)
+  return model
+
+def save(model, filename):
+  print("Writing cost model to", filename)
+  with open(filename, "w") as output:
+    json.dump(model, output, indent=2)
+
+def load(filename):
+  with open(filename) as model:
+    return json.load(model)
+
+def features(msynth):
+  """ The features of a household microsynthesis (with its tables loaded) """
+  _, _, _, use_structural = msynth.prepare()
+  return {"areas": len(use_structural), "dwellings": int(msynth.total_dwellings),
+          "communal": int(msynth.communal.OBS_VALUE.sum()), "structural": int(use_structural.sum())}
+
+def predict(model, features):
+  """ The expected time (s) and peak memory (bytes) of a run with the given features """
+  x = np.array([1.0] + [float(features[f]) for f in model["features"]])
+  return max(float(x.dot(model["time"])), 0.0), max(float(x.dot(model["memory"])), 0.0)
+
+def pack(times, jobs):
+  """ Assigns items with the given times to jobs, longest first to the least loaded job. Returns the job of each item """
+  assignment = np.zeros(len(times), dtype=int)
+  loads = [(0.0, j) for j in range(jobs)]
+  for i in np.argsort(-np.asarray(times), kind="mergesort"):
+    load, j = heapq.heappop(loads)
+    assignment[i] = j
+    heapq.heappush(loads, (load + times[i], j))
+  return assignment
+
+def plan(estimates, max_time):
+  """
+  Groups regions (a DataFrame with region, time and memory columns) into as few jobs as possible (run one region after
+  another) of balanced time, each taking at most max_time (s) if possible. Returns estimates with a job column
+  """
+  times = estimates.time.values
+  jobs = max(1, int(np.ceil(times.sum() / max_time)))
+  assignment = pack(times, jobs)
+  while jobs < len(times) and np.bincount(assignment, weights=times).max() > max_time:
+    jobs += 1
+    assignment = pack(times, jobs)
+  planned = estimates.copy()
+  planned["job"] = assignment
+  return planned.sort_values(["job", "time"], ascending=[True, False]).reset_index(drop=True)
@@ -0,0 +1,56 @@
+""" Concurrent retrieval of census tables, with retries """
+
+import time
+from urllib.error import HTTPError
+from concurrent.futures import ThreadPoolExecutor
+
+# maximum number of concurrent requests (kept low, to be polite to the census APIs)
+WORKERS = 4
+# retries per request, waiting BACKOFF, 2*BACKOFF, 4*BACKOFF... seconds between attempts
+RETRIES = 3
+BACKOFF = 1.0
+
+def retry(func, retries=RETRIES, backoff=BACKOFF):
+  """ Calls func, retrying on network errors (server errors, timeouts, dropped connections) """
+  for attempt in range(retries + 1):
+    try:
+      return func()
+    except OSError as error:
+      # client errors (e.g. a malformed query) won't be fixed by retrying
+      if isinstance(error, HTTPError) and error.code < 500 and error.code != 429:
+        raise
+      if attempt == retries:
+        raise
+      print("retrying after error:", error)
+      time.sleep(backoff * 2 ** attempt)
+
+def table(func):
+  """ The table a request is for: the first argument of a partial call (e.g. get_data), or None """
+  args = getattr(func, "args", ())
+  return args[0] if args else None
+
+def serial(funcs, retries=RETRIES, backoff=BACKOFF):
+  """ Calls each of funcs in turn, with retries, returning their results """
+  return [retry(func, retries, backoff) for func in funcs]
+
+def fetch_all(requests, workers=WORKERS, retries=RETRIES, backoff=BACKOFF):
+  """
+  Runs requests (a dict of name: function returning a table, e.g. a get_data call on a shared client) in up to workers
+  threads, each with retries, and returns a dict of name: table. Downloads and csv parsing mostly release the GIL, so this
+  takes about as long as the slowest request rather than the sum of them. Requests for the same table (see table) are
+  run one after another in the same thread, since the census API clients write a table's metadata and cache files
+  without locking. The first error (after retries) is raised
+  """
+  if workers <= 1:
+    return {name: retry(requests[name], retries, backoff) for name in requests}
+  groups = {}
+  for name in requests:
+    key = table(requests[name])
+    groups.setdefault(name if key is None else key, []).append(name)
+  with ThreadPoolExecutor(max_workers=max(1, min(workers, len(groups)))) as executor:
+    futures = [(names, executor.submit(serial, [requests[name] for name in names], retries, backoff))
+               for names in groups.values()]
+    results = {}
+    for names, future in futures:
+      results.update(zip(names, future.result()))
+    return {name: results[name] for name in requests}
@@ -0,0 +1,93 @@
+"""
+Goodness of fit of a synthetic household population to the census tables, and of its unconstrained cross-tabs to the seed
+"""
+
+import numpy as np
+import pandas as pd
+
+import household_microsynth.utils as utils
+import household_microsynth.seed as seed
+import household_microsynth.planner as planner
+
+# the census tables the households are constrained to (see planner.py): the (area-first) tensor of each held by
+# Household, and the population column and category map (see Household.maps) of each of the other dimensions
+TABLES = {name: (attr, [(planner.COLUMNS[dim], dim) for dim in dims]) for name, attr, dims in planner.TABLES}
+
+# tables that are not synthesised by tenure for Scotland
+NO_TENURE_SC = planner.NO_TENURE_SC
+
+# the dimensions of the seed (T R O B H), and the pairs of them that no census table constrains jointly
+SEED_DIMS = [("LC4402_C_TENHUK11", "tenure"), ("LC4404_C_ROOMS", "rooms"), ("LC4404_C_SIZHUK11", "occupants"),
+             ("LC4405EW_C_BEDROOMS", "bedrooms"), ("LC4408_C_AHTHUK11", "hhtype")]
+SEED_CROSSTABS = {"Rooms x Bedrooms": (1, 3), "Rooms x HHType": (1, 4), "Occupants x HHType": (2, 4),
+                  "Bedrooms x HHType": (3, 4)}
+
+def tae(observed, synthetic):
+  """ Total absolute error of each area (the first axis) """
+  return np.abs(observed - synthetic).reshape(len(observed), -1).sum(axis=1)
+
+def srmse(observed, synthetic):
+  """ Standardised root mean square error of each area (the first axis): the RMSE over the mean observed count """
+  observed = observed.reshape(len(observed), -1).astype(float)
+  synthetic = synthetic.reshape(len(synthetic), -1).astype(float)
+  rmse = np.sqrt(np.mean((observed - synthetic) ** 2, axis=1))
+  mean = observed.mean(axis=1)
+  return np.divide(rmse, mean, out=np.full(len(mean), np.nan), where=mean > 0)
+
+def metrics(name, areas, observed, synthetic):
+  """ The fit of one table (area-first tensors of expected and synthesised counts) in each area """
+  return pd.DataFrame({"Area": areas, "Table": name, "Total": observed.reshape(len(observed), -1).sum(axis=1),
+                       "TAE": tae(observed, synthetic), "SRMSE": srmse(observed, synthetic)},
+                      columns=["Area", "Table", "Total", "TAE", "SRMSE"])
+
+def summarise(per_area, tensors):
+  """ Per table: the total TAE and the mean and worst SRMSE over areas, plus the fit of the region as a whole """
+  summary = per_area.groupby("Table", sort=False).agg({"Total": "sum", "TAE": "sum", "SRMSE": ["mean", "max"]})
+  summary.columns = ["Total", "TAE", "MeanSRMSE", "MaxSRMSE"]
+  summary["RegionSRMSE"] = [srmse(tensors[t][0].sum(axis=0, keepdims=True), tensors[t][1].sum(axis=0, keepdims=True))[0]
+                            for t in summary.index]
+  return summary.reset_index()
+
+def household_fit(msynth, blocks=None, survey=None, sample=None):
+  """
+  Compares the occupied households of a (run) household microsynthesis with the census tables (and the persons per
+  bedroom marginal, for England and Wales), and the cross-tabs that no table constrains with the seed (by default the
+  survey seed, scaled to each area's households). The tensors of the population are accumulated in a single pass over
+  blocks (DataFrames, e.g. store.blocks) if given, or msynth.dwellings. Only the areas with the given indices are
+  compared if sample is given (e.g. a preview, see preview.py). Returns the metrics for each area and table, and a
+  summary of each table
+  """
+  select = slice(None) if sample is None else np.asarray(sample)
+  areas = msynth.lc4404.GEOGRAPHY_CODE.unique()[select]
+  crosstabs = {name: dims for name, dims in SEED_CROSSTABS.items() if not (msynth.scotland and 3 in dims)}
+  specs = {}
+  for name in TABLES:
+    attr, dims = TABLES[name]
+    observed = getattr(msynth, attr)[select]
+    if msynth.scotland and name in NO_TENURE_SC:
+      observed = observed.sum(axis=1)
+      dims = dims[1:]
+    specs[name] = (observed, dims)
+  # persons per bedroom is derived rather than constrained, and households where it is ambiguous are not counted
+  if getattr(msynth, "m4408ppb", None) is not None:
+    specs["LC4408PPB"] = (msynth.m4408ppb[select], [("LC4408EW_C_PPBROOMHEW11", "ppbroom")])
+  if survey is None:
+    survey = seed.get_survey_TROBH()
+  households = msynth.m4404[select].reshape(len(areas), -1).sum(axis=1)
+  for name in crosstabs:
+    dims = crosstabs[name]
+    marginal = survey.sum(axis=tuple(d for d in range(survey.ndim) if d not in dims))
+    specs[name] = (households[:, np.newaxis, np.newaxis] * marginal / marginal.sum(), [SEED_DIMS[d] for d in dims])
+
+  synthetic = {name: 0 for name in specs}
+  for block in [msynth.dwellings] if blocks is None else blocks:
+    occupied = block[(block.QS420_CELL == msynth.NOTAPPLICABLE).values & (block.LC4404_C_SIZHUK11 != 0).values]
+    for name in specs:
+      cols = [c for c, _ in specs[name][1]]
+      maps = [msynth.maps[m] for _, m in specs[name][1]]
+      synthetic[name] = synthetic[name] + utils.area_tensor(occupied, areas, cols, maps,
+                                                            "Count" if "Count" in block.columns else None, "Area")
+
+  tensors = {name: (specs[name][0], synthetic[name]) for name in specs}
+  per_area = pd.concat([metrics(name, areas, *tensors[name]) for name in specs], ignore_index=True)
+  return per_area, summarise(per_area, tensors)
@@ -0,0 +1,129 @@
+""" Geography hierarchy (OA -> LSOA -> MSOA -> LAD) so that one OA-level population can be rolled up to coarser levels """
+
+import os
+import numpy as np
+import pandas as pd
+
+# finest first
+LEVELS = ["OA11", "LSOA11", "MSOA11", "LAD"]
+
+# columns of the ONS "Output Area to Lower Layer Super Output Area to Middle Layer Super Output Area to Local Authority
+# District (December 2011)" lookup. (For Scotland, map the levels to the OA, data zone, intermediate zone and council columns)
+COLUMNS = {"OA11": "OA11CD", "LSOA11": "LSOA11CD", "MSOA11": "MSOA11CD", "LAD": "LAD11CD"}
+
+class Hierarchy:
+  """
+  The codes at each level (sorted) and, for each OA, the index of its parent at each level. Areas are mapped to their
+  parents by array lookups, so annotating or rolling up a population is vectorised
+  """
+
+  def __init__(self, codes, parents):
+    # level -> sorted array of codes
+    self.codes = codes
+    # level -> index into codes[level] of the parent of each OA (in codes[LEVELS[0]] order)
+    self.parents = parents
+
+  @staticmethod
+  def from_table(table, columns=COLUMNS):
+    """ Builds the hierarchy from a lookup table with one row per OA and a column of codes for each level """
+    table = table.drop_duplicates(columns[LEVELS[0]]).sort_values(columns[LEVELS[0]])
+    codes = {}
+    parents = {}
+    for level in LEVELS:
+      values = np.asarray(table[columns[level]].values, dtype=str)
+      codes[level] = np.unique(values)
+      parents[level] = np.searchsorted(codes[level], values).astype(np.int32)
+    return Hierarchy(codes, parents)
+
+  def save(self, filename):
+    """ Saves the hierarchy as a (numpy) npz file """
+    arrays = {}
+    for level in LEVELS:
+      arrays["codes_" + level] = np.asarray(self.codes[level], dtype=str)
+      arrays["parents_" + level] = self.parents[level]
+    np.savez(filename, **arrays)
+
+  @staticmethod
+  def load(filename):
+    """ Loads a hierarchy saved by save """
+    with np.load(filename) as arrays:
+      return Hierarchy({level: arrays["codes_" + level] for level in LEVELS},
+                       {level: arrays["parents_" + level] for level in LEVELS})
+
+  def index(self, areas, level=LEVELS[0]):
+    """ Positions of areas in the codes of level, raising ValueError if any are not in the hierarchy """
+    areas = np.asarray(areas).astype(str)
+    codes = self.codes[level]
+    positions = np.minimum(np.searchsorted(codes, areas), len(codes) - 1)
+    unknown = codes[positions] != areas
+    if np.any(unknown):
+      raise ValueError(str(np.sum(unknown)) + " areas not in the " + level + " geography, e.g. " + areas[unknown][0])
+    return positions
+
+  def mapping(self, base, level):
+    """ For each code at base, the index of its parent at level (a coarser level) """
+    if LEVELS.index(level) < LEVELS.index(base):
+      raise ValueError(level + " is finer than " + base)
+    # the parent of any OA in each base area is its parent
+    _, first = np.unique(self.parents[base], return_index=True)
+    return self.parents[level][first]
+
+  def restrict(self, areas):
+    """ Returns the hierarchy of just the given OAs (e.g. those in a run) """
+    keep = np.unique(self.index(areas))
+    codes = {}
+    parents = {}
+    for level in LEVELS:
+      values = self.codes[level][self.parents[level][keep]]
+      codes[level] = np.unique(values)
+      parents[level] = np.searchsorted(codes[level], values).astype(np.int32)
+    return Hierarchy(codes, parents)
+
+  def annotate(self, population, column="Area", base=LEVELS[0]):
+    """ Returns a copy of population with the codes of the parents of its areas (at base) as categorical columns """
+    population = population.copy()
+    positions = self.index(population[column].values, base)
+    for level in LEVELS[LEVELS.index(base) + 1:]:
+      population[level] = pd.Categorical.from_codes(self.mapping(base, level)[positions], self.codes[level])
+    return population
+
+  def rollup(self, table, level, by=None, column="Area", base=LEVELS[0], count="Count"):
+    """
+    Totals of a population (one row per dwelling or person, or with a count column) or a table of counts by the parent of
+    its areas at level and the columns in by
+    """
+    parent = self.mapping(base, level)[self.index(table[column].values, base)]
+    weights = table[count].values if count in table.columns else np.ones(len(table), dtype=int)
+    if not by:
+      totals = np.bincount(parent, weights=weights, minlength=len(self.codes[level]))
+      present = np.unique(parent)
+      return pd.DataFrame({level: self.codes[level][present], count: totals[present].astype(int)}, columns=[level, count])
+    grouped = table[list(by)].copy()
+    grouped[level] = parent
+    grouped[count] = weights
+    grouped = grouped.groupby([level] + list(by))[count].sum().reset_index()
+    grouped[level] = self.codes[level][grouped[level].values]
+    return grouped
+
+  def rollup_tensor(self, tensor, areas, level, base=LEVELS[0]):
+    """
+    Sums the rows of tensor (a marginal or table with areas as its first axis) into the parents at level of areas.
+    Returns the summed tensor and the parent codes (the rows of the result)
+    """
+    parent = self.mapping(base, level)[self.index(areas, base)]
+    present, rows = np.unique(parent, return_inverse=True)
+    summed = np.zeros((len(present),) + tensor.shape[1:], dtype=tensor.dtype)
+    np.add.at(summed, rows, tensor)
+    return summed, self.codes[level][present]
+
+def load(filename, cache_dir="./cache", columns=COLUMNS):
+  """ Loads the hierarchy from a lookup csv (see COLUMNS), caching it as npz for quick loading """
+  cached = os.path.join(cache_dir, "geography_" + os.path.splitext(os.path.basename(filename))[0] + ".npz")
+  if os.path.isfile(cached) and os.path.getmtime(cached) >= os.path.getmtime(filename):
+    print("using cached geography:", cached)
+    return Hierarchy.load(cached)
+  print("building geography from", filename)
+  hierarchy = Hierarchy.from_table(pd.read_csv(filename, usecols=list(columns.values()), dtype=str), columns)
+  os.makedirs(cache_dir, exist_ok=True)
+  hierarchy.save(cached)
+  return hierarchy
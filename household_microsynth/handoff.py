@@ -0,0 +1,55 @@
+""" In-process handoff of synthetic populations to downstream consumers, as numpy arrays or Arrow tables rather than csv """
+
+import numpy as np
+import pandas as pd
+
+# columns with arbitrary (string) values, which are passed as integer codes into a dictionary of the values
+ENCODED = ("Area",)
+
+def from_frame(table, encoded=ENCODED):
+  """
+  Returns the columns of a population DataFrame as a dict of numpy arrays, where encoded columns hold codes, and a dict of
+  the dictionary (array of values) of each encoded column. Columns that are already numeric are not copied
+  """
+  columns = {}
+  dictionaries = {}
+  for col in table.columns:
+    values = table[col].values
+    if col in encoded:
+      codes, uniques = pd.factorize(values)
+      columns[col] = codes.astype(np.int32)
+      dictionaries[col] = np.asarray(uniques)
+    else:
+      columns[col] = values if values.dtype.kind in "iuf" else values.astype(np.int64)
+  return columns, dictionaries
+
+def from_store(store, start=0, stop=None):
+  """
+  Returns views (not copies) of rows [start, stop) of the arrays of a store.ColumnStore, and the dictionaries of its encoded
+  columns
+  """
+  stop = store.index if stop is None else stop
+  columns = {col: store.arrays[col][start:stop] for col in store.columns}
+  dictionaries = {col: np.asarray(store.categories[col]) for col in store.categories}
+  return columns, dictionaries
+
+def population(msynth, start=0, stop=None):
+  """ Rows [start, stop) of the population of a Household (whether in a store or not) or ReferencePerson microsynthesis """
+  if getattr(msynth, "store", None) is not None:
+    return from_store(msynth.store, start, stop)
+  table = msynth.dwellings if hasattr(msynth, "dwellings") else msynth.hrps
+  return from_frame(table.iloc[start:stop])
+
+def to_arrow(columns, dictionaries):
+  """ Converts columns (see from_frame) to an Arrow table, with dictionary-encoded columns. Numeric arrays are not copied """
+  try:
+    import pyarrow as pa
+  except ImportError:
+    raise ImportError("pyarrow is required for Arrow output (pip install pyarrow)")
+  arrays = []
+  for col in columns:
+    if col in dictionaries:
+      arrays.append(pa.DictionaryArray.from_arrays(pa.array(columns[col]), pa.array(dictionaries[col])))
+    else:
+      arrays.append(pa.array(columns[col]))
+  return pa.Table.from_arrays(arrays, names=list(columns))
@@ -1,12 +1,70 @@
 """ Household microsynthesis """
+import os
+import json
+import hashlib
+import functools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 
 import ukcensusapi.Nomisweb as Api_ew
 import ukcensusapi.NRScotland as Api_sc
-import humanleague
 import household_microsynth.utils as utils
 import household_microsynth.seed as seed
+import household_microsynth.store as store
+import household_microsynth.analyzer as analyzer
+import household_microsynth.solver as solver
+import household_microsynth.progress as progress
+import household_microsynth.fetch as fetch
+import household_microsynth.memprof as memprof
+import household_microsynth.handoff as handoff
+import household_microsynth.planner as planner
+
+# the solver call sites of the Scottish derived tables
+SC_SITES = ("sc_lc4404", "sc_lc4408")
+
+def _derive_area_sc(m4402, m407, m406, m116, area, run_seed, settings=None):
+  """
+  Synthesises the tenure-rooms-size and tenure-hhtype tables for a single Scottish geography, also returning the
+  solver report
+  """
+  if not np.sum(m4402):
+    return np.zeros((len(m4402), len(m407), len(m406)), dtype=int), np.zeros((len(m4402), len(m116)), dtype=int), []
+  area_solver = solver.Solver(run_seed, settings)
+  a4404 = area_solver.qis(SC_SITES[0], area, [np.array([0]), np.array([1]), np.array([2])], [m4402, m407, m406])
+  utils.check_humanleague_result(a4404, [m4402, m407, m406])
+  a4408 = area_solver.qis(SC_SITES[1], area, [np.array([0]), np.array([1])], [m4402, m116])
+  utils.check_humanleague_result(a4408, [m4402, m116])
+  return a4404["result"], a4408["result"], area_solver.report
+
+def _derived_files_sc(cache_dir, region, resolution, run_seed, area_solver):
+  """
+  The cache files of the Scottish derived LC4404 and LC4408 tables, which depend on the seed and on the settings (of
+  area_solver, a solver.Solver) of the calls that synthesise them
+  """
+  config = json.dumps([area_solver.config(site) for site in SC_SITES], sort_keys=True)
+  key = "_".join([region, resolution, str(run_seed), hashlib.sha256(config.encode("utf-8")).hexdigest()[:8]])
+  return cache_dir + "/LC4404SC_derived_" + key + ".csv", cache_dir + "/LC4408SC_derived_" + key + ".csv"
+
+def _load_derived_sc(files):
+  """ The cached derived LC4404 and LC4408 tables (see _derived_files_sc), or None if they have not been cached """
+  if not all(os.path.isfile(f) for f in files):
+    return None
+  print("using cached derived data:", *files)
+  return tuple(pd.read_csv(f) for f in files)
+
+def _save_derived_sc(files, tables):
+  """ Caches the derived LC4404 and LC4408 tables (see _derived_files_sc) """
+  for f, table in zip(files, tables):
+    table.to_csv(f, index=False)
+
+# the household microsynthesis whose replicates are being generated, inherited by (forked) worker processes
+_ENSEMBLE = None
+
+def _replicate(r):
+  """ Synthesises replicate r of the ensemble (in a worker process, see Household.replicates) """
+  return _ENSEMBLE.replicate(r)
 
 class Household:
   """ Household microsynthesis """
@@ -15,10 +73,33 @@ class Household:
   UNKNOWN = -1
   NOTAPPLICABLE = -2
 
-  # initialise, supplying geographical area and resolution , plus (optionally) a location to cache downloads
-  def __init__(self, region, resolution, cache_dir="./cache"):
-    self.api_ew = Api_ew.Nomisweb(cache_dir)
+  # Methods for combining the household tables
+  ENGINES = ("joint", "conditional")
+
+  # initialise, supplying geographical area and resolution , plus (optionally) a location to cache downloads,
+  # the number of worker processes for the parallelisable stages, a directory in which to hold the population
+  # as memory-mapped columns (rather than in memory), the seed from which each area's random streams are derived,
+  # whether to output distinct dwellings with counts, the engine (see ENGINES) used to combine the household tables,
+  # and the settings for each solver call site (see solver.py). A nomisweb client and the region's area codes
+  # (see utils.get_area_codes) can be supplied to share them with other microsyntheses (see pipeline.py)
+  def __init__(self, region, resolution, cache_dir="./cache", workers=1, store_dir=None, seed=0, aggregate=False,
+               engine="joint", solver_settings=None, api=None, area_codes=None):
+    self.api_ew = Api_ew.Nomisweb(cache_dir) if api is None else api
+    self.area_codes = area_codes
     self.api_sc = Api_sc.NRScotland(cache_dir)
+    self.cache_dir = cache_dir
+    self.workers = workers
+    self.seed = seed
+    self.solver = solver.Solver(seed, solver_settings)
+    # aggregate: one row per distinct dwelling (in each area) with the number of such dwellings in a Count column
+    self.aggregate = aggregate
+    if aggregate and store_dir is not None:
+      raise ValueError("aggregated output cannot be held in a column store")
+    # joint: a single QIS over all the household tables, conditional: QIS for the core tables then the others in the
+    # smallest groups the planner can find, dealt out within the dimensions they share with the core (see planner.py)
+    if engine not in Household.ENGINES:
+      raise ValueError("engine must be one of " + str(Household.ENGINES))
+    self.engine = engine
 
     self.region = region
     # convert input string to enum
@@ -29,8 +110,11 @@ class Household:
     if self.region[0] == "S":
       self.scotland = True
       print("Running in 'scotland mode'")
+    # the census tables and the dimensions they constrain (see planner.py)
+    self.tables = planner.tables(self.scotland)
 
-    # (down)load the census tables
+    # (down)load the census tables (persons per bedroom is not available for Scotland)
+    self.lc4408ppb = None
     self.__get_census_data()
 
     # initialise table and index
@@ -39,8 +123,21 @@ class Household:
                   "LC4402_C_CENHEATHUK11", "LC4605_C_NSSEC", "LC4202_C_ETHHUK11", "LC4202_C_CARSNO"]
     self.total_dwellings = sum(self.ks401.OBS_VALUE) + sum(self.communal.OBS_VALUE)
 #    self.dwellings = pd.DataFrame(index=range(0, self.total_dwellings), columns=categories)
-    self.dwellings = pd.DataFrame(columns=categories)
+    if aggregate:
+      categories = categories + ["Count"]
+    self.columns = categories
+    # population is either built up in a DataFrame or written into a preallocated store
+    self.store = None
+    if store_dir is None:
+      self.dwellings = self.__frame()
+    else:
+      self.dwellings = None
+      self.store = store.ColumnStore(categories, self.total_dwellings, store_dir)
+    # number of dwellings synthesised
     self.index = 0
+    self.progress = None
+    self.plan = None
+    self.callback = None
 
     # generate indices
     self.type_index = self.lc4402.C_TYPACCOM.unique()
@@ -48,196 +145,274 @@ class Household:
     self.ch_index = self.lc4402.C_CENHEATHUK11.unique()
     self.comp_index = self.lc4408.C_AHTHUK11.unique()
 
-  def run(self):
-    """ run the microsynthesis """
+  def reset(self):
+    """ Discards the synthesised population (and solver report) so that run can be called again """
+    if self.store is None:
+      self.dwellings = self.__frame()
+    else:
+      self.store.index = 0
+    self.index = 0
+    self.solver = solver.Solver(self.seed, self.solver.settings)
+
+  def configure(self, seed=0, aggregate=False, engine="joint", solver_settings=None):
+    """
+    Sets the options (see __init__) that do not change the census tables, e.g. for a copy of a loaded microsynthesis,
+    and discards the synthesised population
+    """
+    if aggregate and self.store is not None:
+      raise ValueError("aggregated output cannot be held in a column store")
+    if engine not in Household.ENGINES:
+      raise ValueError("engine must be one of " + str(Household.ENGINES))
+    self.seed = seed
+    self.aggregate = aggregate
+    self.engine = engine
+    self.columns = [col for col in self.columns if col != "Count"] + (["Count"] if aggregate else [])
+    self.solver = solver.Solver(seed, solver_settings)
+    self.reset()
+
+  def run(self, events=None, memory=None, callback=None):
+    """
+    run the microsynthesis, writing progress events (see progress.py) to events (a file-like object) if given, and
+    recording the memory use of each area in memory (a memprof.MemoryProfile) if given. If callback is given it is called
+    with the target ("households"), area and rows (see handoff.population) of each area as it is completed
+    """
+
+    area_map = self.start(events, memory, callback)
+    for i, area in enumerate(area_map):
+      self.add_area(i, area)
+    self.finish()
+
+  def start(self, events=None, memory=None, callback=None):
+    """ Prepares the tables for all areas and starts reporting progress (see run). Returns the areas """
+    self.plan = self.__prepare()
+    self.callback = callback
+    render = progress.LogRenderer() if memory is None else progress.tee(progress.LogRenderer(), memory)
+    self.progress = progress.Progress("households", len(self.plan[0]), events, render, region=self.region,
+                                      resolution=self.resolution, engine=self.engine, aggregate=self.aggregate,
+                                      store=self.store is not None)
+    return self.plan[0]
+
+  def add_area(self, i, area):
+    """ Synthesises the households, communal residences and unoccupied dwellings of the i'th area (after start) """
+    _, constraints, structural, use_structural = self.plan
+    self.progress.area_start(area)
+    start_index = self.index
+    first = self.__rows()
+    start_calls = len(self.solver.report)
+
+    # 1. households
+    households = self.__add_households(i, area, structural if use_structural[i] else constraints, structural)
+    self.__append(households)
+
+    # add communal residences
+    communal = self.__add_communal(area)
+
+    # # add unoccupied properties
+    self.__add_unoccupied(area, households)
+
+    calls = self.solver.report[start_calls:]
+    self.progress.area_end(self.index - start_index, engine=self.engine, communal=communal,
+                           seed="structural" if use_structural[i] else "survey",
+                           fallback=len([c for c in calls if c["Site"] == "p0"]) > 1,
+                           solver_attempts=sum(c["Attempts"] for c in calls),
+                           solver_time=sum(c["Time"] for c in calls))
+    if self.callback is not None:
+      self.callback("households", area, handoff.population(self, first))
+
+  def finish(self):
+    """ Finishes reporting progress (see run), recording the peak memory use of the process """
+    self.progress.finish(peak_rss=memprof.peak_rss())
+    self.progress = None
+    self.plan = None
+    self.callback = None
+
+  def prepare(self):
+    """
+    Prepares and checks the tables for all areas (as run does). Returns the areas, the survey and structural seeds, and
+    which areas are to use the structural seed
+    """
+    return self.__prepare()
 
+  def autotune(self, sample_size=10, candidates=solver.CANDIDATES):
+    """
+    Times the household synthesis of a random sample of areas with each of the candidate solver settings (see solver.py)
+    and adopts the fastest that converges and passes the checks. The population is not modified
+    """
+    area_map, constraints, structural, use_structural = self.__prepare()
+    rng = utils.area_rng(self.seed, self.region, "autotune")
+    sample = rng.choice(len(area_map), min(sample_size, len(area_map)), replace=False)
+    def trial(i):
+      self.__add_households(i, area_map[i], structural if use_structural[i] else constraints, structural)
+    return solver.autotune(self.solver, trial, sample, candidates)
+
+  def replicates(self, n, workers=1):
+    """
+    Generates n independent replicates of the household population from a single preparation of the tables, e.g. for
+    uncertainty analysis. Replicate r uses its own solver skips and random streams (see replicate), and replicates are
+    run in (forked) worker processes if workers > 1. Returns the replicates as aggregated rows (see utils.aggregate)
+    with a Replicate column. Any population already synthesised is discarded
+    """
+    global _ENSEMBLE
+    if self.store is not None:
+      raise ValueError("replicates cannot be held in a column store")
+    self.plan = self.__prepare()
+    try:
+      if workers > 1:
+        # forked rather than spawned, so that the workers inherit the prepared tables rather than loading them again
+        _ENSEMBLE = self
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as executor:
+          results = list(executor.map(_replicate, range(n)))
+      else:
+        results = [self.replicate(r) for r in range(n)]
+    finally:
+      _ENSEMBLE = None
+      self.plan = None
+      self.reset()
+    return pd.concat(results, ignore_index=True)
+
+  def replicate(self, r):
+    """
+    Synthesises replicate r of the population (after replicates has prepared the tables), with solver skips (see
+    solver.replicate) and random streams drawn from utils.replicate_seed. Returns it aggregated
+    """
+    seed = self.seed
+    settings = self.solver.settings
+    self.seed = utils.replicate_seed(seed, r)
+    self.solver = solver.replicate(seed, settings, r)
+    self.dwellings = self.__frame()
+    self.index = 0
+    area_map = self.plan[0]
+    self.progress = progress.Progress("households", len(area_map), replicate=r)
+    try:
+      for i, area in enumerate(area_map):
+        self.add_area(i, area)
+      population = self.dwellings if self.aggregate else utils.aggregate(self.dwellings)
+    finally:
+      self.seed = seed
+      self.solver = solver.Solver(seed, settings)
+      self.progress = None
+    print("Replicate %d: %d dwellings" % (r, self.index))
+    population.insert(0, "Replicate", r)
+    return population
+
+  def __prepare(self):
+    """ Returns the areas, the survey and structural seeds, and which areas are to use the structural seed """
     area_map = self.lc4404.GEOGRAPHY_CODE.unique()
 
     # construct seed disallowing states where B>R]
     # T  R  O  B  H  (H=household type)
     # use 7 waves (2009-2015 incl)
     constraints = seed.get_survey_TROBH() #[1,2,3,4,5,6,7]
+    # all possible states equally likely, for areas where the survey is not representative
+    structural = seed.get_impossible_TROBH()
+    # survey seed values include a pseudo-count of 0.5 for possible but unobserved states
+    observed = constraints > 0.5
 
     # bedrooms removed for Scotland
     if self.scotland:
       constraints = np.expand_dims(np.sum(constraints, axis=3), 3)
+      structural = np.expand_dims(np.sum(structural, axis=3), 3)
+      observed = np.expand_dims(np.any(observed, axis=3), 3)
+
+    # tables for every area, checked upfront for consistency
+    self.__get_tensors(area_map)
+    self.stages = planner.plan(self.tables, {dim: len(self.maps[dim]) for dim in self.maps}, self.engine == "joint")
+    print("Household synthesis plan (peak %d cells):" % planner.peak(self.stages))
+    for line in planner.describe(self.stages):
+      print("  " + line)
+    use_structural = analyzer.analyse(area_map, self.m4404, self.m4405, self.m4408, self.m4402, self.m4202,
+                                      observed, structural > 0, self.scotland)
+    if use_structural.any():
+      print("Using unweighted TROBH seed for %d areas with insufficient survey support" % use_structural.sum())
+    return area_map, constraints, structural, use_structural
+
+  def __rows(self):
+    """ Number of rows of the population so far (fewer than the dwellings if aggregated) """
+    return len(self.dwellings) if self.store is None else self.store.index
+
+  def __frame(self):
+    """ An empty population, with integer columns (other than Area) so that they can be handed off without copying """
+    return pd.DataFrame({col: pd.Series(dtype=object if col == "Area" else np.int64) for col in self.columns})
+
+  def __append(self, chunk):
+    self.index += chunk.Count.sum() if self.aggregate else len(chunk)
+    # the chunks are built up column by column from empty (object) frames
+    chunk = chunk.astype(dict((col, np.int64) for col in self.columns if col != "Area"))
+    if self.store is None:
+      self.dwellings = pd.concat([self.dwellings, chunk], ignore_index=True)
+    else:
+      self.store.append(chunk)
 
-    for area in area_map:
-      print('.', end='', flush=True)
-
-      # 1. households
-      self.__add_households(area, constraints)
-
-      # add communal residences
-      self.__add_communal(area)
-
-      # # add unoccupied properties
-      self.__add_unoccupied(area)
-
-      # end area loop
-
-    # temp fix - TODO remove this column?
-    self.dwellings.LC4408EW_C_PPBROOMHEW11 = np.repeat(self.UNKNOWN, len(self.dwellings.LC4408EW_C_PPBROOMHEW11))
-
-  def __add_households(self, area, constraints):
-
-    # TODO use actual values from tables
-    # TODO make members?                            # Dim (overall dim)
-    tenure_map = self.lc4402.C_TENHUK11.unique()    # 0
-    rooms_map = self.lc4404.C_ROOMS.unique()        # 1
-    occupants_map = self.lc4404.C_SIZHUK11.unique() # 2
-    bedrooms_map = self.lc4405.C_BEDROOMS.unique()  # 3 [1,2,3,4] or [-1]
-    hhtype_map =  self.lc4408.C_AHTHUK11.unique()   # 4
-    #
-    ch_map = self.lc4402.C_CENHEATHUK11.unique()    # 1 (5)
-    buildtype_map = self.lc4402.C_TYPACCOM.unique() # 2 (6)
-    eth_map = self.lc4202.C_ETHHUK11.unique()       # 3 (7)
-    cars_map = self.lc4202.C_CARSNO.unique()        # 4 (8)
-    econ_map = self.lc4605.C_NSSEC.unique()         # 5 (9)
-
-    tenure_rooms_occ = self.lc4404.loc[self.lc4404.GEOGRAPHY_CODE == area].copy()
-    # unmap indices
-    # TODO might be quicker to unmap the entire table upfront?
-    utils.unmap(tenure_rooms_occ.C_TENHUK11, tenure_map)
-    utils.unmap(tenure_rooms_occ.C_ROOMS, rooms_map)
-    utils.unmap(tenure_rooms_occ.C_SIZHUK11, occupants_map)
-
-    m4404 = utils.unlistify(tenure_rooms_occ,
-                            ["C_TENHUK11", "C_ROOMS", "C_SIZHUK11"],
-                            [len(tenure_map), len(rooms_map), len(occupants_map)],
-                            "OBS_VALUE")
-
-    # no bedroom info in Scottish data
-    tenure_beds_occ = self.lc4405.loc[self.lc4405.GEOGRAPHY_CODE == area].copy()
-
-    # unmap indices
-    utils.unmap(tenure_beds_occ.C_BEDROOMS, bedrooms_map)
-    utils.unmap(tenure_beds_occ.C_TENHUK11, tenure_map)
-    utils.unmap(tenure_beds_occ.C_SIZHUK11, occupants_map)
-
-    m4405 = utils.unlistify(tenure_beds_occ,
-                            ["C_TENHUK11", "C_BEDROOMS", "C_SIZHUK11"],
-                            [len(tenure_map), len(bedrooms_map), len(occupants_map)],
-                            "OBS_VALUE")
-#    print(m4405.shape)
-
-    tenure_accom = self.lc4408.loc[self.lc4408.GEOGRAPHY_CODE == area].copy()
-
-    utils.unmap(tenure_accom.C_TENHUK11, tenure_map)
-    utils.unmap(tenure_accom.C_AHTHUK11, hhtype_map)
-
-    m4408 = utils.unlistify(tenure_accom,
-                            ["C_TENHUK11", "C_AHTHUK11"],
-                            [len(tenure_map), len(hhtype_map)],
-                            "OBS_VALUE")
-    #print(np.sum(m4404), np.sum(m4405), np.sum(m4408))
-
-    # TODO relax IPF tolerance and maxiters when used within QISI?
-    m4408dim = np.array([0, 4])
-    # collapse m4408 dim for scotland
-    if self.scotland:
-      m4408 = np.sum(m4408, axis=0)
-      m4408dim = np.array([4])
-    p0 = humanleague.qisi(constraints, [np.array([0, 1, 2]), np.array([0, 3, 2]), m4408dim], [m4404, m4405, m4408])
-
-    # drop the survey seed if there are convergence problems
-    # TODO check_humanleague_result needs complete refactoring
-    if not isinstance(p0, dict) or not p0["conv"]:
-      print("Dropping TROBH constraint due to convergence failure")
-      p0 = humanleague.qisi(seed.get_impossible_TROBH(), [np.array([0, 1, 2]), np.array([0, 3, 2]), m4408dim], [m4404, m4405, m4408])
-      utils.check_humanleague_result(p0, [m4404, m4405, m4408], seed.get_impossible_TROBH())
+  def __message(self, text):
+    if self.progress is None:
+      print(text)
     else:
-      utils.check_humanleague_result(p0, [m4404, m4405, m4408], constraints)
-    
-    #print("p0 ok")
-
-    tenure_ch_accom = self.lc4402.loc[self.lc4402.GEOGRAPHY_CODE == area].copy()
-    utils.unmap(tenure_ch_accom.C_CENHEATHUK11, ch_map)
-    utils.unmap(tenure_ch_accom.C_TENHUK11, tenure_map)
-    utils.unmap(tenure_ch_accom.C_TYPACCOM, buildtype_map)
-
-    m4402 = utils.unlistify(tenure_ch_accom,
-                            ["C_TENHUK11", "C_CENHEATHUK11", "C_TYPACCOM"],
-                            [len(tenure_map), len(ch_map), len(buildtype_map)],
-                            "OBS_VALUE")
-
-    tenure_eth_car = self.lc4202.loc[self.lc4202.GEOGRAPHY_CODE == area].copy()
-    utils.unmap(tenure_eth_car.C_ETHHUK11, eth_map)
-    utils.unmap(tenure_eth_car.C_CARSNO, cars_map)
-    utils.unmap(tenure_eth_car.C_TENHUK11, tenure_map)
-
-    m4202 = utils.unlistify(tenure_eth_car,
-                            ["C_TENHUK11", "C_ETHHUK11", "C_CARSNO"],
-                            [len(tenure_map), len(eth_map), len(cars_map)],
-                            "OBS_VALUE")
-
-    econ = self.lc4605.loc[self.lc4605.GEOGRAPHY_CODE == area].copy()
-    utils.unmap(econ.C_NSSEC, econ_map)
-    utils.unmap(econ.C_TENHUK11, tenure_map)
-
-    # econ counts often slightly lower, need to tweak
-    ##econ = utils.adjust(econ, tenure_eth_car)
-
-    m4605 = utils.unlistify(econ,
-                            ["C_TENHUK11", "C_NSSEC"],
-                            [len(tenure_map), len(econ_map)],
-                            "OBS_VALUE")
-
-    m4605_sum = np.sum(m4605)
-    m4202_sum = np.sum(m4202)
-
-    if m4605_sum != m4202_sum:
-      print("LC4402: %d LC4605: %d -> %d " % (np.sum(m4402), m4605_sum, m4202_sum), end="")
-      tenure_4202 = np.sum(m4202, axis=(1, 2))
-      nssec_4605_adj = humanleague.prob2IntFreq(np.sum(m4605, axis=0) / m4605_sum, m4202_sum)["freq"]
-#      m4605_adj = humanleague.qisi(m4605.astype(float), [np.array([0]), np.array([1])], [tenure_4202, nssec_4605_adj])
-      # Convergence problems can occur when e.g. one of the tenure rows is zero yet the marginal total is nonzero,
-      # Can get round this by adding a small number to the seed
-      # effectively allowing zero states to be occupied with a finite probability
-#      if not m4605_adj["conv"]: 
-      m4605_adj = humanleague.qisi(m4605.astype(float) + 1.0/m4202_sum, [np.array([0]), np.array([1])], [tenure_4202, nssec_4605_adj])
-
-      utils.check_humanleague_result(m4605_adj, [tenure_4202, nssec_4605_adj])
-      m4605 = m4605_adj["result"]
-      #print("econ adj ok")
-
-
-    # print(np.sum(p0["result"], axis=(1,2,3,4)))
-    # print(np.sum(m4402, axis=(1,2)))
-    # print(np.sum(m4202, axis=(1,2)))
-    # print(np.sum(m4605, axis=1))
-
-    # no seed constraint so just use QIS
+      self.progress.message(text)
+
+  def __get_tensors(self, area_map):
+    """ Builds the household tables for all areas as tensors indexed by area then category (as ordered in maps) """
+    self.maps = {"tenure": self.lc4402.C_TENHUK11.unique(),
+                 "rooms": self.lc4404.C_ROOMS.unique(),
+                 "occupants": self.lc4404.C_SIZHUK11.unique(),
+                 "bedrooms": self.lc4405.C_BEDROOMS.unique(), # [1,2,3,4] or [-1]
+                 "hhtype": self.lc4408.C_AHTHUK11.unique(),
+                 "ch": self.lc4402.C_CENHEATHUK11.unique(),
+                 "buildtype": self.lc4402.C_TYPACCOM.unique(),
+                 "eth": self.lc4202.C_ETHHUK11.unique(),
+                 "cars": self.lc4202.C_CARSNO.unique(),
+                 "econ": self.lc4605.C_NSSEC.unique()}
+    self.m4404 = utils.area_tensor(self.lc4404, area_map, ["C_TENHUK11", "C_ROOMS", "C_SIZHUK11"],
+                                   [self.maps["tenure"], self.maps["rooms"], self.maps["occupants"]])
+    self.m4405 = utils.area_tensor(self.lc4405, area_map, ["C_TENHUK11", "C_BEDROOMS", "C_SIZHUK11"],
+                                   [self.maps["tenure"], self.maps["bedrooms"], self.maps["occupants"]])
+    self.m4408 = utils.area_tensor(self.lc4408, area_map, ["C_TENHUK11", "C_AHTHUK11"],
+                                   [self.maps["tenure"], self.maps["hhtype"]])
+    self.m4402 = utils.area_tensor(self.lc4402, area_map, ["C_TENHUK11", "C_CENHEATHUK11", "C_TYPACCOM"],
+                                   [self.maps["tenure"], self.maps["ch"], self.maps["buildtype"]])
+    self.m4202 = utils.area_tensor(self.lc4202, area_map, ["C_TENHUK11", "C_ETHHUK11", "C_CARSNO"],
+                                   [self.maps["tenure"], self.maps["eth"], self.maps["cars"]])
+    self.m4605 = utils.area_tensor(self.lc4605, area_map, ["C_TENHUK11", "C_NSSEC"],
+                                   [self.maps["tenure"], self.maps["econ"]])
+    # persons per bedroom is derived rather than synthesised, and only checked (see fit.py)
+    self.m4408ppb = None
+    if self.lc4408ppb is not None:
+      self.maps["ppbroom"] = self.lc4408ppb.C_PPBROOMHEW11.unique()
+      self.m4408ppb = utils.area_tensor(self.lc4408ppb, area_map, ["C_PPBROOMHEW11"], [self.maps["ppbroom"]])
+    # econ counts often slightly lower, need to tweak (within tenure)
     if self.scotland:
-      # tenures not mappable in LC4202
-      m4202 = np.sum(m4202, axis=0)
-      m4605 = np.sum(m4605, axis=0)
-      p1 = humanleague.qis([np.array([0, 1, 2, 3, 4]), np.array([0, 5, 6]), np.array([7, 8]), np.array([9])], [p0["result"], m4402, m4202, m4605])
-      #p1 = humanleague.qis([np.array([0, 1, 2, 3]), np.array([0, 4, 5]), np.array([0, 6, 7])], [p0["result"], m4402, m4202])
+      # LC4202 tenures are remapped to a subset of those of LC4605 so cannot be reconciled against, but LC4605 is only used
+      # summed over tenure (see planner.NO_TENURE_SC) so reconcile that to the area totals
+      self.m4605 = utils.reconcile_areas("LC4605", area_map, self.m4605.sum(axis=1, keepdims=True),
+                                         self.m4202.sum(axis=(1, 2, 3))[:, None])
     else:
-      p1 = humanleague.qis([np.array([0, 1, 2, 3, 4]), np.array([0, 5, 6]), np.array([0, 7, 8]), np.array([0, 9])], [p0["result"], m4402, m4202, m4605])
-      #p1 = humanleague.qis([np.array([0, 1, 2, 3]), np.array([0, 4, 5]), np.array([0, 6, 7])], [p0["result"], m4402, m4202])
-    utils.check_humanleague_result(p1, [p0["result"], m4402, m4202, m4605])
-    #print("p1 ok")
-
-    table = humanleague.flatten(p1["result"])
-
-    chunk = pd.DataFrame(columns=self.dwellings.columns.values)
-    chunk.Area = np.repeat(area, len(table[0]))
-    chunk.LC4402_C_TENHUK11 = utils.remap(table[0], tenure_map)
-    chunk.QS420_CELL = np.repeat(self.NOTAPPLICABLE, len(table[0]))
-    chunk.LC4404_C_ROOMS = utils.remap(table[1], rooms_map)
-    chunk.LC4404_C_SIZHUK11 = utils.remap(table[2], occupants_map)
-    chunk.LC4405EW_C_BEDROOMS = utils.remap(table[3], bedrooms_map)
-    chunk.LC4408_C_AHTHUK11 = utils.remap(table[4], hhtype_map)
-    chunk.LC4402_C_CENHEATHUK11 = utils.remap(table[5], ch_map)
-    chunk.LC4402_C_TYPACCOM = utils.remap(table[6], buildtype_map)
-    chunk.CommunalSize = np.repeat(self.NOTAPPLICABLE, len(table[0]))
-    chunk.LC4202_C_ETHHUK11 = utils.remap(table[7], eth_map)
-    chunk.LC4202_C_CARSNO = utils.remap(table[8], cars_map)
-    chunk.LC4605_C_NSSEC = utils.remap(table[9], econ_map)
-    #print(chunk.head())
-    self.dwellings = self.dwellings.append(chunk, ignore_index=True)
+      self.m4605 = utils.reconcile_areas("LC4605", area_map, self.m4605, self.m4202.sum(axis=(2, 3)))
+
+  def __add_households(self, i, area, constraints, structural):
+    """ Synthesises the households of the i'th area by running the planned stages (see planner.py) """
+    # the seed has been chosen upfront (see analyzer) so should converge, but drop the survey seed if there are still
+    # convergence problems
+    seeds = [constraints] if constraints is structural else [constraints, structural]
+    tensors = planner.area_tensors(self, i)
+    dims, table, counts = planner.execute(self.stages, tensors, self.solver, area, seeds,
+                                          lambda name: utils.area_rng(self.seed, area, name), self.aggregate, self.__message)
+    planner.validate(area, dims, table, counts, self.tables, tensors)
+
+    n = len(table[0])
+    chunk = pd.DataFrame(columns=self.columns)
+    chunk.Area = np.repeat(area, n)
+    for dim, values in zip(dims, table):
+      chunk[planner.COLUMNS[dim]] = utils.remap(values, self.maps[dim])
+    chunk.QS420_CELL = np.repeat(self.NOTAPPLICABLE, n)
+    chunk.CommunalSize = np.repeat(self.NOTAPPLICABLE, n)
+    # unknown where ambiguous, and for Scotland (no bedrooms)
+    chunk.LC4408EW_C_PPBROOMHEW11 = utils.people_per_bedroom_category(chunk.LC4404_C_SIZHUK11.values,
+                                                                      chunk.LC4405EW_C_BEDROOMS.values, self.UNKNOWN)
+    if self.aggregate:
+      if counts is None:
+        chunk = utils.aggregate(chunk)
+      else:
+        chunk.Count = counts
+    return chunk
 
   def __add_communal(self, area):
 
@@ -245,11 +420,11 @@ class Household:
 
     area_communal = self.communal.loc[(self.communal.GEOGRAPHY_CODE == area) & (self.communal.OBS_VALUE > 0)]
     if len(area_communal) == 0:
-      return
+      return 0
 
     num_communal = area_communal.OBS_VALUE.sum()
 
-    chunk = pd.DataFrame(columns=self.dwellings.columns.values)
+    chunk = pd.DataFrame(columns=self.columns)
     chunk.Area = np.repeat(area, num_communal)
     chunk.LC4402_C_TENHUK11 = np.repeat(self.NOTAPPLICABLE, num_communal)
     chunk.LC4404_C_ROOMS = np.repeat(self.UNKNOWN, num_communal)
@@ -260,36 +435,33 @@ class Household:
     chunk.LC4402_C_TYPACCOM = np.repeat(self.NOTAPPLICABLE, num_communal)
     chunk.LC4202_C_ETHHUK11 = np.repeat(self.UNKNOWN, num_communal)
     chunk.LC4202_C_CARSNO = np.repeat(1, num_communal) # no cars (blanket assumption)
-
-    index = 0
-    #print(area, len(area_communal))
-    for i in range(0, len(area_communal)):
-      # average occupants per establishment - integerised (special case when zero occupants)
-      establishments = area_communal.at[area_communal.index[i], "OBS_VALUE"]
-      occupants = area_communal.at[area_communal.index[i], "CommunalSize"]
-      if establishments == 1:
-        occ_array = [occupants]
-      else:
-        occ_array = humanleague.prob2IntFreq(np.full(establishments, 1.0 / establishments), occupants)["freq"]
-      for j in range(0, establishments):
-        chunk.QS420_CELL.at[index] = area_communal.at[area_communal.index[i], "CELL"]
-        chunk.CommunalSize.at[index] = occ_array[j]
-        chunk.LC4605_C_NSSEC.at[index] = utils.communal_economic_status(area_communal.at[area_communal.index[i], "CELL"])
-        index += 1
-
+    chunk.LC4408EW_C_PPBROOMHEW11 = np.repeat(self.NOTAPPLICABLE, num_communal)
+
+    # one row per establishment: build the columns as arrays (chained .at writes into the frame are lost under copy-on-write)
+    establishments = area_communal.OBS_VALUE.values
+    cells = area_communal.CELL.values
+    chunk.QS420_CELL = np.repeat(cells, establishments)
+    chunk.LC4605_C_NSSEC = np.repeat([utils.communal_economic_status(cell) for cell in cells], establishments)
+    # occupants per establishment, divided as evenly as possible (special case when zero occupants)
+    chunk.CommunalSize = np.concatenate([utils.even_split(occupants, n)
+                                         for occupants, n in zip(area_communal.CommunalSize.values, establishments)])
+
+    if self.aggregate:
+      chunk = utils.aggregate(chunk)
     #print(chunk.head())
-    self.dwellings = self.dwellings.append(chunk, ignore_index=True)
+    self.__append(chunk)
+    return num_communal
 
   # unoccupied, should be one entry per area
-  # sample from the occupied houses
-  def __add_unoccupied(self, area):
+  # sample from the occupied houses (i.e. the households generated for the area)
+  def __add_unoccupied(self, area, occ):
     unocc = self.ks401.loc[(self.ks401.GEOGRAPHY_CODE == area) & (self.ks401.CELL == 6)]
     if not len(unocc) == 1:
       raise("ks401 problem - multiple unoccupied entries in table")
     n_unocc = unocc.at[unocc.index[0], "OBS_VALUE"]
     #print(n_unocc)
 
-    chunk = pd.DataFrame(columns=self.dwellings.columns.values)
+    chunk = pd.DataFrame(columns=self.columns)
     chunk.Area = np.repeat(area, n_unocc)
     chunk.LC4402_C_TENHUK11 = np.repeat(self.UNKNOWN, n_unocc)
     chunk.LC4404_C_SIZHUK11 = np.repeat(0, n_unocc)
@@ -300,15 +472,19 @@ class Household:
     chunk.QS420_CELL = np.repeat(self.NOTAPPLICABLE, n_unocc)
     chunk.CommunalSize = np.repeat(self.NOTAPPLICABLE, n_unocc)
     chunk.LC4605_C_NSSEC = np.repeat(self.UNKNOWN, n_unocc)
+    chunk.LC4408EW_C_PPBROOMHEW11 = np.repeat(self.NOTAPPLICABLE, n_unocc) # no persons
 
-    occ = self.dwellings.loc[(self.dwellings.Area == area) & (self.dwellings.QS420_CELL == self.NOTAPPLICABLE)]
-
-    s = occ.sample(n_unocc, replace=True).reset_index()
+    # aggregated rows are sampled in proportion to the number of dwellings they represent
+    weights = occ.Count.astype(float) if self.aggregate else None
+    s = occ.sample(n_unocc, replace=True, weights=weights,
+                   random_state=utils.area_rng(self.seed, area, "unoccupied")).reset_index()
     chunk.LC4404_C_ROOMS = s.LC4404_C_ROOMS
     chunk.LC4405EW_C_BEDROOMS = s.LC4405EW_C_BEDROOMS
     chunk.LC4402_C_CENHEATHUK11 = s.LC4402_C_CENHEATHUK11
 
-    self.dwellings = self.dwellings.append(chunk, ignore_index=True)
+    if self.aggregate:
+      chunk = utils.aggregate(chunk)
+    self.__append(chunk)
 
   def __get_census_data(self):
     if self.region[0] == "E" or self.region[0] == "W":
@@ -329,41 +505,34 @@ class Household:
     # ensure counts are consistent across tables
     checksum = self.lc4402.OBS_VALUE.sum()
 
+    # fetch (parse) the remaining tables concurrently (see fetch.py). This is done after LC4402 has been loaded, which
+    # downloads the data for the whole resolution, so that the requests don't all download it at once
+    cats = [2,6,11,14,22,23,24,25,26,27,28,29,30,31,32,33]
+    requests = {
+      "KS101SC": functools.partial(self.api_sc.get_data, "KS101SC", self.region, self.resolution,
+                                   category_filters={"KS101SC_0_CODE": [3,4]}),
+      "KS401SC": functools.partial(self.api_sc.get_data, "KS401SC", self.region, self.resolution,
+                                   category_filters={"KS401SC_0_CODE": [5,6,7]}),
+      "LC4202SC": functools.partial(self.api_sc.get_data, "LC4202SC", self.region, self.resolution,
+                                    category_filters={"LC4202SC_1_CODE": [1,2,3], "LC4202SC_2_CODE": [1,2,3],
+                                                      "LC4202SC_0_CODE": [1,2,3,4,5,6]}),
+      "LC4605SC": functools.partial(self.api_sc.get_data, "LC4605SC", self.region, self.resolution,
+                                    category_filters={"LC4605SC_1_CODE": [2,3,5,6], "LC4605SC_0_CODE": range(1,10)}),
+      "QS420SC": functools.partial(self.api_sc.get_data, "QS420SC", self.region, self.resolution,
+                                   category_filters={"QS420SC_0_CODE": cats}),
+      "QS421SC": functools.partial(self.api_sc.get_data, "QS421SC", self.region, self.resolution,
+                                   category_filters={"QS421SC_0_CODE": cats})
+    }
+    tables = fetch.fetch_all(requests)
+
     # construct a tenure marginal for synthesis of other tables unavailable in Scottish dataset
     ngeogs = len(self.lc4402.GEOGRAPHY_CODE.unique())
     ntenures = len(self.lc4402.C_TENHUK11.unique())
     tenure_table = self.lc4402.groupby(["GEOGRAPHY_CODE", "C_TENHUK11"]).sum().reset_index().drop(["C_TYPACCOM", "C_CENHEATHUK11"], axis=1)
     m4402 = utils.unlistify(tenure_table, ["GEOGRAPHY_CODE", "C_TENHUK11"], [ngeogs, ntenures], "OBS_VALUE")
 
-    # synthesise LC4404 from QS407 and QS406
-    # LC4404SC room categories are: 1, 2-3, 4-5, 6+ so not very useful, using univariate tables instead
-    #print(self.api_sc.get_metadata("QS407SC", self.resolution))
-    qs407 = self.api_sc.get_data("QS407SC", self.region, self.resolution, category_filters={"QS407SC_0_CODE": range(1,10)})
-    qs407.rename({"QS407SC_0_CODE": "C_ROOMS"}, axis=1, inplace=True)
-    qs407 = utils.cap_value(qs407, "C_ROOMS", 6, "OBS_VALUE")
-    #print(qs407.head())
-    assert qs407.OBS_VALUE.sum() == checksum
-
-    #print(self.api_sc.get_metadata("QS406SC", self.resolution))
-    qs406 = self.api_sc.get_data("QS406SC", self.region, self.resolution, category_filters={"QS406SC_0_CODE": range(1,9)})
-    qs406.rename({"QS406SC_0_CODE": "C_SIZHUK11"}, axis=1, inplace=True)
-    qs406 = utils.cap_value(qs406, "C_SIZHUK11", 4, "OBS_VALUE")
-    #print(qs406.head())
-    assert qs406.OBS_VALUE.sum() == checksum
-
-    nrooms = len(qs407.C_ROOMS.unique())
-    nsizes = len(qs406.C_SIZHUK11.unique())
-
-    m407 = utils.unlistify(qs407, ["GEOGRAPHY_CODE", "C_ROOMS"], [ngeogs, nrooms], "OBS_VALUE")
-    m406 = utils.unlistify(qs406, ["GEOGRAPHY_CODE", "C_SIZHUK11"], [ngeogs, nsizes], "OBS_VALUE")
-
-    a4404 = humanleague.qis([np.array([0,1]), np.array([0,2]), np.array([0,3])], [m4402, m407, m406])
-    utils.check_humanleague_result(a4404, [m4402, m407, m406])
-    self.lc4404 = utils.listify(a4404["result"], "OBS_VALUE", ["GEOGRAPHY_CODE", "C_TENHUK11", "C_ROOMS", "C_SIZHUK11"])
-    self.lc4404.GEOGRAPHY_CODE = utils.remap(self.lc4404.GEOGRAPHY_CODE, qs406.GEOGRAPHY_CODE.unique())
-    self.lc4404.C_TENHUK11 = utils.remap(self.lc4404.C_TENHUK11, tenure_table.C_TENHUK11.unique())
-    self.lc4404.C_ROOMS = utils.remap(self.lc4404.C_ROOMS, qs407.C_ROOMS.unique())
-    self.lc4404.C_SIZHUK11 = utils.remap(self.lc4404.C_SIZHUK11, qs406.C_SIZHUK11.unique())
+    # synthesise LC4404 and LC4408 equivalents (or load them if already derived for this region and resolution)
+    self.__get_derived_data_sc(m4402, tenure_table, checksum)
 
     #print(self.lc4404.head())
 
@@ -391,52 +560,12 @@ class Household:
     #print(self.lc4405)
     assert self.lc4405.OBS_VALUE.sum() == checksum
 
-    # synthesise LC4408
-
-    #print(self.api_sc.get_metadata("QS116SC", self.resolution))
-    # 1'One person household', 
-    # 2'Married couple household: No dependent children', 
-    # 3'Married couple household: With dependent children', 
-    # 4'Same-sex civil partnership couple household', 
-    # 5'Cohabiting couple household: No dependent children', 
-    # 6'Cohabiting couple household: With dependent children', 
-    # 7'Lone parent household: No dependent children', 
-    # 8'Lone parent household: With dependent children', 
-    # 9'Multi-person household: All full-time students', 
-    # 10'Multi-person household: Other']}}
-    qs116 = self.api_sc.get_data("QS116SC", self.region, self.resolution, category_filters={"QS116SC_0_CODE": range(1,11)})
-    qs116.rename({"QS116SC_0_CODE": "C_AHTHUK11"}, axis=1, inplace=True)
-    # map to lower-resolution household types
-    # 1 -> 1 (single)
-    # (2,3,4) -> 2 (married/civil couple)
-    # (5,6) -> 3 (cohabiting couple)
-    # (7,8) -> 4 (single parent)
-    # (9,10) -> 5 (mixed)
-    qs116.loc[(qs116.C_AHTHUK11 == 2) | (qs116.C_AHTHUK11 == 3) | (qs116.C_AHTHUK11 == 4), "C_AHTHUK11"] = 2  
-    qs116.loc[(qs116.C_AHTHUK11 == 5) | (qs116.C_AHTHUK11 == 6), "C_AHTHUK11"] = 3 
-    qs116.loc[(qs116.C_AHTHUK11 == 7) | (qs116.C_AHTHUK11 == 8), "C_AHTHUK11"] = 4 
-    qs116.loc[(qs116.C_AHTHUK11 == 9) | (qs116.C_AHTHUK11 == 10), "C_AHTHUK11"] = 5
-    # ...and consolidate
-    qs116 = qs116.groupby(["GEOGRAPHY_CODE", "C_AHTHUK11"]).sum().reset_index()
-
-    assert qs116.OBS_VALUE.sum() == checksum
-
-    nhhtypes = len(qs116.C_AHTHUK11.unique())
-    m116 = utils.unlistify(qs116, ["GEOGRAPHY_CODE", "C_AHTHUK11"], [ngeogs, nhhtypes], "OBS_VALUE")
-
-    a4408 = humanleague.qis([np.array([0,1]), np.array([0,2])], [m4402, m116])
-    utils.check_humanleague_result(a4408, [m4402, m116])
-
-    self.lc4408 = utils.listify(a4408["result"], "OBS_VALUE", ["GEOGRAPHY_CODE", "C_TENHUK11", "C_AHTHUK11"])
-    self.lc4408.GEOGRAPHY_CODE = utils.remap(self.lc4408.GEOGRAPHY_CODE, qs116.GEOGRAPHY_CODE.unique())
-    self.lc4408.C_TENHUK11 = utils.remap(self.lc4408.C_TENHUK11, self.lc4402.C_TENHUK11.unique())
-    self.lc4408.C_AHTHUK11 = utils.remap(self.lc4408.C_AHTHUK11, qs116.C_AHTHUK11.unique())
     #print(self.lc4408.head())
     assert self.lc4408.OBS_VALUE.sum() == checksum
 
     # LC1105
     #print(self.api_sc.get_metadata("KS101SC", self.resolution))
-    self.lc1105 = self.api_sc.get_data("KS101SC", self.region, self.resolution, category_filters={"KS101SC_0_CODE": [3,4]})
+    self.lc1105 = tables["KS101SC"]
     self.lc1105.rename({"KS101SC_0_CODE": "C_RESIDENCE_TYPE"}, axis=1, inplace=True)
     # 3->1, 4->2
     self.lc1105["C_RESIDENCE_TYPE"] = self.lc1105["C_RESIDENCE_TYPE"] - 2
@@ -447,7 +576,7 @@ class Household:
     # 5'All household spaces: Occupied', 
     # 6'All household spaces: Unoccupied: Second residence/holiday accommodation', 
     # 7'All household spaces: Unoccupied: Vacant', 
-    self.ks401 = self.api_sc.get_data("KS401SC", self.region, self.resolution, category_filters={"KS401SC_0_CODE": [5,6,7]})
+    self.ks401 = tables["KS401SC"]
     self.ks401.rename({"KS401SC_0_CODE": "CELL"}, axis=1, inplace=True)
     self.ks401 = utils.cap_value(self.ks401, "CELL", 6, "OBS_VALUE")
     assert self.ks401[self.ks401.CELL == 5].OBS_VALUE.sum() == checksum
@@ -471,7 +600,7 @@ class Household:
     # 'African', 
     # 'Caribbean or Black', 
     # 'Other ethnic groups']}}
-    self.lc4202 = self.api_sc.get_data("LC4202SC", self.region, self.resolution, category_filters={"LC4202SC_1_CODE": [1,2,3], "LC4202SC_2_CODE": [1,2,3], "LC4202SC_0_CODE": [1,2,3,4,5,6]})
+    self.lc4202 = tables["LC4202SC"]
     self.lc4202.rename({"LC4202SC_2_CODE": "C_CARSNO", "LC4202SC_1_CODE": "C_TENHUK11", "LC4202SC_0_CODE": "C_ETHHUK11"}, axis=1, inplace=True)
     # TODO how to map tenure 1->2/3?
     self.lc4202.loc[self.lc4202.C_TENHUK11 == 3, "C_TENHUK11"] = 6
@@ -499,43 +628,133 @@ class Household:
     # '7. Routine occupations', 
     # '8. Never worked and long-term unemployed', 
     # 'L15 Full-time students']}}
-    self.lc4605 = self.api_sc.get_data("LC4605SC", self.region, self.resolution, category_filters={"LC4605SC_1_CODE": [2,3,5,6], "LC4605SC_0_CODE": range(1,10)})
+    self.lc4605 = tables["LC4605SC"]
     self.lc4605.rename({"LC4605SC_1_CODE": "C_TENHUK11", "LC4605SC_0_CODE": "C_NSSEC"}, axis=1, inplace=True)
     # TODO add retired?
     print(self.lc4605.OBS_VALUE.sum(), checksum, "TODO add retired")
 
     #print(self.api_sc.get_metadata("QS420SC", self.resolution))
-    cats = [2,6,11,14,22,23,24,25,26,27,28,29,30,31,32,33]
 
     # merge the two communal tables (so we have establishment and people counts)
-    self.communal = self.api_sc.get_data("QS420SC", self.region, self.resolution, category_filters={"QS420SC_0_CODE": cats}).rename({"QS420SC_0_CODE": "CELL"}, axis=1)
-    qs421 = self.api_sc.get_data("QS421SC", self.region, self.resolution, category_filters={"QS421SC_0_CODE": cats}).rename({"OBS_VALUE": "CommunalSize"}, axis=1)
+    self.communal = tables["QS420SC"].rename({"QS420SC_0_CODE": "CELL"}, axis=1)
+    qs421 = tables["QS421SC"].rename({"OBS_VALUE": "CommunalSize"}, axis=1)
     #print(qs421.head())
     self.communal = self.communal.merge(qs421, left_on=["GEOGRAPHY_CODE", "CELL"], right_on=["GEOGRAPHY_CODE", "QS421SC_0_CODE"]).drop("QS421SC_0_CODE", axis=1)
     #print(self.communal.CommunalSize.sum())
 
+  def __get_derived_data_sc(self, m4402, tenure_table, checksum):
+    """
+    Synthesises LC4404 and LC4408 equivalents from univariate Scottish tables, constrained by the LC4402 tenure marginal.
+    Each geography is solved independently (in parallel if workers > 1) and the results are cached by region, resolution,
+    seed and solver settings
+    """
+    files = _derived_files_sc(self.cache_dir, self.region, self.resolution, self.seed, self.solver)
+    cached = _load_derived_sc(files)
+    if cached is not None:
+      self.lc4404, self.lc4408 = cached
+      return
+
+    ngeogs = m4402.shape[0]
+
+    # synthesise LC4404 from QS407 and QS406
+    # LC4404SC room categories are: 1, 2-3, 4-5, 6+ so not very useful, using univariate tables instead
+    #print(self.api_sc.get_metadata("QS407SC", self.resolution))
+    qs407 = self.api_sc.get_data("QS407SC", self.region, self.resolution, category_filters={"QS407SC_0_CODE": range(1,10)})
+    qs407.rename({"QS407SC_0_CODE": "C_ROOMS"}, axis=1, inplace=True)
+    qs407 = utils.cap_value(qs407, "C_ROOMS", 6, "OBS_VALUE")
+    #print(qs407.head())
+    assert qs407.OBS_VALUE.sum() == checksum
+
+    #print(self.api_sc.get_metadata("QS406SC", self.resolution))
+    qs406 = self.api_sc.get_data("QS406SC", self.region, self.resolution, category_filters={"QS406SC_0_CODE": range(1,9)})
+    qs406.rename({"QS406SC_0_CODE": "C_SIZHUK11"}, axis=1, inplace=True)
+    qs406 = utils.cap_value(qs406, "C_SIZHUK11", 4, "OBS_VALUE")
+    #print(qs406.head())
+    assert qs406.OBS_VALUE.sum() == checksum
+
+    nrooms = len(qs407.C_ROOMS.unique())
+    nsizes = len(qs406.C_SIZHUK11.unique())
+
+    m407 = utils.unlistify(qs407, ["GEOGRAPHY_CODE", "C_ROOMS"], [ngeogs, nrooms], "OBS_VALUE")
+    m406 = utils.unlistify(qs406, ["GEOGRAPHY_CODE", "C_SIZHUK11"], [ngeogs, nsizes], "OBS_VALUE")
+
+    # synthesise LC4408
+    #print(self.api_sc.get_metadata("QS116SC", self.resolution))
+    # 1'One person household', 
+    # 2'Married couple household: No dependent children', 
+    # 3'Married couple household: With dependent children', 
+    # 4'Same-sex civil partnership couple household', 
+    # 5'Cohabiting couple household: No dependent children', 
+    # 6'Cohabiting couple household: With dependent children', 
+    # 7'Lone parent household: No dependent children', 
+    # 8'Lone parent household: With dependent children', 
+    # 9'Multi-person household: All full-time students', 
+    # 10'Multi-person household: Other']}}
+    qs116 = self.api_sc.get_data("QS116SC", self.region, self.resolution, category_filters={"QS116SC_0_CODE": range(1,11)})
+    qs116.rename({"QS116SC_0_CODE": "C_AHTHUK11"}, axis=1, inplace=True)
+    # map to lower-resolution household types
+    # 1 -> 1 (single)
+    # (2,3,4) -> 2 (married/civil couple)
+    # (5,6) -> 3 (cohabiting couple)
+    # (7,8) -> 4 (single parent)
+    # (9,10) -> 5 (mixed)
+    qs116.loc[(qs116.C_AHTHUK11 == 2) | (qs116.C_AHTHUK11 == 3) | (qs116.C_AHTHUK11 == 4), "C_AHTHUK11"] = 2  
+    qs116.loc[(qs116.C_AHTHUK11 == 5) | (qs116.C_AHTHUK11 == 6), "C_AHTHUK11"] = 3 
+    qs116.loc[(qs116.C_AHTHUK11 == 7) | (qs116.C_AHTHUK11 == 8), "C_AHTHUK11"] = 4 
+    qs116.loc[(qs116.C_AHTHUK11 == 9) | (qs116.C_AHTHUK11 == 10), "C_AHTHUK11"] = 5
+    # ...and consolidate
+    qs116 = qs116.groupby(["GEOGRAPHY_CODE", "C_AHTHUK11"]).sum().reset_index()
+
+    assert qs116.OBS_VALUE.sum() == checksum
+
+    nhhtypes = len(qs116.C_AHTHUK11.unique())
+    m116 = utils.unlistify(qs116, ["GEOGRAPHY_CODE", "C_AHTHUK11"], [ngeogs, nhhtypes], "OBS_VALUE")
+
+    # geographies are independent so solve separately rather than as one (very large) tensor
+    # (rows of the tensors are in sorted geography code order)
+    geogs = np.sort(tenure_table.GEOGRAPHY_CODE.unique())
+    seeds = np.repeat(self.seed, ngeogs)
+    settings = [self.solver.settings] * ngeogs
+    if self.workers > 1:
+      with ProcessPoolExecutor(max_workers=self.workers) as executor:
+        results = list(executor.map(_derive_area_sc, m4402, m407, m406, m116, geogs, seeds, settings,
+                                    chunksize=max(1, ngeogs // (4 * self.workers))))
+    else:
+      results = list(map(_derive_area_sc, m4402, m407, m406, m116, geogs, seeds, settings))
+    a4404 = np.stack([r[0] for r in results])
+    a4408 = np.stack([r[1] for r in results])
+    for r in results:
+      self.solver.report.extend(r[2])
+
+    self.lc4404 = utils.listify(a4404, "OBS_VALUE", ["GEOGRAPHY_CODE", "C_TENHUK11", "C_ROOMS", "C_SIZHUK11"])
+    self.lc4404.GEOGRAPHY_CODE = utils.remap(self.lc4404.GEOGRAPHY_CODE, qs406.GEOGRAPHY_CODE.unique())
+    self.lc4404.C_TENHUK11 = utils.remap(self.lc4404.C_TENHUK11, tenure_table.C_TENHUK11.unique())
+    self.lc4404.C_ROOMS = utils.remap(self.lc4404.C_ROOMS, qs407.C_ROOMS.unique())
+    self.lc4404.C_SIZHUK11 = utils.remap(self.lc4404.C_SIZHUK11, qs406.C_SIZHUK11.unique())
+
+    self.lc4408 = utils.listify(a4408, "OBS_VALUE", ["GEOGRAPHY_CODE", "C_TENHUK11", "C_AHTHUK11"])
+    self.lc4408.GEOGRAPHY_CODE = utils.remap(self.lc4408.GEOGRAPHY_CODE, qs116.GEOGRAPHY_CODE.unique())
+    self.lc4408.C_TENHUK11 = utils.remap(self.lc4408.C_TENHUK11, self.lc4402.C_TENHUK11.unique())
+    self.lc4408.C_AHTHUK11 = utils.remap(self.lc4408.C_AHTHUK11, qs116.C_AHTHUK11.unique())
+
+    _save_derived_sc(files, (self.lc4404, self.lc4408))
+
   def __get_census_data_ew(self):
     """ 
     Retrieves census tables for the specified geography
     checks for locally cached data or calls nomisweb API
     """
 
-    # convert input string to enum
-    resolution = self.api_ew.GeoCodeLookup[self.resolution]
-
-    if self.region in self.api_ew.GeoCodeLookup.keys():
-      region_codes = self.api_ew.GeoCodeLookup[self.region]
-    else:
-      region_codes = self.api_ew.get_lad_codes(self.region)
-      if not region_codes:
-        raise ValueError("no regions match the input: \"" + self.region + "\"")
-
-    area_codes = self.api_ew.get_geo_codes(region_codes, resolution)
+    if self.area_codes is None:
+      self.area_codes = utils.get_area_codes(self.api_ew, self.region, self.resolution)
+    area_codes = self.area_codes
 
     # assignment does shallow copy, need to use .copy() to avoid this getting query_params fields
     common_params = {"MEASURES": "20100",
                      "date": "latest",
                      "geography": area_codes}
+    # the tables are fetched concurrently (see fetch.py) once all the queries are defined
+    requests = {}
 
     # LC4402EW - Accommodation type by type of central heating in household by tenure
     query_params = common_params.copy()
@@ -543,7 +762,7 @@ class Household:
     query_params["C_CENHEATHUK11"] = "1,2"
     query_params["C_TYPACCOM"] = "2...5"
     query_params["select"] = "GEOGRAPHY_CODE,C_TENHUK11,C_CENHEATHUK11,C_TYPACCOM,OBS_VALUE"
-    self.lc4402 = self.api_ew.get_data("LC4402EW", query_params)
+    requests["LC4402EW"] = functools.partial(self.api_ew.get_data, "LC4402EW", query_params)
 
     # LC4404EW - Tenure by household size by number of rooms
     query_params = common_params.copy()
@@ -551,7 +770,7 @@ class Household:
     query_params["C_TENHUK11"] = "2,3,5,6"
     query_params["C_SIZHUK11"] = "1...4"
     query_params["select"] = "GEOGRAPHY_CODE,C_ROOMS,C_TENHUK11,C_SIZHUK11,OBS_VALUE"
-    self.lc4404 = self.api_ew.get_data("LC4404EW", query_params)
+    requests["LC4404EW"] = functools.partial(self.api_ew.get_data, "LC4404EW", query_params)
 
     # LC4405EW - Tenure by household size by number of bedrooms
     query_params = common_params.copy()
@@ -559,7 +778,7 @@ class Household:
     query_params["C_BEDROOMS"] = "1...4"
     query_params["C_SIZHUK11"] = "1...4"
     query_params["select"] = "GEOGRAPHY_CODE,C_SIZHUK11,C_TENHUK11,C_BEDROOMS,OBS_VALUE"
-    self.lc4405 = self.api_ew.get_data("LC4405EW", query_params)
+    requests["LC4405EW"] = functools.partial(self.api_ew.get_data, "LC4405EW", query_params)
 
     # LC4408EW - Tenure by number of persons per bedroom in household by household type
     query_params = common_params.copy()
@@ -568,7 +787,15 @@ class Household:
     query_params["C_AHTHUK11"] = "1...5"
     query_params["C_TENHUK11"] = "2,3,5,6"
     query_params["select"] = "GEOGRAPHY_CODE,C_AHTHUK11,C_TENHUK11,OBS_VALUE"
-    self.lc4408 = self.api_ew.get_data("LC4408EW", query_params)
+    requests["LC4408EW"] = functools.partial(self.api_ew.get_data, "LC4408EW", query_params)
+
+    # LC4408EW - persons per bedroom marginal, to check the derived column against
+    query_params = common_params.copy()
+    query_params["C_PPBROOMHEW11"] = "1...4"
+    query_params["C_AHTHUK11"] = "0"
+    query_params["C_TENHUK11"] = "0"
+    query_params["select"] = "GEOGRAPHY_CODE,C_PPBROOMHEW11,OBS_VALUE"
+    requests["LC4408EW_PPBROOM"] = functools.partial(self.api_ew.get_data, "LC4408EW", query_params)
 
     # LC1105EW - Residence type by sex by age
     query_params = common_params.copy()
@@ -576,7 +803,7 @@ class Household:
     query_params["C_AGE"] = "0"
     query_params["C_RESIDENCE_TYPE"] = "1,2"
     query_params["select"] = "GEOGRAPHY_CODE,C_RESIDENCE_TYPE,OBS_VALUE"
-    self.lc1105 = self.api_ew.get_data("LC1105EW", query_params)
+    requests["LC1105EW"] = functools.partial(self.api_ew.get_data, "LC1105EW", query_params)
 
     # KS401EW - Dwellings, household spaces and accommodation type
     # Household spaces with at least one usual resident / Household spaces with no usual residents
@@ -584,10 +811,10 @@ class Household:
     query_params["RURAL_URBAN"] = "0"
     query_params["CELL"] = "5,6"
     query_params["select"] = "GEOGRAPHY_CODE,CELL,OBS_VALUE"
-    self.ks401 = self.api_ew.get_data("KS401EW", query_params)
+    requests["KS401EW"] = functools.partial(self.api_ew.get_data, "KS401EW", query_params)
 
     # NOTE: common_params is passed by ref so take a copy
-    self.communal = self.__get_communal_data_ew(common_params.copy())
+    self.__get_communal_data_ew(requests, common_params.copy())
 
     # LC4202EW - Tenure by car or van availability by ethnic group of Household Reference Person (HRP)
     query_params = common_params.copy()
@@ -595,26 +822,34 @@ class Household:
     query_params["C_TENHUK11"] = "2,3,5,6"
     query_params["C_ETHHUK11"] = "2...8"
     query_params["select"] = "GEOGRAPHY_CODE,C_ETHHUK11,C_CARSNO,C_TENHUK11,OBS_VALUE"
-    self.lc4202 = self.api_ew.get_data("LC4202EW", query_params)
+    requests["LC4202EW"] = functools.partial(self.api_ew.get_data, "LC4202EW", query_params)
 
     # LC4605EW - Tenure by NS-SeC - Household Reference Persons
     query_params = common_params.copy()
     query_params["C_TENHUK11"] = "2,3,5,6"
     query_params["C_NSSEC"] = "1...9"
     query_params["select"] = "GEOGRAPHY_CODE,C_TENHUK11,C_NSSEC,OBS_VALUE"
-    self.lc4605 = self.api_ew.get_data("LC4605EW", query_params)
-
-  def __get_communal_data_ew(self, query_params):
-
+    requests["LC4605EW"] = functools.partial(self.api_ew.get_data, "LC4605EW", query_params)
+
+    tables = fetch.fetch_all(requests)
+    self.lc4402 = tables["LC4402EW"]
+    self.lc4404 = tables["LC4404EW"]
+    self.lc4405 = tables["LC4405EW"]
+    self.lc4408 = tables["LC4408EW"]
+    self.lc4408ppb = tables["LC4408EW_PPBROOM"]
+    self.lc1105 = tables["LC1105EW"]
+    self.ks401 = tables["KS401EW"]
+    self.lc4202 = tables["LC4202EW"]
+    self.lc4605 = tables["LC4605EW"]
+    # merge the two communal tables (so we have establishment and people counts)
     # TODO merge the tables rather than relying on the order being the same in both
+    self.communal = tables["QS420EW"]
+    self.communal["CommunalSize"] = tables["QS421EW"].OBS_VALUE
 
+  def __get_communal_data_ew(self, requests, query_params):
+    """ Adds the queries for the communal tables: QS420 (establishments) and QS421 (people) """
     query_params["RURAL_URBAN"] = 0
     query_params["CELL"] = "2,6,11,14,22...34"
     query_params["select"] = "GEOGRAPHY_CODE,CELL,OBS_VALUE"
-    # communal is qs420 plus qs421
-    communal = self.api_ew.get_data("QS420EW", query_params) # establishments
-    qs421 = self.api_ew.get_data("QS421EW", query_params) # people
-
-    # merge the two tables (so we have establishment and people counts)
-    communal["CommunalSize"] = qs421.OBS_VALUE
-    return communal
+    requests["QS420EW"] = functools.partial(self.api_ew.get_data, "QS420EW", query_params)
+    requests["QS421EW"] = functools.partial(self.api_ew.get_data, "QS421EW", query_params)
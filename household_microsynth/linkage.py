@@ -0,0 +1,85 @@
+""" Linkage of household reference persons to synthesised dwellings """
+
+import numpy as np
+import pandas as pd
+
+from household_microsynth.household import Household
+import household_microsynth.utils as utils
+
+# Bucket keys as (dwelling column, HRP column) pairs, from the strictest to the most relaxed.
+# HRPs left unmatched at one level are matched with the remaining households at the next
+LINK_KEYS = [[("Area", "Area"), ("LC4402_C_TENHUK11", "LC4605_C_TENHUK11"), ("LC4605_C_NSSEC", "LC4605_C_NSSEC")],
+             [("Area", "Area"), ("LC4402_C_TENHUK11", "LC4605_C_TENHUK11")],
+             [("Area", "Area")]]
+
+def _shuffled_rank(buckets, shuffle):
+  """ Returns the position of each element within its bucket, after shuffling the elements by the random keys in shuffle """
+  order = np.lexsort((shuffle, buckets))
+  rank = np.empty(len(buckets), dtype=np.int64)
+  rank[order] = pd.Series(buckets[order]).groupby(buckets[order]).cumcount().values
+  return rank
+
+def match(hh_keys, hrp_keys, seed=0, stage="link"):
+  """
+  Randomly pairs rows of hh_keys with rows of hrp_keys that have identical keys (both DataFrames with the same columns,
+  the first of which is the area). Each bucket of identical keys is shuffled on both sides (using the area's streams)
+  and zipped, so min(#households, #hrps) pairs are made per bucket.
+  Returns arrays of the matched positions in hh_keys and hrp_keys
+  """
+  if not len(hh_keys) or not len(hrp_keys):
+    return np.array([], dtype=int), np.array([], dtype=int)
+  # assign common bucket ids to both sides
+  buckets = pd.concat([hh_keys, hrp_keys], ignore_index=True).groupby(list(hh_keys.columns), sort=False).ngroup().values
+  hh_buckets = buckets[:len(hh_keys)]
+  hrp_buckets = buckets[len(hh_keys):]
+
+  # zip on (bucket, rank within bucket)
+  stride = max(len(hh_keys), len(hrp_keys))
+  hh_shuffle = utils.area_random(seed, stage + ":hh", hh_keys.iloc[:, 0].values)
+  hrp_shuffle = utils.area_random(seed, stage + ":hrp", hrp_keys.iloc[:, 0].values)
+  hh_slots = pd.Index(hh_buckets * stride + _shuffled_rank(hh_buckets, hh_shuffle))
+  hrp_slots = hrp_buckets * stride + _shuffled_rank(hrp_buckets, hrp_shuffle)
+  hh_pos = hh_slots.get_indexer(hrp_slots)
+  matched = hh_pos >= 0
+  return hh_pos[matched], np.flatnonzero(matched)
+
+def link(dwellings, hrps, seed=0):
+  """
+  Assigns each HRP to a compatible occupied dwelling in the same area, matching on tenure and NSSEC where possible and
+  relaxing the keys (see LINK_KEYS) for the remainder. Returns a copy of dwellings with the HRP attributes appended, along
+  with HRPID (the row number of the HRP) and LinkLevel (the index of the keys in LINK_KEYS used to make the match).
+  Non-household dwellings get NOTAPPLICABLE and unmatched households UNKNOWN in the additional columns
+  """
+  occupied = np.flatnonzero(((dwellings.QS420_CELL == Household.NOTAPPLICABLE) & (dwellings.LC4404_C_SIZHUK11 != 0)).values)
+  hh_link = np.full(len(occupied), -1, dtype=np.int64)
+  hrp_linked = np.zeros(len(hrps), dtype=bool)
+  level = np.full(len(occupied), Household.UNKNOWN, dtype=np.int64)
+
+  for i, keys in enumerate(LINK_KEYS):
+    hh_free = np.flatnonzero(hh_link < 0)
+    hrp_free = np.flatnonzero(~hrp_linked)
+    hh_keys = pd.DataFrame({str(j): dwellings[k[0]].values[occupied[hh_free]] for j, k in enumerate(keys)})
+    hrp_keys = pd.DataFrame({str(j): hrps[k[1]].values[hrp_free] for j, k in enumerate(keys)})
+    hh_pos, hrp_pos = match(hh_keys, hrp_keys, seed, "link" + str(i))
+    hh_link[hh_free[hh_pos]] = hrp_free[hrp_pos]
+    hrp_linked[hrp_free[hrp_pos]] = True
+    level[hh_free[hh_pos]] = i
+    print("Link level %d: %d households" % (i, len(hh_pos)))
+
+  print("Unlinked households: %d, unlinked HRPs: %d" % ((hh_link < 0).sum(), (~hrp_linked).sum()))
+
+  linked = dwellings.copy()
+  hrp_cols = [c for c in hrps.columns.values if c not in dwellings.columns.values]
+  found = hh_link >= 0
+  for col in hrp_cols + ["HRPID", "LinkLevel"]:
+    if col == "HRPID":
+      values = hh_link[found]
+    elif col == "LinkLevel":
+      values = level[found]
+    else:
+      values = hrps[col].values[hh_link[found]]
+    column = np.full(len(dwellings), Household.NOTAPPLICABLE, dtype=object)
+    column[occupied] = Household.UNKNOWN
+    column[occupied[found]] = values
+    linked[col] = column
+  return linked
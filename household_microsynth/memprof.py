@@ -0,0 +1,91 @@
+""" Opt-in memory profiling of the stages of a microsynthesis and of its largest areas """
+
+import os
+import json
+import heapq
+import resource
+import tracemalloc
+
+def peak_rss():
+  """ Peak resident set size of the process so far, in bytes """
+  peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # kB on linux, bytes on mac
+  return peak if os.uname().sysname == "Darwin" else peak * 1024
+
+def _rss():
+  """ Current resident set size in bytes, where available """
+  try:
+    with open("/proc/self/statm") as statm:
+      return int(statm.read().split()[1]) * resource.getpagesize()
+  except (IOError, OSError):
+    return None
+
+class MemoryProfile:
+  """
+  Records the peak RSS, current RSS and traced (python) memory, and the top allocators (by source line) at each stage
+  boundary, plus the areas with the largest traced memory peaks. Starts tracemalloc if it isn't already running.
+  An instance can be passed as a progress renderer (see progress.py) to see the start and end of each area
+  """
+
+  def __init__(self, top=10, areas=5):
+    self.top = top
+    self.areas = areas
+    self.stages = []
+    # (peak over the memory in use at the start of the area, order, record) for the largest areas
+    self.area_peaks = []
+    # largest area peak since the last stage, since area peaks are reset
+    self.stage_peak = 0
+    # traced memory at the start of the current area
+    self.area_base = 0
+    if not tracemalloc.is_tracing():
+      tracemalloc.start()
+
+  def __allocators(self):
+    snapshot = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__),))
+    return [{"location": str(stat.traceback[0]), "size": stat.size, "count": stat.count}
+            for stat in snapshot.statistics("lineno")[:self.top]]
+
+  def __reset_peak(self):
+    # not available before python 3.9, in which case peaks are since the last reset (or start)
+    if hasattr(tracemalloc, "reset_peak"):
+      tracemalloc.reset_peak()
+
+  def stage(self, name):
+    """ Records the memory use at the end of a stage, and the peak during it """
+    current, peak = tracemalloc.get_traced_memory()
+    peak = max(peak, self.stage_peak)
+    self.stage_peak = 0
+    self.stages.append({"stage": name, "peak_rss": peak_rss(), "rss": _rss(), "traced": current, "traced_peak": peak,
+                        "allocators": self.__allocators()})
+    print("Memory after %s: peak RSS %.1fMB, traced %.1fMB (peak %.1fMB)" % (name, peak_rss() / 1e6, current / 1e6, peak / 1e6))
+    self.__reset_peak()
+
+  def __call__(self, record):
+    """ Progress renderer: tracks the traced memory peak of each area, over the memory in use when it started """
+    if record["event"] == "area_start":
+      self.stage_peak = max(self.stage_peak, tracemalloc.get_traced_memory()[1])
+      self.__reset_peak()
+      self.area_base = tracemalloc.get_traced_memory()[0]
+    elif record["event"] == "area_end":
+      current, peak = tracemalloc.get_traced_memory()
+      self.stage_peak = max(self.stage_peak, peak)
+      growth = peak - self.area_base
+      if len(self.area_peaks) < self.areas or growth > self.area_peaks[0][0]:
+        # only take a snapshot for the areas kept
+        area = {"area": record["area"], "target": record["target"], "dwellings": record["dwellings"], "traced": current,
+                "traced_peak": peak, "traced_growth": growth, "rss": _rss(), "allocators": self.__allocators()}
+        entry = (growth, record["done"], area)
+        if len(self.area_peaks) < self.areas:
+          heapq.heappush(self.area_peaks, entry)
+        else:
+          heapq.heapreplace(self.area_peaks, entry)
+
+  def report(self):
+    """ Returns the stages and the largest areas (largest first) """
+    return {"stages": self.stages, "areas": [entry[2] for entry in sorted(self.area_peaks, key=lambda e: -e[0])]}
+
+  def write(self, filename):
+    """ Writes the report as JSON """
+    print("Writing memory profile to", filename)
+    with open(filename, "w") as output:
+      json.dump(self.report(), output, indent=2)
@@ -0,0 +1,62 @@
+""" Household and household ref person microsyntheses run together, sharing table loading and the area pass """
+
+import ukcensusapi.Nomisweb as Api
+
+import household_microsynth.utils as utils
+import household_microsynth.household as household
+import household_microsynth.ref_person as ref_person
+import household_microsynth.handoff as handoff
+
+class Pipeline:
+  """
+  Household and ref person microsyntheses of the same region and resolution. The nomisweb client, the region's area
+  codes and the LC4605 table are loaded once and shared, and both populations are synthesised in a single pass over the
+  areas. The microsyntheses are in households and hrps
+  """
+
+  def __init__(self, region, resolution, cache_dir="./cache", workers=1, store_dir=None, seed=0, aggregate=False,
+               engine="joint", solver_settings=None):
+    if region[0] not in "EW":
+      raise ValueError("household ref persons are only available for England and Wales")
+    api = Api.Nomisweb(cache_dir)
+    area_codes = utils.get_area_codes(api, region, resolution)
+    self.households = household.Household(region, resolution, cache_dir, workers, store_dir, seed, aggregate, engine,
+                                          solver_settings, api, area_codes)
+    self.hrps = ref_person.ReferencePerson(region, resolution, cache_dir, seed, solver_settings, api, area_codes,
+                                           self.households.lc4605)
+
+  def reset(self):
+    """ Discards the synthesised populations so that run can be called again """
+    self.households.reset()
+    self.hrps.reset()
+
+  def run(self, events=None, memory=None, callback=None):
+    """
+    run both microsyntheses, area by area, writing progress events (see progress.py) to events (a file-like object) if
+    given, and recording the memory use of each area in memory (a memprof.MemoryProfile) if given. callback (if given)
+    is called with the rows of each area of each population as it is completed (see Household.run)
+    """
+    area_map = self.households.start(events, memory, callback)
+    self.hrps.start(events, memory, area_map, callback)
+    for i, area in enumerate(area_map):
+      self.households.add_area(i, area)
+      self.hrps.add_area(i, area)
+    self.households.finish()
+    self.hrps.finish()
+
+def synthesise(region, resolution, cache_dir="./cache", hrp=False, arrow=False, callback=None, **options):
+  """
+  Library entry point: runs the household microsynthesis of a region (with the household ref persons if hrp, see
+  Pipeline) and returns a dict of the populations ("households", and "hrp" if requested), each as columns and
+  dictionaries (see handoff.py), or an Arrow table if arrow is set. If callback is given it is called with the target,
+  area and rows (in the same form) of each area as it is completed. options are passed to Household
+  """
+  convert = (lambda batch: handoff.to_arrow(*batch)) if arrow else (lambda batch: batch)
+  stream = None if callback is None else lambda target, area, batch: callback(target, area, convert(batch))
+  if hrp:
+    msynth = Pipeline(region, resolution, cache_dir, **options)
+    msynth.run(callback=stream)
+    return {"households": convert(handoff.population(msynth.households)), "hrp": convert(handoff.population(msynth.hrps))}
+  msynth = household.Household(region, resolution, cache_dir, **options)
+  msynth.run(callback=stream)
+  return {"households": convert(handoff.population(msynth))}
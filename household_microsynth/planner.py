@@ -0,0 +1,181 @@
+""" Declarative description of the household tables, compiled by a planner into a sequence of humanleague calls """
+
+import numpy as np
+
+import household_microsynth.utils as utils
+
+# the household dimensions (see Household.maps for the categories of each), in the order they are synthesised, and the
+# population column of each
+DIMS = [("tenure", "LC4402_C_TENHUK11"), ("rooms", "LC4404_C_ROOMS"), ("occupants", "LC4404_C_SIZHUK11"),
+        ("bedrooms", "LC4405EW_C_BEDROOMS"), ("hhtype", "LC4408_C_AHTHUK11"), ("ch", "LC4402_C_CENHEATHUK11"),
+        ("buildtype", "LC4402_C_TYPACCOM"), ("eth", "LC4202_C_ETHHUK11"), ("cars", "LC4202_C_CARSNO"),
+        ("econ", "LC4605_C_NSSEC")]
+COLUMNS = dict(DIMS)
+
+# the census tables the households are constrained to: the (area-first) tensor of each held by Household, and the
+# dimension of each of its other axes
+TABLES = [("LC4404", "m4404", ["tenure", "rooms", "occupants"]),
+          ("LC4405", "m4405", ["tenure", "bedrooms", "occupants"]),
+          ("LC4408", "m4408", ["tenure", "hhtype"]),
+          ("LC4402", "m4402", ["tenure", "ch", "buildtype"]),
+          ("LC4202", "m4202", ["tenure", "eth", "cars"]),
+          ("LC4605", "m4605", ["tenure", "econ"])]
+
+# the dimensions of the seeds (T R O B H, see seed.py)
+SEED = ["tenure", "rooms", "occupants", "bedrooms", "hhtype"]
+
+# tables that are not synthesised by tenure for Scotland (tenures are not mappable)
+NO_TENURE_SC = ["LC4408", "LC4202", "LC4605"]
+
+def tables(scotland=False):
+  """ The tables (name, tensor attribute, dims) for England & Wales, or for Scotland """
+  return [(name, attr, [d for d in dims if not (scotland and name in NO_TENURE_SC and d == "tenure")])
+          for name, attr, dims in TABLES]
+
+def area_tensors(msynth, i):
+  """
+  The tensor of each table (see tables) for the i'th area of a household microsynthesis (or the areas, area first, if i
+  is an array of indices), summed over tenure if need be
+  """
+  spec = dict((name, dims) for name, _, dims in TABLES)
+  tensors = {}
+  for name, attr, dims in msynth.tables:
+    tensor = getattr(msynth, attr)[i]
+    # tenure is the first dimension of every table
+    tensors[name] = tensor.sum(axis=tensor.ndim - len(spec[name])) if len(dims) < len(spec[name]) else tensor
+  return tensors
+
+def _order(dims):
+  return sorted(dims, key=[d for d, _ in DIMS].index)
+
+def _stage(site, solve, link, new, members, sizes):
+  dims = list(link) + _order(new)
+  shape = [sizes[d] for d in dims]
+  return {"site": site, "solve": solve, "name": "+".join(t[0] for t in members).lower(), "dims": dims, "link": list(link),
+          "tables": [(t[0], list(t[2])) for t in members], "shape": shape, "size": int(np.prod(shape))}
+
+def plan(tables, sizes, joint=False, seed=SEED):
+  """
+  Compiles tables (see tables) into stages, each a humanleague call or a table used as is. The tables within the seed's
+  dimensions are solved first, together with the seed (qisi). If joint the other tables are then solved in one call over
+  all the dimensions, constrained by that result (qis). Otherwise tables are only solved together when they share a
+  dimension the seed does not have, each group over just the dimensions it shares with the seed (the link) and its own,
+  smallest first, and the result is dealt out to the households within each link cell. This gives the same totals with a
+  peak dense state of the largest group rather than the product of all the dimensions. sizes gives the number of
+  categories of each dimension. Returns a list of stages (dicts)
+  """
+  core = [t for t in tables if set(t[2]) <= set(seed)]
+  if not core:
+    raise ValueError("no tables are within the seed dimensions " + str(seed))
+  rest = [t for t in tables if not set(t[2]) <= set(seed)]
+  stages = [_stage("p0", "qisi", [], [], core, sizes)]
+  stages[0].update(dims=list(seed), shape=[sizes[d] for d in seed], size=int(np.prod([sizes[d] for d in seed])))
+  if not rest:
+    return stages
+  if joint:
+    return stages + [_stage("p1", "qis", seed, set(d for t in rest for d in t[2]) - set(seed), rest, sizes)]
+
+  # tables sharing an unseeded dimension must be solved together
+  groups = []
+  for table in rest:
+    new = set(table[2]) - set(seed)
+    members = [table]
+    for group in [g for g in groups if g[0] & new]:
+      groups.remove(group)
+      new = new | group[0]
+      members = group[1] + members
+    groups.append((new, sorted(members, key=tables.index)))
+  planned = []
+  for new, members in groups:
+    link = _order(set(d for t in members for d in t[2]) & set(seed))
+    planned.append(_stage("p1", None if len(members) == 1 else "qis", link, new, members, sizes))
+  return stages + sorted(planned, key=lambda s: s["size"])
+
+def peak(stages):
+  """ The largest dense state (number of cells) of the stages """
+  return max(stage["size"] for stage in stages)
+
+def describe(stages):
+  """ One line per stage: the call (or table used as is), its dimensions and its size """
+  return ["%s %s %s over %s (%d cells)" % (stage["site"], stage["solve"] or "as is", "+".join(t for t, _ in stage["tables"]),
+                                          ",".join(stage["dims"]), stage["size"]) for stage in stages]
+
+def _marginal(dims, population, link, shape):
+  """ The counts of a population (a tensor over dims, or one index array per dim) in each cell of the link dims """
+  if not isinstance(population, list):
+    summed = population.sum(axis=tuple(a for a, d in enumerate(dims) if d not in link))
+    kept = [d for d in dims if d in link]
+    return np.transpose(summed, [kept.index(d) for d in link])
+  index = np.ravel_multi_index([population[dims.index(d)] for d in link], shape)
+  return np.bincount(index, minlength=int(np.prod(shape))).reshape(shape)
+
+def execute(stages, tensors, solver, area, seeds, rng, aggregate=False, message=print):
+  """
+  Runs the stages (see plan) for an area, given the area's tensor of each table (see area_tensors), using solver (a
+  solver.Solver). seeds are tried in turn for the first stage, the next being used if it fails to converge. rng(name)
+  returns the random stream used to deal out a stage's households. Returns the dimensions and the population, as one
+  index array per dimension, and the count of each row if aggregate and the population was solved jointly (else None)
+  """
+  first = stages[0]
+  indices = [np.array([first["dims"].index(d) for d in tdims]) for _, tdims in first["tables"]]
+  marginals = [tensors[name] for name, _ in first["tables"]]
+  result = solver.qisi(first["site"], area, seeds[0], indices, marginals)
+  if not (isinstance(result, dict) and result["conv"]) and len(seeds) > 1:
+    message("Dropping TROBH constraint due to convergence failure")
+    result = solver.qisi(first["site"], area, seeds[1], indices, marginals)
+    utils.check_humanleague_result(result, marginals, seeds[1])
+  else:
+    utils.check_humanleague_result(result, marginals, seeds[0])
+  return complete(stages[1:], tensors, solver, area, list(first["dims"]), result["result"], rng, aggregate)
+
+def complete(stages, tensors, solver, area, dims, population, rng, aggregate=False):
+  """
+  Runs the remaining stages (see plan) for an area from a population over dims (a tensor, or one index array per dim).
+  Returns as execute does
+  """
+  for stage in stages:
+    nlink = len(stage["link"])
+    shape = tuple(stage["shape"][:nlink])
+    if stage["solve"] is None:
+      name, tdims = stage["tables"][0]
+      table = np.transpose(tensors[name], [tdims.index(d) for d in stage["dims"]])
+    else:
+      indices = [np.arange(nlink)] if nlink else []
+      marginals = [_marginal(dims, population, stage["link"], shape)] if nlink else []
+      for name, tdims in stage["tables"]:
+        indices.append(np.array([stage["dims"].index(d) for d in tdims]))
+        marginals.append(tensors[name])
+      result = solver.qis(stage["site"], area, indices, marginals)
+      utils.check_humanleague_result(result, marginals)
+      table = result["result"]
+
+    if not isinstance(population, list) and stage["link"] == dims:
+      # the population is still a tensor and this stage refines every cell of it, so replaces it
+      population = table
+      dims = list(stage["dims"])
+      continue
+    if not isinstance(population, list):
+      population = utils.flatten(population)
+    if nlink:
+      key = np.ravel_multi_index([population[dims.index(d)] for d in stage["link"]], shape)
+    else:
+      key = np.zeros(len(population[0]), dtype=int)
+    cells = table.reshape((int(np.prod(shape)),) + table.shape[nlink:])
+    population = population + utils.attach(key, cells, rng(stage["name"]))
+    dims = dims + stage["dims"][nlink:]
+
+  if isinstance(population, list):
+    return dims, population, None
+  if aggregate:
+    index, counts = utils.nonzero(population)
+    return dims, index, counts
+  return dims, utils.flatten(population), None
+
+def validate(area, dims, population, counts, tables, tensors):
+  """ Checks a synthesised population (see execute) against the tensor of each table, raising RuntimeError on a mismatch """
+  for name, _, tdims in tables:
+    expected = tensors[name]
+    index = np.ravel_multi_index([population[dims.index(d)] for d in tdims], expected.shape)
+    actual = np.bincount(index, weights=counts, minlength=expected.size).reshape(expected.shape)
+    if not np.array_equal(actual, expected):
+      raise RuntimeError("synthesised households in %s do not match %s" % (area, name))
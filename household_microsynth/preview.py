@@ -0,0 +1,113 @@
+""" Fast approximate household synthesis for previews: stochastic rounding of IPF expectations in place of seeded QIS """
+
+import time
+import numpy as np
+import pandas as pd
+
+import household_microsynth.utils as utils
+import household_microsynth.planner as planner
+import household_microsynth.fit as fit
+
+# IPF iterations (over all the sampled areas at once); the tables are consistent so this converges quickly
+ITERATIONS = 20
+
+def sample_areas(n, fraction, rng):
+  """ The (sorted) indices of a random sample of a fraction of n areas, at least one """
+  if not 0.0 < fraction <= 1.0:
+    raise ValueError("sample fraction must be in (0, 1]")
+  return np.sort(rng.choice(n, max(1, int(round(fraction * n))), replace=False))
+
+def ipf(seed, indices, marginals, iterations=ITERATIONS):
+  """
+  Fits seed to the marginals (area-first tensors, each over the seed dimensions in the corresponding indices) for all
+  areas at once, by iterative proportional fitting. Returns the expected counts (area-first)
+  """
+  expected = np.tile(seed.astype(float), (len(marginals[0]),) + (1,) * seed.ndim)
+  for _ in range(iterations):
+    for index, marginal in zip(indices, marginals):
+      axes = tuple(1 + d for d in range(seed.ndim) if d not in index)
+      # the sums over the other dimensions are in ascending order of dimension
+      target = np.transpose(marginal, [0] + [1 + i for i in np.argsort(index)])
+      current = expected.sum(axis=axes)
+      ratio = np.divide(target, current, out=np.zeros(current.shape), where=current > 0)
+      expected *= np.expand_dims(ratio, axes)
+  return expected
+
+def integerise(expected, totals, rng):
+  """
+  Stochastic rounding of expected counts (area-first) to the totals (area by tenure) of the first dimension, tenure, of
+  each area: counts are scaled to the totals and rounded down, and the shortfall made up by drawing cells in proportion
+  to their remainders
+  """
+  flat = expected.reshape(expected.shape[0], expected.shape[1], -1)
+  current = flat.sum(axis=2, keepdims=True)
+  flat = flat * np.divide(totals[:, :, np.newaxis], current, out=np.zeros(current.shape), where=current > 0)
+  counts = np.floor(flat).astype(int)
+  remainder = flat - counts
+  shortfall = totals - counts.sum(axis=2)
+  for a, t in zip(*np.nonzero(shortfall > 0)):
+    p = remainder[a, t]
+    counts[a, t, rng.choice(len(p), shortfall[a, t], replace=False, p=p / p.sum())] += 1
+  return counts.reshape(expected.shape)
+
+def synthesise(msynth, sample, area_map, structural):
+  """
+  Synthesises the occupied households of the sampled areas (indices into area_map) of a household microsynthesis, with
+  its tables prepared (see Household.prepare, which also returns the areas and structural seed). The core tables are
+  fitted jointly to the structural seed, and the others attached within tenure (as the conditional engine does).
+  Returns the households as aggregated rows (see utils.aggregate)
+  """
+  stages = planner.plan(msynth.tables, {dim: len(msynth.maps[dim]) for dim in msynth.maps})
+  core = stages[0]
+  tensors = planner.area_tensors(msynth, sample)
+  indices = [np.array([core["dims"].index(d) for d in tdims]) for _, tdims in core["tables"]]
+  expected = ipf(structural, indices, [tensors[name] for name, _ in core["tables"]])
+  tenure = tensors["LC4404"].sum(axis=(2, 3))
+  counts = integerise(expected, tenure, utils.area_rng(msynth.seed, msynth.region, "preview"))
+
+  chunks = []
+  for k, i in enumerate(sample):
+    area = area_map[i]
+    rng = lambda name: utils.area_rng(msynth.seed, area, "preview:" + name)
+    dims, table, _ = planner.complete(stages[1:], planner.area_tensors(msynth, i), msynth.solver, area, list(core["dims"]),
+                                      utils.flatten(counts[k]), rng)
+    chunk = pd.DataFrame({planner.COLUMNS[dim]: utils.remap(values, msynth.maps[dim]) for dim, values in zip(dims, table)})
+    chunk.insert(0, "Area", area)
+    chunks.append(chunk)
+  households = pd.concat(chunks, ignore_index=True)
+  households["QS420_CELL"] = msynth.NOTAPPLICABLE
+  households["LC4408EW_C_PPBROOMHEW11"] = utils.people_per_bedroom_category(households.LC4404_C_SIZHUK11.values,
+                                                                            households.LC4405EW_C_BEDROOMS.values,
+                                                                            msynth.UNKNOWN)
+  return utils.aggregate(households)
+
+def preview(msynth, fraction=1.0, compare=False):
+  """
+  Previews a household microsynthesis (see synthesise) over a random sample of a fraction of its areas, and its fit to
+  the tables (see fit.py). If compare is set the sampled areas are also synthesised by the full method (see
+  Household.add_area), and the summary includes its fit and the loss of the preview (the difference in mean SRMSE).
+  Returns the preview households and the fit summary of each table
+  """
+  start = time.time()
+  area_map, _, structural, _ = msynth.prepare()
+  sample = sample_areas(len(area_map), fraction, utils.area_rng(msynth.seed, msynth.region, "preview_sample"))
+  households = synthesise(msynth, sample, area_map, structural)
+  print("Preview of %d areas took %.1fs" % (len(sample), time.time() - start))
+  _, summary = fit.household_fit(msynth, [households], sample=sample)
+  if not compare:
+    return households, summary
+
+  if msynth.store is not None:
+    raise ValueError("the full method cannot be compared when the population is held in a column store")
+  start = time.time()
+  msynth.reset()
+  msynth.start()
+  for i in sample:
+    msynth.add_area(i, area_map[i])
+  msynth.finish()
+  print("Full synthesis of %d areas took %.1fs" % (len(sample), time.time() - start))
+  _, full = fit.household_fit(msynth, sample=sample)
+  msynth.reset()
+  summary = summary.merge(full[["Table", "TAE", "MeanSRMSE"]], on="Table", how="left", suffixes=("", "Full"))
+  summary["Loss"] = summary.MeanSRMSE - summary.MeanSRMSEFull
+  return households, summary
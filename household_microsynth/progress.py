@@ -0,0 +1,113 @@
+""" Progress of a microsynthesis as a stream of events (JSON lines), and a log-friendly rendering of them """
+
+import sys
+import json
+import time
+from collections import deque
+
+def _to_json(value):
+  # numpy scalars
+  return value.item() if hasattr(value, "item") else str(value)
+
+class Progress:
+  """
+  Tracks the progress of a microsynthesis through its areas. Every event is a dict with the event type, target, time and
+  areas done so far, plus the event's own fields. It is written as a line of JSON to events (a file-like object) if given,
+  and passed to render (a function) if given. Rates are over the last window areas. Any details (e.g. the region) are
+  added to the start event
+  """
+
+  def __init__(self, target, total, events=None, render=None, window=50, clock=time.time, **details):
+    self.target = target
+    self.total = total
+    self.events = events
+    self.render = render
+    self.clock = clock
+    self.done = 0
+    self.dwellings = 0
+    self.area = None
+    self.recent = deque(maxlen=window)
+    self.started = self.area_started = clock()
+    self.emit("start", **details)
+
+  def area_start(self, area):
+    """ Records the start of an area """
+    self.area = area
+    self.area_started = self.clock()
+    self.emit("area_start", area=area)
+
+  def area_end(self, dwellings, **details):
+    """ Records the end of the current area, which produced dwellings (households or persons), and any details """
+    now = self.clock()
+    self.done += 1
+    self.dwellings += dwellings
+    self.recent.append((self.area_started, now, dwellings))
+    elapsed = max(now - self.recent[0][0], 1e-9)
+    areas_per_s = len(self.recent) / elapsed
+    dwellings_per_s = sum(r[2] for r in self.recent) / elapsed
+    fields = {"area": self.area, "dwellings": dwellings, "duration": now - self.area_started,
+              "areas_per_s": areas_per_s, "dwellings_per_s": dwellings_per_s, "eta": (self.total - self.done) / areas_per_s}
+    fields.update(details)
+    self.emit("area_end", **fields)
+
+  def message(self, text):
+    """ Records a message about the current area """
+    self.emit("message", area=self.area, text=text)
+
+  def finish(self, **details):
+    """ Records the end of the microsynthesis, and any details """
+    self.emit("finish", duration=self.clock() - self.started, dwellings=self.dwellings, **details)
+
+  def emit(self, event, **fields):
+    record = {"event": event, "target": self.target, "time": self.clock(), "done": self.done, "total": self.total}
+    record.update(fields)
+    if self.events is not None:
+      self.events.write(json.dumps(record, default=_to_json) + "\n")
+      self.events.flush()
+    if self.render is not None:
+      self.render(record)
+
+def _hms(seconds):
+  seconds = int(seconds)
+  return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+class LogRenderer:
+  """ Renders progress events as a line of text at most every interval seconds (plus messages), for batch job logs """
+
+  def __init__(self, stream=None, interval=10.0):
+    self.stream = stream
+    self.interval = interval
+    self.last = None
+
+  def __call__(self, record):
+    stream = sys.stdout if self.stream is None else self.stream
+    event = record["event"]
+    if event == "start":
+      self.last = record["time"]
+      line = "%s: %d areas" % (record["target"], record["total"])
+    elif event == "message":
+      line = "%s: %s %s" % (record["target"], record["area"], record["text"])
+    elif event == "area_end":
+      if record["time"] - self.last < self.interval and record["done"] < record["total"]:
+        return
+      self.last = record["time"]
+      line = "%s: %d/%d areas (%.1f%%) %.2f areas/s %.0f dwellings/s ETA %s" \
+           % (record["target"], record["done"], record["total"], 100.0 * record["done"] / max(record["total"], 1),
+              record["areas_per_s"], record["dwellings_per_s"], _hms(record["eta"]))
+    elif event == "finish":
+      line = "%s: done, %d dwellings in %s" % (record["target"], record["dwellings"], _hms(record["duration"]))
+    else:
+      return
+    print(line, file=stream, flush=True)
+
+def tee(*renders):
+  """ Combines renderers (e.g. a LogRenderer and a memprof.MemoryProfile) into one """
+  def render(record):
+    for r in renders:
+      r(record)
+  return render
+
+def read_events(filename):
+  """ Loads the events written to a file, e.g. for a scheduler to check on a job """
+  with open(filename) as events:
+    return [json.loads(line) for line in events if line.strip()]
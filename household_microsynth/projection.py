@@ -0,0 +1,98 @@
+""" Household projection: extends a synthetic population with newbuild dwellings """
+
+import os
+import numpy as np
+import pandas as pd
+
+from household_microsynth.household import Household
+import household_microsynth.utils as utils
+
+def get_period(filename):
+  """ Extracts the period (e.g. "201607") from a newbuilds_<period>.csv filename """
+  return os.path.splitext(os.path.basename(filename))[0].split("_")[-1]
+
+def load_newbuilds(filename):
+  """
+  Loads a newbuilds file (as written by projection_data.batch_newbuilds) into long format, i.e. one row per
+  area and build type with columns Area, LC4402_C_TYPACCOM, Count and Period. Unknown areas and zero counts are dropped
+  """
+  wide = pd.read_csv(filename, index_col=0)
+  wide.index.name = "Area"
+  newbuilds = wide.reset_index().melt(id_vars="Area", var_name="LC4402_C_TYPACCOM", value_name="Count")
+  newbuilds.LC4402_C_TYPACCOM = newbuilds.LC4402_C_TYPACCOM.astype(int)
+  newbuilds = newbuilds[(newbuilds.Area != "UNKNOWN") & (newbuilds.Count > 0)].reset_index(drop=True)
+  newbuilds["Period"] = get_period(filename)
+  return newbuilds
+
+def project(dwellings, newbuilds, seed=0):
+  """
+  Returns a table of new dwellings, one per newbuild, with the same columns as dwellings.
+  Each new dwelling copies the attributes of an existing occupied dwelling of the same build type in the same area, drawn
+  in proportion to the number of dwellings each row represents (1, or its Count if the population is aggregated, in
+  which case the new rows have a Count of 1), i.e. weighted by the frequency of each combination of attributes. Where an
+  area has no dwellings of the required type, donors are drawn from the whole population. Newbuilds in areas not covered
+  by the population are ignored. Random draws come from each area's stream for the given seed.
+  """
+  # only occupied households have a known build type
+  donors = dwellings[dwellings.LC4402_C_TYPACCOM != Household.NOTAPPLICABLE]
+  newbuilds = newbuilds[newbuilds.Area.isin(dwellings.Area.unique())]
+  if len(donors) == 0 or len(newbuilds) == 0:
+    return dwellings.iloc[0:0].copy()
+
+  # index the donors by area and type, and by type alone for the fallback
+  donors = donors.sort_values(["Area", "LC4402_C_TYPACCOM"], kind="mergesort")
+  area_sizes = donors.groupby(["Area", "LC4402_C_TYPACCOM"]).size()
+  area_starts = np.cumsum(area_sizes.values) - area_sizes.values
+
+  by_type = donors.sort_values("LC4402_C_TYPACCOM", kind="mergesort")
+  type_sizes = by_type.groupby("LC4402_C_TYPACCOM").size()
+  type_starts = np.cumsum(type_sizes.values) - type_sizes.values
+
+  group = area_sizes.index.get_indexer(pd.MultiIndex.from_arrays([newbuilds.Area.values, newbuilds.LC4402_C_TYPACCOM.values]))
+  fallback = type_sizes.index.get_indexer(newbuilds.LC4402_C_TYPACCOM.values)
+
+  local = group >= 0
+  if not local.all():
+    print("Sampling newbuilds from whole population for %d area/build type combinations" % (~local).sum())
+  missing = ~local & (fallback < 0)
+  if missing.any():
+    print("No donor dwellings for build types", newbuilds.LC4402_C_TYPACCOM[missing].unique(), "skipping",
+          newbuilds.Count[missing].sum(), "newbuilds")
+    newbuilds = newbuilds[~missing]
+    group = group[~missing]
+    fallback = fallback[~missing]
+    local = local[~missing]
+
+  # one entry per new dwelling, positions index the area-sorted donors followed by the type-sorted donors
+  counts = newbuilds.Count.values
+  pool = pd.concat([donors, by_type])
+  starts = np.where(local, area_starts[np.maximum(group, 0)], len(donors) + type_starts[np.maximum(fallback, 0)])
+  sizes = np.where(local, area_sizes.values[np.maximum(group, 0)], type_sizes.values[np.maximum(fallback, 0)])
+  starts = np.repeat(starts, counts)
+  ends = starts + np.repeat(sizes, counts) - 1
+
+  # draw from the cumulative weights of each donor group (with unit weights, a uniform draw of a row)
+  weights = pool.Count.values.astype(float) if "Count" in pool.columns else np.ones(len(pool))
+  cumulative = np.cumsum(weights)
+  offsets = cumulative[starts] - weights[starts]
+  areas = np.repeat(newbuilds.Area.values, counts)
+  targets = offsets + utils.area_random(seed, "projection", areas) * (cumulative[ends] - offsets)
+  draws = np.minimum(np.searchsorted(cumulative, targets, side="right"), ends)
+  new = pool.iloc[draws].reset_index(drop=True)
+  new.Area = areas
+  if "Count" in new.columns:
+    new.Count = 1
+  return new
+
+def apply_newbuilds(dwellings, newbuild_files, seed=0):
+  """
+  Appends the newbuilds in each file (applied in period order) to the population, without rerunning the microsynthesis.
+  Returns the extended population, indexed consecutively from the original population
+  """
+  for filename in sorted(newbuild_files, key=get_period):
+    newbuilds = load_newbuilds(filename)
+    # each period has its own streams
+    new = project(dwellings, newbuilds, str(seed) + ":" + get_period(filename))
+    print(get_period(filename) + ": " + str(len(new)) + " new dwellings")
+    dwellings = pd.concat([dwellings, new], ignore_index=True)
+  return dwellings
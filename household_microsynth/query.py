@@ -0,0 +1,150 @@
+""" Indexed queries (filtered counts and cross-tabs) over synthetic population files, without loading their rows """
+
+import os
+import numpy as np
+import pandas as pd
+
+# the number of dwellings a row stands for (aggregated output); not indexed
+COUNT = "Count"
+
+# number of set bits in each byte value
+_BITS = np.array([bin(i).count("1") for i in range(256)], dtype=np.int64)
+
+def index_file(filename):
+  """ Where the index of a population file is kept """
+  return os.path.splitext(filename)[0] + "_index.npz"
+
+def _positions(values, requested):
+  """ Positions in values (sorted) of those of the requested values that are present """
+  requested = np.atleast_1d(np.asarray(requested))
+  if values.dtype.kind in "iuf":
+    try:
+      requested = requested.astype(values.dtype)
+    except ValueError:
+      return np.array([], dtype=int)
+  else:
+    requested = requested.astype(str)
+  positions = np.minimum(np.searchsorted(values, requested), len(values) - 1)
+  return np.unique(positions[values[positions] == requested])
+
+class PartitionIndex:
+  """
+  Index of one population file (a partition): for each column its distinct values (sorted), the code of each row's
+  value and a bitmap (packed bits) of the rows with each value. Arrays are read from the index file as they are needed
+  """
+
+  def __init__(self, arrays):
+    self.arrays = arrays
+    self.cache = {}
+    self.nrows = int(self.__get("nrows"))
+    self.columns = list(self.__get("columns"))
+    self.weights = self.__get("weights") if "weights" in self.arrays else None
+
+  def __get(self, key):
+    if key not in self.cache:
+      self.cache[key] = self.arrays[key]
+    return self.cache[key]
+
+  @staticmethod
+  def build(population):
+    """ Indexes a population (a DataFrame, with a Count column if aggregated) """
+    arrays = {"nrows": len(population), "columns": np.array([c for c in population.columns if c != COUNT], dtype=str)}
+    if COUNT in population.columns:
+      arrays["weights"] = population[COUNT].values.astype(np.int64)
+    for col in arrays["columns"]:
+      column = population[col].values
+      if column.dtype.kind not in "iuf":
+        column = np.asarray(column, dtype=str)
+      values, codes = np.unique(column, return_inverse=True)
+      arrays["values_" + col] = values
+      arrays["codes_" + col] = codes.astype(np.int32)
+      arrays["bitmaps_" + col] = np.array([np.packbits(codes == i) for i in range(len(values))], dtype=np.uint8)
+    return PartitionIndex(arrays)
+
+  def save(self, filename):
+    np.savez(filename, **{key: self.arrays[key] for key in self.arrays})
+
+  @staticmethod
+  def load(filename):
+    return PartitionIndex(np.load(filename))
+
+  def values(self, col):
+    """ The distinct values of a column """
+    if col not in self.columns:
+      raise ValueError("no column " + col + " in the population")
+    return self.__get("values_" + col)
+
+  def matches(self, where):
+    """ Whether any rows might satisfy the predicates (using only the distinct values of each column) """
+    return all(len(_positions(self.values(col), where[col])) for col in where)
+
+  def mask(self, where):
+    """ Packed bitmap of the rows satisfying the predicates (a dict of column: value or list of values) """
+    mask = None
+    for col in where:
+      bitmaps = self.__get("bitmaps_" + col)[_positions(self.values(col), where[col])]
+      selected = np.bitwise_or.reduce(bitmaps, axis=0) if len(bitmaps) else np.zeros((self.nrows + 7) // 8, dtype=np.uint8)
+      mask = selected if mask is None else mask & selected
+    return mask
+
+  def count(self, where=None):
+    """ Number of dwellings (or persons) satisfying the predicates """
+    if not where:
+      return self.nrows if self.weights is None else int(self.weights.sum())
+    mask = self.mask(where)
+    if self.weights is None:
+      return int(_BITS[mask].sum())
+    return int(self.weights[np.unpackbits(mask)[:self.nrows].astype(bool)].sum())
+
+  def crosstab(self, by, where=None):
+    """ Counts of the dwellings (or persons) satisfying the predicates by the values of the columns in by """
+    rows = slice(None) if not where else np.unpackbits(self.mask(where))[:self.nrows].astype(bool)
+    shape = [len(self.values(col)) for col in by]
+    cells = np.ravel_multi_index([self.__get("codes_" + col)[rows] for col in by], shape)
+    counts = np.bincount(cells, weights=None if self.weights is None else self.weights[rows], minlength=int(np.prod(shape)))
+    present = np.flatnonzero(counts)
+    table = pd.DataFrame({col: self.values(col)[codes] for col, codes in zip(by, np.unravel_index(present, shape))}, columns=by)
+    table[COUNT] = counts[present].astype(np.int64)
+    return table
+
+class Query:
+  """
+  Counts and cross-tabs over population files (e.g. one per region). Each file is indexed the first time it is queried
+  (the index is saved alongside it, see index_file) and files that cannot satisfy a query's predicates are skipped
+  """
+
+  def __init__(self, filenames):
+    self.filenames = list(filenames)
+    self.indexes = {}
+
+  def partition(self, filename):
+    """ The index of a file, building it if it is missing or older than the file """
+    if filename not in self.indexes:
+      index = index_file(filename)
+      if os.path.isfile(index) and os.path.getmtime(index) >= os.path.getmtime(filename):
+        self.indexes[filename] = PartitionIndex.load(index)
+      else:
+        print("indexing", filename)
+        partition = PartitionIndex.build(pd.read_csv(filename, index_col=0))
+        partition.save(index)
+        self.indexes[filename] = partition
+    return self.indexes[filename]
+
+  def partitions(self, where=None):
+    """ The indexes of the files that might have rows satisfying the predicates """
+    for filename in self.filenames:
+      partition = self.partition(filename)
+      if not where or partition.matches(where):
+        yield partition
+
+  def count(self, where=None):
+    """ Number of dwellings (or persons) satisfying the predicates, a dict of column: value or list of values """
+    return sum(partition.count(where) for partition in self.partitions(where))
+
+  def crosstab(self, by, where=None):
+    """ Counts of the dwellings (or persons) satisfying the predicates by the values of the columns in by """
+    by = list(by)
+    tables = [partition.crosstab(by, where) for partition in self.partitions(where)]
+    if not tables:
+      return pd.DataFrame(columns=by + [COUNT])
+    return pd.concat(tables).groupby(by)[COUNT].sum().reset_index()
@@ -1,11 +1,16 @@
 """ Household ref person microsynthesis """
 
+import functools
 import numpy as np
 import pandas as pd
 
 import ukcensusapi.Nomisweb as Api
 import humanleague
 import household_microsynth.utils as Utils
+import household_microsynth.solver as solver
+import household_microsynth.progress as progress
+import household_microsynth.fetch as fetch
+import household_microsynth.handoff as handoff
 
 class ReferencePerson:
   """ Household ref person microsynthesis """
@@ -15,8 +20,16 @@ class ReferencePerson:
   NOTAPPLICABLE = -2
 
   # initialise, supplying geographical area and resolution , plus (optionally) a location to cache downloads
-  def __init__(self, region, resolution, cache_dir="./cache"):
-    self.api = Api.Nomisweb(cache_dir)
+  # the seed from which each area's random streams are derived, and the settings for each solver call site (see solver.py).
+  # A nomisweb client, the region's area codes (see utils.get_area_codes) and the LC4605 table can be supplied to share
+  # them with a household microsynthesis (see pipeline.py)
+  def __init__(self, region, resolution, cache_dir="./cache", seed=0, solver_settings=None, api=None, area_codes=None,
+               lc4605=None):
+    self.api = Api.Nomisweb(cache_dir) if api is None else api
+    self.area_codes = area_codes
+    self.lc4605 = lc4605
+    self.seed = seed
+    self.solver = solver.Solver(seed, solver_settings)
 
     self.region = region
     # convert input string to enum
@@ -26,8 +39,8 @@ class ReferencePerson:
     self.__get_census_data()
 
     # initialise table and index
-    categories = ["Area", "LC4605_C_NSSEC", "LC4605_C_TENHUK11", "LC4201_C_AGE", "LC4201_C_ETHPUK11",
-                  "QS111_C_HHLSHUK11", "LC1102_C_LARPUK11"]
+    self.columns = ["Area", "LC4605_C_NSSEC", "LC4605_C_TENHUK11", "LC4201_C_AGE", "LC4201_C_ETHPUK11",
+                    "QS111_C_HHLSHUK11", "LC1102_C_LARPUK11"]
 
     # LC4605_C_NSSEC  LC4605_C_TENHUK11
     # LC4201_C_AGE  LC4201_C_ETHPUK11  [C_TENHUK11]
@@ -35,8 +48,10 @@ class ReferencePerson:
     # [C_AGE] LC1102_C_LARPUK11
 
     self.num_hrps = sum(self.lc4605.OBS_VALUE)
-    self.hrps = pd.DataFrame(columns=categories)
+    self.hrps = self.__frame()
     self.index = 0
+    self.progress = None
+    self.callback = None
 
 #     # generate indices
     self.nssec_index = self.lc4605.C_NSSEC.unique()
@@ -46,8 +61,26 @@ class ReferencePerson:
     self.lifestage_index = self.qs111.C_HHLSHUK11.unique()
     self.livarr_index = self.lc1102.C_LARPUK11.unique()
 
-  def run(self):
-    """ run the microsynthesis """
+  def reset(self):
+    """ Discards the synthesised population (and solver report) so that run can be called again """
+    self.hrps = self.__frame()
+    self.solver = solver.Solver(self.seed, self.solver.settings)
+
+  def configure(self, seed=0, solver_settings=None):
+    """
+    Sets the seed and solver settings (see __init__), e.g. for a copy of a loaded microsynthesis, and discards the
+    population
+    """
+    self.seed = seed
+    self.solver = solver.Solver(seed, solver_settings)
+    self.reset()
+
+  def run(self, events=None, memory=None, callback=None):
+    """
+    run the microsynthesis, writing progress events (see progress.py) to events (a file-like object) if given, and
+    recording the memory use of each area in memory (a memprof.MemoryProfile) if given. If callback is given it is called
+    with the target ("hrp"), area and rows (see handoff.population) of each area as it is completed
+    """
 
     # print(self.nssec_index)
     # print(self.tenure_index)
@@ -56,111 +89,115 @@ class ReferencePerson:
     # print(self.lifestage_index)
     # print(self.livarr_index)
 
-    area_map = self.lc4605.GEOGRAPHY_CODE.unique()
+    area_map = self.start(events, memory, callback=callback)
+    for i, area in enumerate(area_map):
+      self.add_area(i, area)
+    self.finish()
+
+  def start(self, events=None, memory=None, area_map=None, callback=None):
+    """
+    Prepares the tables for all areas (in the order of area_map if given, e.g. to match a household microsynthesis)
+    and starts reporting progress (see run). Returns the areas
+    """
+    if area_map is None:
+      area_map = self.lc4605.GEOGRAPHY_CODE.unique()
 
     # construct seed disallowing states where lifestage doesn match age
     #                      N  T  A  E   L  V   (V=living arrangements)
     # use microdata here if possible
-    constraints = np.ones([9, 4, 4, 7, 12, 7])
+    self.constraints = np.ones([9, 4, 4, 7, 12, 7])
     # seed from microdata...
 
-    for area in area_map:
-      print('.', end='', flush=True)
-
-      self.__add_ref_persons(area, constraints)
-
-      # end area loop
-
-  def __add_ref_persons(self, area, constraints):
-
-    nssec_tenure = self.lc4605.loc[self.lc4605.GEOGRAPHY_CODE == area].copy()
-    # unmap indices
-    # TODO might be quicker to unmap the entire table upfront?
-    Utils.unmap(nssec_tenure.C_NSSEC, self.nssec_index)
-    Utils.unmap(nssec_tenure.C_TENHUK11, self.tenure_index)
-
-    m4605 = Utils.unlistify(nssec_tenure,
-                            ["C_NSSEC", "C_TENHUK11"],
-                            [len(self.nssec_index), len(self.tenure_index)],
-                            "OBS_VALUE")
-    #print(m4605)
-
-    age_eth_tenure = self.lc4201.loc[self.lc4201.GEOGRAPHY_CODE == area].copy()
-    # unmap indices
-    # TODO might be quicker to unmap the entire table upfront?
-    #Utils.unmap(age_eth_tenure.C_AGE, self.age_index)
-    Utils.unmap(age_eth_tenure.C_ETHPUK11, self.eth_index)
-    Utils.unmap(age_eth_tenure.C_TENHUK11, self.tenure_index)
-
-    m4201 = Utils.unlistify(age_eth_tenure,
-                            ["C_AGE", "C_ETHPUK11", "C_TENHUK11"],
-                            [len(self.age_index), len(self.eth_index), len(self.tenure_index)],
-                            "OBS_VALUE")
-    # collapse age
-    m4201 = np.sum(m4201, axis=0)
-
-    # now check LC4605 total matches LC4201 and adjust as necessary (ensuring partial sum in tenure dimension is preserved)
-    m4605_sum = np.sum(m4605)
-    m4201_sum = np.sum(m4201)
-    if m4605_sum != m4201_sum:
-      print("LC4605:"+str(m4605_sum)+"->"+str(m4201_sum), end="")
-      tenure_4201 = np.sum(m4201, axis=0)
-      nssec_4605_adj = humanleague.prob2IntFreq(np.sum(m4605, axis=1) / m4605_sum, m4201_sum)["freq"]
-      #print(m4605)
-      m4605_adj = humanleague.qisi(m4605.astype(float), [np.array([0]), np.array([1])], [nssec_4605_adj, tenure_4201])
-      if isinstance(m4605_adj, str):
-        print(m4605_adj)
-      assert m4605_adj["conv"]
-      m4605 = m4605_adj["result"]
-      #print(m4605)
-
-    lifestage = self.qs111.loc[self.qs111.GEOGRAPHY_CODE == area].copy()
-    # unmap indices
-    # TODO might be quicker to unmap the entire table upfront?
-    Utils.unmap(lifestage.C_HHLSHUK11, self.lifestage_index)
-
-    mq111 = Utils.unlistify(lifestage,
-                            ["C_HHLSHUK11"],
-                            [len(self.lifestage_index)],
-                            "OBS_VALUE")
-    #mq111 = lifestage.OBS_VALUE
-    #print(mq111)
-
-    age_livarr = self.lc1102.loc[self.lc1102.GEOGRAPHY_CODE == area].copy()
-
-    # unmap indices
-    # TODO might be quicker to unmap the entire table upfront?
-    Utils.unmap(age_livarr.C_AGE, self.age_index)
-    Utils.unmap(age_livarr.C_LARPUK11, self.livarr_index)
-
-    # # TODO resolve age band incompatibility issues
-    # m1102 = Utils.unlistify(age_livarr,
-    #                         ["C_AGE", "C_LARPUK11"],
-    #                         [len(self.age_index) + 1, len(self.livarr_index)],
-    #                         "OBS_VALUE")
-    # m1102 = age_livarr.groupby("C_LARPUK11")["OBS_VALUE"].sum().as_matrix()
-    m1102 = Utils.unlistify(age_livarr,
-                            ["C_LARPUK11"],
-                            [len(self.livarr_index)],
-                            "OBS_VALUE")
-    #print(m1102)
-
-    pop = humanleague.qis([np.array([0, 1]), np.array([2, 1]), np.array([3]), np.array([4])], [m4605, m4201, mq111, m1102])
+    self.__prepare(area_map)
+
+    render = progress.LogRenderer() if memory is None else progress.tee(progress.LogRenderer(), memory)
+    self.progress = progress.Progress("hrp", len(area_map), events, render)
+    self.callback = callback
+    return area_map
+
+  def add_area(self, i, area):
+    """ Synthesises the household ref persons of the i'th area (after start) """
+    self.progress.area_start(area)
+    start_calls = len(self.solver.report)
+
+    first = len(self.hrps)
+    chunk = self.__add_ref_persons(i, area, self.constraints)
+    # the chunks are built up column by column from empty (object) frames
+    chunk = chunk.astype(dict((col, np.int64) for col in self.columns if col != "Area"))
+    self.hrps = pd.concat([self.hrps, chunk], ignore_index=True)
+
+    calls = self.solver.report[start_calls:]
+    self.progress.area_end(len(chunk), solver_attempts=sum(c["Attempts"] for c in calls),
+                           solver_time=sum(c["Time"] for c in calls))
+    if self.callback is not None:
+      self.callback("hrp", area, handoff.population(self, first))
+
+  def finish(self):
+    """ Finishes reporting progress (see run) """
+    self.progress.finish()
+    self.progress = None
+
+  def autotune(self, sample_size=10, candidates=solver.CANDIDATES):
+    """
+    Times the synthesis of a random sample of areas with each of the candidate solver settings (see solver.py) and adopts
+    the fastest that converges. The population is not modified
+    """
+    area_map = self.lc4605.GEOGRAPHY_CODE.unique()
+    self.__prepare(area_map)
+    rng = Utils.area_rng(self.seed, self.region, "autotune")
+    sample = rng.choice(len(area_map), min(sample_size, len(area_map)), replace=False)
+    return solver.autotune(self.solver, lambda i: self.__add_ref_persons(i, area_map[i], None), sample, candidates)
+
+  def __prepare(self, area_map):
+    """ Builds the tables for all areas as tensors indexed by area then category (as ordered in the indices) """
+    self.__reconcile(area_map)
+    # tenure by ethnicity (collapsing age), the dimensions in ascending order as humanleague 2 requires
+    self.m4201 = Utils.area_tensor(self.lc4201, area_map, ["C_AGE", "C_TENHUK11", "C_ETHPUK11"],
+                                   [self.age_index, self.tenure_index, self.eth_index]).sum(axis=1)
+    self.mq111 = Utils.area_tensor(self.qs111, area_map, ["C_HHLSHUK11"], [self.lifestage_index])
+    # TODO resolve age band incompatibility issues (living arrangements are summed over age)
+    self.m1102 = Utils.area_tensor(self.lc1102, area_map, ["C_LARPUK11"], [self.livarr_index])
+
+  def __reconcile(self, area_map):
+    """
+    LC4605 counts are often slightly lower than LC4201 (likely missing HRPs aged under 16), so scale them up within tenure
+    for all areas at once
+    """
+    m4605 = Utils.area_tensor(self.lc4605, area_map, ["C_TENHUK11", "C_NSSEC"], [self.tenure_index, self.nssec_index])
+    tenure_4201 = Utils.area_tensor(self.lc4201, area_map, ["C_TENHUK11"], [self.tenure_index])
+    # NSSEC by tenure, for each area
+    self.m4605 = np.swapaxes(Utils.reconcile_areas("LC4605", area_map, m4605, tenure_4201), 1, 2)
+
+  def __frame(self):
+    """ An empty population, with integer columns (other than Area) so that they can be handed off without copying """
+    return pd.DataFrame({col: pd.Series(dtype=object if col == "Area" else np.int64) for col in self.columns})
+
+  def __add_ref_persons(self, i, area, constraints):
+
+    m4605 = self.m4605[i]
+    m4201 = self.m4201[i]
+    mq111 = self.mq111[i]
+    m1102 = self.m1102[i]
+
+    pop = self.solver.qis("hrp", area, [np.array([0, 1]), np.array([1, 2]), np.array([3]), np.array([4])],
+                          [m4605, m4201, mq111, m1102])
     if isinstance(pop, str):
       print(pop)
     assert pop["conv"]
 
-    table = humanleague.flatten(pop["result"])
+    table = Utils.flatten(pop["result"])
 
-    chunk = pd.DataFrame(columns=self.hrps.columns.values)
+    chunk = pd.DataFrame(columns=self.columns)
     chunk.Area = np.repeat(area, len(table[0]))
     chunk.LC4605_C_NSSEC = Utils.remap(table[0], self.nssec_index)
     chunk.LC4605_C_TENHUK11 = Utils.remap(table[1], self.tenure_index)
+    # age is collapsed (see __prepare), so not synthesised
+    chunk.LC4201_C_AGE = np.repeat(self.UNKNOWN, len(table[0]))
     chunk.LC4201_C_ETHPUK11 = Utils.remap(table[2], self.eth_index)
     chunk.QS111_C_HHLSHUK11 = Utils.remap(table[3], self.lifestage_index)
     chunk.LC1102_C_LARPUK11 = Utils.remap(table[4], self.livarr_index)
     #print(chunk.head())
-    self.hrps = self.hrps.append(chunk)
+    return chunk
 
   def __get_census_data(self):
     """
@@ -168,17 +205,9 @@ class ReferencePerson:
     checks for locally cached data or calls nomisweb API
     """
 
-    # convert input string to enum
-    resolution = self.api.GeoCodeLookup[self.resolution]
-
-    if self.region in self.api.GeoCodeLookup.keys():
-      region_codes = self.api.GeoCodeLookup[self.region]
-    else:
-      region_codes = self.api.get_lad_codes(self.region)
-      if not region_codes:
-        raise ValueError("no regions match the input: \"" + self.region + "\"")
-
-    area_codes = self.api.get_geo_codes(region_codes, resolution)
+    if self.area_codes is None:
+      self.area_codes = Utils.get_area_codes(self.api, self.region, self.resolution)
+    area_codes = self.area_codes
 
     # assignment does shallow copy, need to use .copy() to avoid this getting query_params fields
     common_params = {"MEASURES": "20100",
@@ -187,12 +216,16 @@ class ReferencePerson:
 
     # tables:
 
-    # LC4605EW Tenure by NS-SeC - Household Reference Persons
-    query_params = common_params.copy()
-    query_params["C_TENHUK11"] = "2,3,5,6"
-    query_params["C_NSSEC"] = "1...9"
-    query_params["select"] = "GEOGRAPHY_CODE,C_NSSEC,C_TENHUK11,OBS_VALUE"
-    self.lc4605 = self.api.get_data("LC4605EW", query_params)
+    # the tables are fetched concurrently (see fetch.py) once all the queries are defined
+    requests = {}
+
+    # LC4605EW Tenure by NS-SeC - Household Reference Persons (unless shared)
+    if self.lc4605 is None:
+      query_params = common_params.copy()
+      query_params["C_TENHUK11"] = "2,3,5,6"
+      query_params["C_NSSEC"] = "1...9"
+      query_params["select"] = "GEOGRAPHY_CODE,C_NSSEC,C_TENHUK11,OBS_VALUE"
+      requests["LC4605EW"] = functools.partial(self.api.get_data, "LC4605EW", query_params)
     #self.lc4605.to_csv("LC4605.csv")
 
     # LC4201EW  Tenure by ethnic group by age - Household Reference Persons
@@ -208,7 +241,7 @@ class ReferencePerson:
     query_params["C_AGE"] = "1...4"
     query_params["C_ETHPUK11"] = "2...8"
     query_params["select"] = "GEOGRAPHY_CODE,C_AGE,C_ETHPUK11,C_TENHUK11,OBS_VALUE"
-    self.lc4201 = self.api.get_data("LC4201EW", query_params)
+    requests["LC4201EW"] = functools.partial(self.api.get_data, "LC4201EW", query_params)
 
     # QS111EW - Household lifestage
     # Stages correspond to:
@@ -222,7 +255,7 @@ class ReferencePerson:
     query_params["C_HHLSHUK11"] = "2,3,4,6,7,8,10,11,12,14,15,16"
     query_params["RURAL_URBAN"] = "0"
     query_params["select"] = "GEOGRAPHY_CODE,C_HHLSHUK11,OBS_VALUE"
-    self.qs111 = self.api.get_data("QS111EW", query_params)
+    requests["QS111EW"] = functools.partial(self.api.get_data, "QS111EW", query_params)
 
     # LC1102EW - Living arrangements by age - Household Reference Persons
     # NOTE DIFFERENT AGE CATEGORIES
@@ -237,6 +270,12 @@ class ReferencePerson:
     query_params["C_AGE"] = "1...5"
     query_params["C_LARPUK11"] = "2,3,5,6,7,8,9"
     query_params["select"] = "GEOGRAPHY_CODE,C_AGE,C_LARPUK11,OBS_VALUE"
-    self.lc1102 = self.api.get_data("LC1102EW", query_params)
+    requests["LC1102EW"] = functools.partial(self.api.get_data, "LC1102EW", query_params)
+
+    tables = fetch.fetch_all(requests)
+    self.lc4605 = tables.get("LC4605EW", self.lc4605)
+    self.lc4201 = tables["LC4201EW"]
+    self.qs111 = tables["QS111EW"]
+    self.lc1102 = tables["LC1102EW"]
 
     # LC6115 HRP: composition by NSSEC?
@@ -6,6 +6,8 @@ Functionality for generating seed data for the microsynthesis
 import numpy as np
 import pandas as pd
 
+# survey seeds already loaded, by waves
+_survey_cache = {}
 
 # T: tenure
 # R: rooms
@@ -17,7 +19,11 @@ def get_survey_TROBH(waveno=3):
   # ensure array
   if isinstance(waveno, int):
     waveno=[waveno]
-  
+
+  key = tuple(waveno)
+  if key in _survey_cache:
+    return _survey_cache[key].copy()
+
   cols = ['tenure', 'rooms', 'occupants', 'bedrooms', 'hhtype']
   shape = [4,        6,       4,           4,          5]
   seed = np.zeros(shape, dtype=float)
@@ -34,7 +40,8 @@ def get_survey_TROBH(waveno=3):
   # add small probability of being in an unobserved state but ensure impossible states stay impossible
   # 0.5 representing approximately the probability threshhold of the state not being seen in the survey
   seed = (seed + 0.5) * get_impossible_TROBH()
-  return seed
+  _survey_cache[key] = seed
+  return seed.copy()
 
 def get_impossible_TROBH():
   """ zeros out impossible (beds>rooms, single household with >1 occupants) states, all others are equally probable """
@@ -0,0 +1,135 @@
+""" Long-running synthesis service that keeps census tables loaded between jobs """
+
+import copy
+import json
+import zlib
+import socketserver
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ProcessPoolExecutor
+
+import household_microsynth.household as household
+import household_microsynth.ref_person as ref_person
+
+# job fields (and their defaults) for each target
+JOB_FIELDS = {"households": {"region": None, "resolution": None, "seed": 0, "aggregate": False, "engine": "joint",
+                             "solver": None},
+              "hrp": {"region": None, "resolution": None, "seed": 0, "solver": None}}
+
+# rows of the result written at a time
+BLOCK_SIZE = 10000
+
+# job fields that determine the census tables a microsynthesis loads; the others are options of each run
+TEMPLATE_FIELDS = ["target", "region", "resolution"]
+
+# microsyntheses with their tables loaded but not run, by job key (per worker process)
+_templates = {}
+
+def parse_job(job):
+  """ Validates a job (a dict with a target, region, resolution and options) and fills in the defaults """
+  target = job.get("target", "households")
+  if target not in JOB_FIELDS:
+    raise ValueError("target must be one of " + str(sorted(JOB_FIELDS)))
+  unknown = set(job) - set(JOB_FIELDS[target]) - {"target"}
+  if unknown:
+    raise ValueError("unknown job fields: " + str(sorted(unknown)))
+  parsed = dict(JOB_FIELDS[target])
+  parsed.update(job)
+  parsed["target"] = target
+  for field in ["region", "resolution"]:
+    if not parsed[field]:
+      raise ValueError(field + " must be specified")
+  return parsed
+
+def job_key(job):
+  """
+  Identifies the microsynthesis (with its tables loaded) that a parsed job runs. The Scottish household tables are partly
+  synthesised (see household._derive_area_sc), so depend on the seed and solver settings too
+  """
+  fields = TEMPLATE_FIELDS
+  if job["target"] == "households" and job["region"][0] == "S":
+    fields = fields + ["seed", "solver"]
+  return json.dumps(dict((field, job[field]) for field in fields), sort_keys=True)
+
+def run_job(job, cache_dir="./cache"):
+  """
+  Runs a parsed job in this process and returns the synthetic population. The census tables are loaded the first time
+  a region and resolution is seen and reused for subsequent jobs, each running a copy with its own options
+  """
+  key = job_key(job)
+  if key not in _templates:
+    if job["target"] == "households":
+      _templates[key] = household.Household(job["region"], job["resolution"], cache_dir, seed=job["seed"],
+                                            solver_settings=job["solver"])
+    else:
+      _templates[key] = ref_person.ReferencePerson(job["region"], job["resolution"], cache_dir, job["seed"], job["solver"])
+  msynth = copy.copy(_templates[key])
+  if job["target"] == "households":
+    msynth.configure(job["seed"], job["aggregate"], job["engine"], job["solver"])
+  else:
+    msynth.configure(job["seed"], job["solver"])
+  msynth.run()
+  return msynth.dwellings if job["target"] == "households" else msynth.hrps
+
+class _Server(socketserver.ThreadingMixIn, HTTPServer):
+  daemon_threads = True
+
+class _Handler(BaseHTTPRequestHandler):
+  """ POST /jobs with a JSON job to run it (the response is the population as csv), GET /status for the server state """
+
+  def do_GET(self):
+    if self.path != "/status":
+      self.send_error(404)
+      return
+    self.__send_json(200, {"workers": len(self.server.pools), "jobs": self.server.jobs})
+
+  def do_POST(self):
+    if self.path != "/jobs":
+      self.send_error(404)
+      return
+    try:
+      job = parse_job(json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8")))
+    except ValueError as error:
+      self.__send_json(400, {"error": str(error)})
+      return
+
+    # the same job always goes to the same worker, whose tables are then already loaded
+    pools = self.server.pools
+    key = job_key(job)
+    future = pools[zlib.crc32(key.encode("utf-8")) % len(pools)].submit(run_job, job, self.server.cache_dir)
+    try:
+      population = future.result()
+    except Exception as error:
+      self.__send_json(500, {"error": str(error)})
+      return
+    self.server.jobs += 1
+
+    self.send_response(200)
+    self.send_header("Content-Type", "text/csv")
+    self.end_headers()
+    index_label = "HID" if job["target"] == "households" else None
+    for start in range(0, len(population), BLOCK_SIZE):
+      block = population.iloc[start:start + BLOCK_SIZE]
+      self.wfile.write(block.to_csv(index_label=index_label, header=(start == 0)).encode("utf-8"))
+    if not len(population):
+      self.wfile.write(population.to_csv(index_label=index_label).encode("utf-8"))
+
+  def __send_json(self, status, content):
+    self.send_response(status)
+    self.send_header("Content-Type", "application/json")
+    self.end_headers()
+    self.wfile.write(json.dumps(content).encode("utf-8"))
+
+def make_server(host="127.0.0.1", port=8080, workers=1, cache_dir="./cache"):
+  """ Creates (but does not start) the service, with workers single-process pools """
+  server = _Server((host, port), _Handler)
+  server.pools = [ProcessPoolExecutor(max_workers=1) for _ in range(max(1, workers))]
+  server.cache_dir = cache_dir
+  server.jobs = 0
+  return server
+
+def shutdown(server):
+  """ Stops the service and its workers """
+  server.shutdown()
+  server.server_close()
+  for pool in server.pools:
+    pool.shutdown()
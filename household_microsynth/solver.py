@@ -0,0 +1,127 @@
+""" Configurable calls to the humanleague solvers, with a record of the cost of each call """
+
+import time
+import numpy as np
+import pandas as pd
+import humanleague
+
+import household_microsynth.utils as utils
+
+# Settings for each call site (e.g. "p0", or "*" for all sites). The Sobol sequence skips are drawn from 2^[0, max_skip),
+# and the time taken grows with the number of values skipped. max_skip 0 leaves the sequence unskipped (humanleague's
+# own default). A call that fails to converge is retried (with different skips, so only if max_skip is set) up to
+# attempts times in total.
+# NB humanleague does not expose the IPF tolerance or iteration limit, so these are the only costs that can be controlled
+DEFAULTS = {"max_skip": 0, "attempts": 1}
+
+# The smallest max_skip of the replicates of an ensemble (see replicate). Skips of up to 2^19 values cost milliseconds
+REPLICATE_MAX_SKIP = 20
+
+# Settings tried by autotune, cheapest first
+CANDIDATES = [{"max_skip": 0, "attempts": 1},
+              {"max_skip": 1, "attempts": 3},
+              {"max_skip": 4, "attempts": 2},
+              {"max_skip": 8, "attempts": 2},
+              {"max_skip": 12, "attempts": 1}]
+
+def converged(result):
+  """ Whether a humanleague result (a dict, or a string if there was an error) has converged """
+  return isinstance(result, dict) and bool(result.get("conv", False))
+
+def _normalise(result):
+  """ humanleague 2 returns (population, stats) rather than a dict holding both """
+  if isinstance(result, tuple):
+    return dict(result[1], result=result[0])
+  return result
+
+class Solver:
+  """
+  Calls humanleague for an area with the settings for the call site, using the area's random streams for the skips.
+  Each call is recorded in report (area, site, time, attempts, convergence, and the chi-squared statistic of the result)
+  """
+
+  def __init__(self, seed=0, settings=None):
+    self.seed = seed
+    self.settings = dict(settings) if settings else {}
+    self.report = []
+
+  def config(self, site):
+    """ Returns the settings for a call site """
+    config = dict(DEFAULTS)
+    config.update(self.settings.get("*", {}))
+    config.update(self.settings.get(site, {}))
+    unknown = set(config) - set(DEFAULTS)
+    if unknown:
+      raise ValueError("unknown solver settings for " + site + ": " + str(sorted(unknown)))
+    return config
+
+  def qisi(self, site, area, seed, indices, marginals):
+    """ humanleague.qisi """
+    return self.__solve(site, area, humanleague.qisi, [seed, indices, marginals])
+
+  def qis(self, site, area, indices, marginals):
+    """ humanleague.qis """
+    return self.__solve(site, area, humanleague.qis, [indices, marginals])
+
+  def __solve(self, site, area, func, args):
+    config = self.config(site)
+    start = time.time()
+    for attempt in range(max(1, config["attempts"])):
+      # retries use streams derived from the site's
+      stage = site if attempt == 0 else site + ":" + str(attempt)
+      skips = [utils.area_skips(self.seed, area, stage, config["max_skip"])] if config["max_skip"] else []
+      result = _normalise(func(*(args + skips)))
+      if converged(result):
+        break
+    self.report.append({"Area": area, "Site": site, "Time": time.time() - start, "Attempts": attempt + 1,
+                        "Converged": converged(result),
+                        "ChiSq": result.get("chiSq", np.nan) if isinstance(result, dict) else np.nan})
+    return result
+
+  def summary(self):
+    """ Returns the report as a DataFrame """
+    return pd.DataFrame(self.report, columns=["Area", "Site", "Time", "Attempts", "Converged", "ChiSq"])
+
+def replicate(seed, settings, r):
+  """
+  The solver for replicate r of an ensemble (see Household.replicates). Its skips are drawn from the replicate's own
+  streams (see utils.replicate_seed), and max_skip is raised to at least REPLICATE_MAX_SKIP at every call site:
+  humanleague rounds skips up to a power of two, so a narrower range would leave many replicates with the same sequence
+  """
+  settings = dict((site, dict(config)) for site, config in (settings or {}).items())
+  for site in set(settings) | set(["*"]):
+    config = settings.setdefault(site, {})
+    if site == "*" or "max_skip" in config:
+      config["max_skip"] = max(config.get("max_skip", DEFAULTS["max_skip"]), REPLICATE_MAX_SKIP)
+  return Solver(utils.replicate_seed(seed, r), settings)
+
+def autotune(solver, trial, areas, candidates=CANDIDATES):
+  """
+  Runs trial (a function that synthesises a single area, raising an error if the result is invalid) for each of areas
+  with each of the candidate settings applied to every call site, and adopts the fastest candidate for which every call
+  converged and every area validated. If none succeed the settings are unchanged. Returns the settings
+  """
+  original = solver.settings
+  best = None
+  for candidate in candidates:
+    solver.settings = {"*": candidate}
+    solver.report = []
+    start = time.time()
+    try:
+      for area in areas:
+        trial(area)
+      valid = all(r["Converged"] for r in solver.report)
+    except (RuntimeError, ValueError, AssertionError):
+      valid = False
+    elapsed = time.time() - start
+    print("Solver settings", candidate, "%.3fs" % elapsed, "ok" if valid else "failed")
+    if valid and (best is None or elapsed < best[1]):
+      best = (candidate, elapsed)
+  solver.report = []
+  if best is None:
+    print("No candidate solver settings succeeded, keeping", original)
+    solver.settings = original
+  else:
+    print("Using solver settings", best[0])
+    solver.settings = {"*": best[0]}
+  return solver.settings
@@ -0,0 +1,96 @@
+""" Columnar storage for synthetic populations """
+
+import os
+import numpy as np
+import pandas as pd
+
+class ColumnStore:
+  """
+  A table of fixed length, filled in order, with each (integer) column held in a separate numpy array, or if a directory
+  is specified, a memory-mapped file. Columns listed in encoded (e.g. Area) hold arbitrary values stored as integer codes
+  """
+
+  def __init__(self, columns, nrows, directory=None, encoded=("Area",), dtype=np.int32):
+    self.columns = list(columns)
+    self.nrows = nrows
+    self.directory = directory
+    self.index = 0
+    # category values of encoded columns, and a reverse lookup
+    self.categories = {col: [] for col in encoded if col in self.columns}
+    self.__codes = {col: {} for col in self.categories}
+
+    if directory is not None:
+      os.makedirs(directory, exist_ok=True)
+    self.arrays = {}
+    for col in self.columns:
+      if directory is None:
+        self.arrays[col] = np.zeros(nrows, dtype=dtype)
+      else:
+        # zero-length memmaps are not permitted
+        self.arrays[col] = np.memmap(self.__filename(col), dtype=dtype, mode="w+", shape=(max(nrows, 1),))
+
+  def __filename(self, col):
+    return os.path.join(self.directory, col + ".bin")
+
+  def encode(self, col, values):
+    """ Converts values into codes for an encoded column, adding any new values to its categories """
+    codes = self.__codes[col]
+    for value in pd.unique(values):
+      if value not in codes:
+        codes[value] = len(self.categories[col])
+        self.categories[col].append(value)
+    return pd.Index(self.categories[col]).get_indexer(values)
+
+  def append(self, chunk):
+    """ Writes the rows of chunk (a DataFrame containing all the columns) into the next free rows of the store """
+    n = len(chunk)
+    if self.index + n > self.nrows:
+      raise RuntimeError("store capacity (%d rows) exceeded" % self.nrows)
+    for col in self.columns:
+      values = chunk[col].values
+      if col in self.categories:
+        values = self.encode(col, values)
+      self.arrays[col][self.index:self.index + n] = values
+    self.index += n
+
+  def fill(self, col, value):
+    """ Sets every row of a column to value """
+    self.arrays[col][:] = value
+
+  def block(self, start, stop):
+    """ Returns rows [start, stop) as a DataFrame, decoding encoded columns """
+    data = {}
+    for col in self.columns:
+      if col in self.categories:
+        data[col] = np.asarray(self.categories[col], dtype=object)[self.arrays[col][start:stop]]
+      else:
+        data[col] = np.array(self.arrays[col][start:stop])
+    return pd.DataFrame(data, columns=self.columns, index=pd.RangeIndex(start, stop))
+
+  def blocks(self, block_size):
+    """ Iterates over the filled rows in DataFrames of (at most) block_size rows """
+    for start in range(0, self.index, block_size):
+      yield self.block(start, min(start + block_size, self.index))
+
+  def to_csv(self, filename, block_size, index_label="HID"):
+    """ Writes the filled rows to csv, block_size rows at a time """
+    header = True
+    for block in self.blocks(block_size):
+      block.to_csv(filename, index_label=index_label, header=header, mode="w" if header else "a")
+      header = False
+
+  def remove(self):
+    """ Deletes the backing files (if any). The store is unusable afterwards """
+    if self.directory is None:
+      return
+    for col in self.columns:
+      del self.arrays[col]
+      os.remove(self.__filename(col))
+
+def block_size(max_memory, ncols, overhead=8):
+  """
+  Returns the number of rows per block that keeps a decoded block, plus the temporaries (e.g. masks) derived from it,
+  within max_memory (MB)
+  """
+  # 8 bytes per value in a DataFrame, times a factor for masks, copies and object (area code) columns
+  return max(1, int(max_memory * 1024 * 1024 / (8 * ncols * overhead)))
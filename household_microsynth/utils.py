@@ -1,21 +1,104 @@
 # utility functions
 
+import hashlib
 import numpy as np
 import pandas as pd
-from random import randint
+
+def get_area_codes(api, region, resolution):
+  """
+  Resolves a region (a LAD code, or a name nomisweb recognises) to the nomisweb geography codes of its areas at resolution
+  """
+  if region in api.GeoCodeLookup.keys():
+    region_codes = api.GeoCodeLookup[region]
+  else:
+    region_codes = api.get_lad_codes(region)
+    if not region_codes:
+      raise ValueError("no regions match the input: \"" + region + "\"")
+  return api.get_geo_codes(region_codes, api.GeoCodeLookup[resolution])
+
+def area_rng(seed, area, stage):
+  """
+  Returns a random generator for one stage of the processing of one area, derived from the run seed. Since each stream
+  depends only on (seed, area, stage), results do not depend on the order in which areas are processed
+  """
+  digest = hashlib.sha256((str(seed) + ":" + str(stage) + ":" + str(area)).encode("utf-8")).digest()
+  return np.random.RandomState(int.from_bytes(digest[:4], "little"))
+
+def replicate_seed(seed, replicate):
+  """ The seed of the random streams of a replicate of an ensemble (replicate 0 being the run itself) """
+  if replicate == 0:
+    return seed
+  digest = hashlib.sha256((str(seed) + ":replicate:" + str(replicate)).encode("utf-8")).digest()
+  return int.from_bytes(digest[:4], "little")
+
+def area_skips(seed, area, stage, max_exp=12):
+  """ Returns the number of Sobol values for humanleague to skip (a power of two below 2^max_exp) for one stage of one area """
+  return 2 ** area_rng(seed, area, stage).randint(0, max_exp)
+
+def area_random(seed, stage, areas):
+  """
+  Returns uniform random numbers, one per element of areas, where the values for each area are drawn (in order of
+  appearance) from that area's stream, so they do not depend on the presence or order of other areas
+  """
+  codes, uniques = pd.factorize(np.asarray(areas))
+  values = np.empty(len(codes))
+  order = np.argsort(codes, kind="mergesort")
+  splits = np.split(order, np.cumsum(np.bincount(codes, minlength=len(uniques)))[:-1])
+  for area, positions in zip(uniques, splits):
+    values[positions] = area_rng(seed, area, stage).random_sample(len(positions))
+  return values
+
+def reconcile(table, targets, fallback=None):
+  """
+  Scales each row (i.e. along the last dimension) of a tensor of counts to the corresponding total in targets, as integers
+  in proportion to the row (using largest remainders). Rows that are all zero take their proportions from the corresponding
+  row of fallback if given and nonzero, otherwise are uniform. Vectorised over all the leading dimensions
+  """
+  table = np.asarray(table)
+  targets = np.asarray(targets)
+  weights = table.astype(float)
+  if fallback is not None:
+    weights = np.where(weights.sum(axis=-1, keepdims=True) > 0, weights, np.broadcast_to(fallback, table.shape))
+  weights = np.where(weights.sum(axis=-1, keepdims=True) > 0, weights, 1.0)
+  exact = weights * (targets / weights.sum(axis=-1))[..., None]
+  result = np.floor(exact).astype(int)
+  # the largest remainders in each row get the shortfall
+  shortfall = targets - result.sum(axis=-1)
+  rank = np.argsort(np.argsort(result - exact, axis=-1, kind="mergesort"), axis=-1)
+  return result + (rank < shortfall[..., None])
+
+def reconcile_areas(name, areas, table, targets):
+  """
+  Reconciles a table (area x tenure x category) to target totals by area and tenure (see reconcile), where a tenure
+  missing from the table takes the proportions of the area as a whole. Logs the areas adjusted
+  """
+  adjusted = reconcile(table, targets, table.sum(axis=1, keepdims=True))
+  changed = np.flatnonzero((adjusted != table).reshape(len(areas), -1).any(axis=1))
+  if len(changed):
+    before = table.sum(axis=(1, 2))
+    after = adjusted.sum(axis=(1, 2))
+    print("%s adjusted in %d areas:" % (name, len(changed)))
+    for i in changed:
+      print("  %s: %d -> %d" % (areas[i], before[i], after[i]))
+  return adjusted
 
 # econ table sometimes has a slightly lower (1 or 2) count, need to adjust ***at the correct tenure***
 def adjust(table, consistent_table):
-  for t in table.C_TENHUK11.unique():
-    consistent_sum = consistent_table[consistent_table.C_TENHUK11 == t].OBS_VALUE.sum()
-    sum = table[table.C_TENHUK11 == t].OBS_VALUE.sum()
-    if sum < consistent_sum:
-      print("adjusting table tenure", str(t), sum, "->", consistent_sum)
-      # randomly increment values (better to scale proportionally)
-      r = len(table[table.C_TENHUK11 == t].OBS_VALUE)
-      for i in range(sum, consistent_sum):
-        index = table[table.C_TENHUK11 == t].OBS_VALUE.index.values
-        table.OBS_VALUE.at[index[randint(0, r-1)]] += 1
+  """ Scales up the values in table proportionally within each tenure where they fall short of consistent_table """
+  tenures = table.C_TENHUK11.unique()
+  row = pd.Index(tenures).get_indexer(table.C_TENHUK11.values)
+  col = table.groupby("C_TENHUK11").cumcount().values
+  counts = np.zeros((len(tenures), col.max() + 1 if len(col) else 0), dtype=int)
+  counts[row, col] = table.OBS_VALUE.values
+  targets = consistent_table.groupby("C_TENHUK11").OBS_VALUE.sum().reindex(tenures).fillna(0).values.astype(int)
+  targets = np.maximum(counts.sum(axis=1), targets)
+  for t in np.flatnonzero(targets > counts.sum(axis=1)):
+    print("adjusting table tenure", str(tenures[t]), counts[t].sum(), "->", targets[t])
+  # padding (beyond the rows of each tenure) must stay zero
+  padding = np.arange(counts.shape[1]) >= np.bincount(row, minlength=len(tenures))[:, None]
+  adjusted = reconcile(counts, targets, np.where(padding, 0, 1))
+  table = table.copy()
+  table.OBS_VALUE = adjusted[row, col]
   return table
 
 # TODO this shouldnt throw it should report back to caller
@@ -41,6 +124,74 @@ def check_humanleague_result(result, marginals, seed=None):
     print(result)  
     raise RuntimeError("humanleague convergence failure") 
 
+def nonzero(tensor):
+  """
+  Returns the indices (one array per dimension) and values of the nonzero elements of tensor, i.e. its sparse (COO) form.
+  Population tensors are large and very sparse, so this should be done once and the tensor discarded
+  """
+  index = np.nonzero(tensor)
+  return list(index), tensor[index]
+
+def flatten(tensor):
+  """
+  Converts a tensor of counts into one index array per dimension with one entry per unit (as humanleague.flatten), by
+  repeating the indices of the nonzero elements only
+  """
+  index, counts = nonzero(tensor)
+  return [np.repeat(i, counts) for i in index]
+
+def aggregate(table):
+  """ Collapses identical rows of table into a single row with the number of occurrences in a Count column """
+  cols = [col for col in table.columns.values if col != "Count"]
+  return table.groupby(cols, sort=False).size().reset_index(name="Count")
+
+def expand(table):
+  """ Converts an aggregated table (see aggregate) into one row per unit, dropping the Count column """
+  rows = np.repeat(np.arange(len(table)), table.Count.values.astype(int))
+  return table.drop("Count", axis=1).iloc[rows].reset_index(drop=True)
+
+def hh_file(output_dir, region, resolution, aggregate=False, period="2011"):
+  """ The csv file of a household population (aggregated populations, see aggregate, have an _agg suffix) """
+  return output_dir + "/hh_" + region + "_" + resolution + "_" + period + ("_agg" if aggregate else "") + ".csv"
+
+def attach(tenure, table, rng, conditional=True):
+  """
+  Assigns the units of table (a tensor of counts whose first dimension is tenure) to a population with the given tenure
+  indices, by shuffling the table's units and dealing them out to the population within each tenure. The table's totals
+  are therefore met exactly. If not conditional the table has no tenure dimension and is dealt out over the whole
+  population. Returns the indices (one array per remaining dimension of table) for each member of the population
+  """
+  cells = flatten(table)
+  if not conditional:
+    tenure = np.zeros(len(tenure), dtype=int)
+    cells = [np.zeros(len(cells[0]), dtype=int)] + cells
+  # randomly ordered within tenure
+  cell_order = np.lexsort((rng.random_sample(len(cells[0])), cells[0]))
+  order = np.argsort(tenure, kind="mergesort")
+  if not np.array_equal(cells[0][cell_order], np.asarray(tenure)[order]):
+    raise ValueError("table totals do not match the population by tenure")
+  result = []
+  for dim in cells[1:]:
+    values = np.empty(len(tenure), dtype=int)
+    values[order] = dim[cell_order]
+    result.append(values)
+  return result
+
+def area_tensor(table, areas, cols, mappings, vals="OBS_VALUE", area_col="GEOGRAPHY_CODE"):
+  """
+  Returns the values of a census table (or the counts of rows of a population if vals is None) for all areas as a single
+  tensor, indexed by the position of the area in areas then the position of the category value of each of cols in the
+  corresponding mapping. Rows with values not in areas or the mappings are ignored
+  """
+  tensor = np.zeros([len(areas)] + [len(m) for m in mappings], dtype=int)
+  index = [pd.Index(areas).get_indexer(table[area_col].values)]
+  index += [pd.Index(m).get_indexer(table[c].values) for c, m in zip(cols, mappings)]
+  index = tuple(np.asarray(i) for i in index)
+  valid = np.all([i >= 0 for i in index], axis=0)
+  values = np.ones(len(table), dtype=int) if vals is None else table[vals].values.astype(int)
+  np.add.at(tensor, tuple(i[valid] for i in index), values[valid])
+  return tensor
+
 def unmap(values, mapping):
   """
   Converts values (census category enumerations)
@@ -54,10 +205,7 @@ def remap(indices, mapping):
   """
   Converts array of index values back into category values
   """
-  values = []
-  for i in range(0,len(indices)):
-    values.append(mapping[indices[i]])
-  return values
+  return np.asarray(mapping)[np.asarray(indices, dtype=int)]
 
 def unlistify(table, cols, sizes, vals):
   if len(cols) == 1:
@@ -105,15 +253,36 @@ def cap_value(table, colname, maxval, sumcolname):
 
   return table_under.append(table_over)
 
+# upper bounds of the persons per bedroom categories (LC4408EW C_PPBROOMHEW11) 1-3, category 4 being over 1.5
+PPBROOM_BOUNDS = np.array([0.5, 1.0, 1.5])
+
 def people_per_bedroom(people, bedrooms):
-  ppbed = people / bedrooms
-  if ppbed <= 0.5:
-    return 1 # (0,0.5]
-  if ppbed <= 1:
-    return 2 # (0.5, 1]
-  if ppbed <= 1.5:
-    return 3 # (1, 1.5]
-  return 4 # >1.5
+  """ Persons per bedroom category: 1 (0,0.5], 2 (0.5,1], 3 (1,1.5], 4 >1.5. Works elementwise on arrays """
+  return np.searchsorted(PPBROOM_BOUNDS, np.divide(people, bedrooms)) + 1
+
+def people_per_bedroom_category(occupants, bedrooms, unknown, max_occupants=4, max_bedrooms=4):
+  """
+  Persons per bedroom category (see people_per_bedroom) of each household, from its occupants and bedrooms categories,
+  the highest of which (max_occupants, max_bedrooms) mean that many or more. The category is unknown where this makes it
+  ambiguous (e.g. 3 occupants in 4+ bedrooms) or either value is not a count (e.g. no bedroom data)
+  """
+  occupants = np.asarray(occupants, dtype=float)
+  bedrooms = np.asarray(bedrooms, dtype=float)
+  valid = (occupants > 0) & (bedrooms > 0)
+  with np.errstate(divide="ignore", invalid="ignore"):
+    lowest = people_per_bedroom(occupants, np.where(bedrooms >= max_bedrooms, np.inf, bedrooms))
+    highest = people_per_bedroom(np.where(occupants >= max_occupants, np.inf, occupants), bedrooms)
+  return np.where(valid & (lowest == highest), lowest, unknown)
+
+def check_ppbroom(counts, lc4408ppb):
+  """
+  Checks the persons per bedroom of the occupied households (counts, a Series of the number of households by category)
+  against the census marginal (LC4408EW). The category is derived, and only known where the capped occupants and
+  bedrooms determine it, so each category can be no more than the census count. Unknown and n/a codes are skipped
+  """
+  for i in lc4408ppb.C_PPBROOMHEW11.unique():
+    assert counts.get(i, 0) <= lc4408ppb[lc4408ppb.C_PPBROOMHEW11 == i].OBS_VALUE.sum()
+  return True
 
 # make assumption on economic status of residents of different types of communal residence
 def communal_economic_status(communal_type):
@@ -167,11 +336,23 @@ def communal_economic_status(communal_type):
   }
   return communal_econ_map[communal_type]
 
+def even_split(total, n):
+  """ Divides total into n integer parts as evenly as possible (the integerisation of a uniform distribution) """
+  return np.full(n, total // n, dtype=np.int64) + (np.arange(n) < total % n)
+
 # TODO asserts are not the best idea here as it will bale immediately
 def check_hh(msynth, total_occ_dwellings, total_households, total_communal, total_household_poplb, total_communal_pop, scotland=False):
+  # rows of aggregated output represent Count dwellings
+  if "Count" in msynth.dwellings.columns:
+    weights = msynth.dwellings.Count
+  else:
+    weights = pd.Series(1, index=msynth.dwellings.index)
+  def count(mask):
+    return weights[mask].sum()
+
   # correct number of dwellings
   #print(len(msynth.dwellings), msynth.total_dwellings)
-  assert len(msynth.dwellings) == msynth.total_dwellings
+  assert weights.sum() == msynth.total_dwellings
   # check no missing/NaN values
   assert not pd.isnull(msynth.dwellings).values.any()
 
@@ -182,51 +363,60 @@ def check_hh(msynth, total_occ_dwellings, total_households, total_communal, tota
   assert np.array_equal(sorted(msynth.dwellings.LC4408_C_AHTHUK11.unique()), np.insert(msynth.comp_index, 0, [msynth.UNKNOWN]))
   #assert np.array_equal(sorted(msynth.dwellings.LC4408_C_PPBROOMH11.unique()), msynth.ppb_index)
   assert np.array_equal(sorted(msynth.dwellings.LC4402_C_CENHEATHUK11.unique()), msynth.ch_index)
+  # persons per bedroom is derived, so can be unknown (and is n/a for communal and unoccupied dwellings)
+  assert set(msynth.dwellings.LC4408EW_C_PPBROOMHEW11.unique()) <= set([msynth.NOTAPPLICABLE, msynth.UNKNOWN, 1, 2, 3, 4])
+  if msynth.lc4408ppb is not None:
+    occupied = (msynth.dwellings.QS420_CELL == msynth.NOTAPPLICABLE) & (msynth.dwellings.LC4404_C_SIZHUK11 != 0)
+    assert check_ppbroom(weights[occupied].groupby(msynth.dwellings.LC4408EW_C_PPBROOMHEW11[occupied]).sum(), msynth.lc4408ppb)
 
   # occupied/unoccupied/communal dwelling totals correct
-  assert len(msynth.dwellings[(msynth.dwellings.QS420_CELL == msynth.NOTAPPLICABLE)
-                            & (msynth.dwellings.LC4404_C_SIZHUK11 != 0)]) == total_occ_dwellings
-  assert len(msynth.dwellings[(msynth.dwellings.QS420_CELL == msynth.NOTAPPLICABLE)
-                            & (msynth.dwellings.LC4404_C_SIZHUK11 == 0)]) == total_households - total_occ_dwellings
-  assert len(msynth.dwellings[msynth.dwellings.QS420_CELL != msynth.NOTAPPLICABLE]) == total_communal
+  assert count((msynth.dwellings.QS420_CELL == msynth.NOTAPPLICABLE)
+                            & (msynth.dwellings.LC4404_C_SIZHUK11 != 0)) == total_occ_dwellings
+  assert count((msynth.dwellings.QS420_CELL == msynth.NOTAPPLICABLE)
+                            & (msynth.dwellings.LC4404_C_SIZHUK11 == 0)) == total_households - total_occ_dwellings
+  assert count(msynth.dwellings.QS420_CELL != msynth.NOTAPPLICABLE) == total_communal
 
   # occupied/unoccupied/communal occupants totals correct
-  assert msynth.dwellings[(msynth.dwellings.QS420_CELL == msynth.NOTAPPLICABLE)
-                            & (msynth.dwellings.LC4404_C_SIZHUK11 != 0)].LC4404_C_SIZHUK11.sum() == total_household_poplb
+  assert (msynth.dwellings.LC4404_C_SIZHUK11 * weights)[(msynth.dwellings.QS420_CELL == msynth.NOTAPPLICABLE)
+                            & (msynth.dwellings.LC4404_C_SIZHUK11 != 0)].sum() == total_household_poplb
   assert msynth.dwellings[(msynth.dwellings.QS420_CELL == msynth.NOTAPPLICABLE)
                             & (msynth.dwellings.LC4404_C_SIZHUK11 == 0)].LC4404_C_SIZHUK11.sum() == 0
   if not scotland:
-    assert msynth.dwellings[msynth.dwellings.QS420_CELL != msynth.NOTAPPLICABLE].CommunalSize.sum() == total_communal_pop
+    assert (msynth.dwellings.CommunalSize * weights)[msynth.dwellings.QS420_CELL != msynth.NOTAPPLICABLE].sum() \
+      == total_communal_pop
 
 
   # Build (accomodation) type (occupied only)
   for i in msynth.type_index:
-    assert len(msynth.dwellings[(msynth.dwellings.LC4402_C_TYPACCOM == i)
-                              & (msynth.dwellings.LC4404_C_SIZHUK11 != 0)]) == sum(msynth.lc4402[msynth.lc4402.C_TYPACCOM == i].OBS_VALUE)
+    assert count((msynth.dwellings.LC4402_C_TYPACCOM == i)
+                 & (msynth.dwellings.LC4404_C_SIZHUK11 != 0)) == sum(msynth.lc4402[msynth.lc4402.C_TYPACCOM == i].OBS_VALUE)
 
   # Tenure (occupied only)
   for i in msynth.tenure_index:
-    assert len(msynth.dwellings[(msynth.dwellings.LC4402_C_TENHUK11 == i)
-                              & (msynth.dwellings.LC4404_C_SIZHUK11 != 0)]) == sum(msynth.lc4402[msynth.lc4402.C_TENHUK11 == i].OBS_VALUE)
+    assert count((msynth.dwellings.LC4402_C_TENHUK11 == i)
+                 & (msynth.dwellings.LC4404_C_SIZHUK11 != 0)) == sum(msynth.lc4402[msynth.lc4402.C_TENHUK11 == i].OBS_VALUE)
 
   # central heating (ignoring unoccupied and communal)
   for i in msynth.ch_index:
-    assert len(msynth.dwellings[(msynth.dwellings.LC4402_C_CENHEATHUK11 == i)
-                              & (msynth.dwellings.LC4404_C_SIZHUK11 != 0)
-                              & (msynth.dwellings.QS420_CELL == msynth.NOTAPPLICABLE)]) == sum(msynth.lc4402[msynth.lc4402.C_CENHEATHUK11 == i].OBS_VALUE)
+    assert count((msynth.dwellings.LC4402_C_CENHEATHUK11 == i)
+                 & (msynth.dwellings.LC4404_C_SIZHUK11 != 0)
+                 & (msynth.dwellings.QS420_CELL == msynth.NOTAPPLICABLE)) \
+      == sum(msynth.lc4402[msynth.lc4402.C_CENHEATHUK11 == i].OBS_VALUE)
 
   # # composition
   for i in msynth.comp_index:
-    assert len(msynth.dwellings[(msynth.dwellings.LC4408_C_AHTHUK11 == i)
-                             & (msynth.dwellings.LC4404_C_SIZHUK11 != 0)
-                             & (msynth.dwellings.QS420_CELL == msynth.NOTAPPLICABLE)]),  sum(msynth.lc4408[msynth.lc4408.C_AHTHUK11 == i].OBS_VALUE)
+    assert count((msynth.dwellings.LC4408_C_AHTHUK11 == i)
+                 & (msynth.dwellings.LC4404_C_SIZHUK11 != 0)
+                 & (msynth.dwellings.QS420_CELL == msynth.NOTAPPLICABLE)), \
+      sum(msynth.lc4408[msynth.lc4408.C_AHTHUK11 == i].OBS_VALUE)
 
   # Rooms (ignoring communal and unoccupied)
   assert np.array_equal(sorted(msynth.dwellings[msynth.dwellings.LC4402_C_TYPACCOM != msynth.NOTAPPLICABLE].LC4404_C_ROOMS.unique()), msynth.lc4404["C_ROOMS"].unique())
   for i in msynth.lc4404["C_ROOMS"].unique():
-    assert len(msynth.dwellings[(msynth.dwellings.LC4404_C_ROOMS == i)
-                              & (msynth.dwellings.LC4404_C_SIZHUK11 != 0)
-                              & (msynth.dwellings.QS420_CELL == msynth.NOTAPPLICABLE)]) == sum(msynth.lc4404[msynth.lc4404.C_ROOMS == i].OBS_VALUE)
+    assert count((msynth.dwellings.LC4404_C_ROOMS == i)
+                 & (msynth.dwellings.LC4404_C_SIZHUK11 != 0)
+                 & (msynth.dwellings.QS420_CELL == msynth.NOTAPPLICABLE)) \
+      == sum(msynth.lc4404[msynth.lc4404.C_ROOMS == i].OBS_VALUE)
   # check communal residences rooms are all UNKNOWN
   assert(msynth.dwellings[msynth.dwellings.CommunalSize != msynth.NOTAPPLICABLE].LC4404_C_ROOMS.unique() == msynth.UNKNOWN)
   # == msynth.UNKNOWN)
@@ -236,9 +426,10 @@ def check_hh(msynth, total_occ_dwellings, total_households, total_communal, tota
   # Bedrooms (ignoring communal and unoccupied)
   assert np.array_equal(sorted(msynth.dwellings[msynth.dwellings.LC4402_C_TYPACCOM != msynth.NOTAPPLICABLE].LC4405EW_C_BEDROOMS.unique()), msynth.lc4405["C_BEDROOMS"].unique())
   for i in msynth.lc4405["C_BEDROOMS"].unique():
-    assert len(msynth.dwellings[(msynth.dwellings.LC4405EW_C_BEDROOMS == i)
-                             & (msynth.dwellings.LC4404_C_SIZHUK11 != 0)
-                             & (msynth.dwellings.QS420_CELL == msynth.NOTAPPLICABLE)]) == sum(msynth.lc4405[msynth.lc4405.C_BEDROOMS == i].OBS_VALUE)
+    assert count((msynth.dwellings.LC4405EW_C_BEDROOMS == i)
+                 & (msynth.dwellings.LC4404_C_SIZHUK11 != 0)
+                 & (msynth.dwellings.QS420_CELL == msynth.NOTAPPLICABLE)) \
+      == sum(msynth.lc4405[msynth.lc4405.C_BEDROOMS == i].OBS_VALUE)
   # check communal residences bedrooms are all UNKNOWN
   assert(msynth.dwellings[msynth.dwellings.CommunalSize != msynth.NOTAPPLICABLE].LC4405EW_C_BEDROOMS.unique() == msynth.UNKNOWN)
   # check unoccupied residences bedrooms are all "known"
@@ -249,25 +440,28 @@ def check_hh(msynth, total_occ_dwellings, total_households, total_communal, tota
   # Economic status (might be small diffs) (ignoring communal and unoccupied)
   assert np.array_equal(sorted(msynth.dwellings[msynth.dwellings.LC4605_C_NSSEC != msynth.UNKNOWN].LC4605_C_NSSEC.unique()), msynth.lc4605["C_NSSEC"].unique())
   for i in msynth.lc4605["C_NSSEC"].unique():
-    assert len(msynth.dwellings[(msynth.dwellings.LC4605_C_NSSEC == i)
-                             & (msynth.dwellings.LC4404_C_SIZHUK11 != 0)
-                             & (msynth.dwellings.QS420_CELL == msynth.NOTAPPLICABLE)]) >= sum(msynth.lc4605[msynth.lc4605["C_NSSEC"] == i].OBS_VALUE)
+    assert count((msynth.dwellings.LC4605_C_NSSEC == i)
+                 & (msynth.dwellings.LC4404_C_SIZHUK11 != 0)
+                 & (msynth.dwellings.QS420_CELL == msynth.NOTAPPLICABLE)) \
+      >= sum(msynth.lc4605[msynth.lc4605["C_NSSEC"] == i].OBS_VALUE)
 
   # Ethnicity (ignoring communal and unoccupied)
   # Need to omit OB_VALIUE=0 entries in LC4202 as can break regions where not all ethnicities present e.g. Scilly Isles
   assert np.array_equal(sorted(msynth.dwellings[msynth.dwellings.LC4202_C_ETHHUK11 != msynth.UNKNOWN].LC4202_C_ETHHUK11.unique()), 
                         sorted(msynth.lc4202[msynth.lc4202.OBS_VALUE>0].C_ETHHUK11.unique()))
   for i in msynth.lc4202["C_ETHHUK11"].unique():
-    assert len(msynth.dwellings[(msynth.dwellings.LC4202_C_ETHHUK11 == i)
-                             & (msynth.dwellings.LC4404_C_SIZHUK11 != 0)
-                             & (msynth.dwellings.QS420_CELL == msynth.NOTAPPLICABLE)]) == sum(msynth.lc4202[msynth.lc4202["C_ETHHUK11"] == i].OBS_VALUE)
+    assert count((msynth.dwellings.LC4202_C_ETHHUK11 == i)
+                 & (msynth.dwellings.LC4404_C_SIZHUK11 != 0)
+                 & (msynth.dwellings.QS420_CELL == msynth.NOTAPPLICABLE)) \
+      == sum(msynth.lc4202[msynth.lc4202["C_ETHHUK11"] == i].OBS_VALUE)
 
  # Cars (ignoring communal and unoccupied)
   assert np.array_equal(sorted(msynth.dwellings[msynth.dwellings.LC4202_C_CARSNO != msynth.UNKNOWN].LC4202_C_CARSNO.unique()), msynth.lc4202["C_CARSNO"].unique())
   for i in msynth.lc4202["C_CARSNO"].unique():
-    assert len(msynth.dwellings[(msynth.dwellings.LC4202_C_CARSNO == i)
-                             & (msynth.dwellings.LC4404_C_SIZHUK11 != 0)
-                             & (msynth.dwellings.QS420_CELL == msynth.NOTAPPLICABLE)]) == sum(msynth.lc4202[msynth.lc4202["C_CARSNO"] == i].OBS_VALUE)
+    assert count((msynth.dwellings.LC4202_C_CARSNO == i)
+                 & (msynth.dwellings.LC4404_C_SIZHUK11 != 0)
+                 & (msynth.dwellings.QS420_CELL == msynth.NOTAPPLICABLE)) \
+      == sum(msynth.lc4202[msynth.lc4202["C_CARSNO"] == i].OBS_VALUE)
 
   return True
 
@@ -328,4 +522,118 @@ def check_hrp(msynth, total_hrps):
     print("\n".join(failures))
     raise RuntimeError("Consistency checks failed, see log for further details")
 
-  return True
\ No newline at end of file
+  return True
+
+def _tally(tallies, name, values):
+  """ Adds the value counts of values to the named running tally """
+  counts = pd.Series(values).value_counts()
+  tallies[name] = counts if name not in tallies else tallies[name].add(counts, fill_value=0)
+
+def _tally_count(tallies, name, value):
+  if name not in tallies or value not in tallies[name].index:
+    return 0
+  return tallies[name][value]
+
+def check_hh_store(msynth, total_occ_dwellings, total_households, total_communal, total_household_poplb, total_communal_pop,
+                   block_size, scotland=False):
+  """
+  Equivalent of check_hh for a population held in a (memory-mapped) store. The population is read in blocks of block_size
+  rows, from which running totals are accumulated, then checked against the census tables
+  """
+  assert msynth.store.index == msynth.total_dwellings
+
+  na = msynth.NOTAPPLICABLE
+  unk = msynth.UNKNOWN
+  totals = {"occupied": 0, "unoccupied": 0, "communal": 0, "occupied_pop": 0, "unoccupied_pop": 0, "communal_pop": 0,
+            "unoccupied_min_rooms": np.inf, "unoccupied_min_beds": np.inf}
+  tallies = {}
+  for block in msynth.store.blocks(block_size):
+    household = (block.QS420_CELL == na).values
+    occupied = household & (block.LC4404_C_SIZHUK11 != 0).values
+    unoccupied = household & (block.LC4404_C_SIZHUK11 == 0).values
+    communal = ~household
+    built = (block.LC4402_C_TYPACCOM != na).values
+
+    totals["occupied"] += occupied.sum()
+    totals["unoccupied"] += unoccupied.sum()
+    totals["communal"] += communal.sum()
+    totals["occupied_pop"] += block.LC4404_C_SIZHUK11.values[occupied].sum()
+    totals["unoccupied_pop"] += block.LC4404_C_SIZHUK11.values[unoccupied].sum()
+    totals["communal_pop"] += block.CommunalSize.values[communal].sum()
+    if unoccupied.any():
+      totals["unoccupied_min_rooms"] = min(totals["unoccupied_min_rooms"], block.LC4404_C_ROOMS.values[unoccupied].min())
+      totals["unoccupied_min_beds"] = min(totals["unoccupied_min_beds"], block.LC4405EW_C_BEDROOMS.values[unoccupied].min())
+
+    for col in ["LC4402_C_TYPACCOM", "LC4402_C_TENHUK11", "LC4408_C_AHTHUK11", "LC4402_C_CENHEATHUK11", "LC4404_C_ROOMS",
+                "LC4405EW_C_BEDROOMS", "LC4408EW_C_PPBROOMHEW11", "LC4605_C_NSSEC", "LC4202_C_ETHHUK11", "LC4202_C_CARSNO"]:
+      _tally(tallies, col, block[col].values)
+      _tally(tallies, col + "_occupied", block[col].values[occupied])
+    for col in ["LC4404_C_ROOMS", "LC4405EW_C_BEDROOMS"]:
+      _tally(tallies, col + "_built", block[col].values[built])
+      _tally(tallies, col + "_communal", block[col].values[(block.CommunalSize != na).values])
+
+  def values(name, exclude=()):
+    return sorted(v for v in tallies[name].index.values if tallies[name][v] > 0 and v not in exclude)
+
+  # category values are within those expected, including unknown/n/a where permitted
+  assert np.array_equal(values("LC4402_C_TYPACCOM"), np.insert(msynth.type_index, 0, [na]))
+  assert np.array_equal(values("LC4402_C_TENHUK11"), np.insert(msynth.tenure_index, 0, [na, unk]))
+  assert np.array_equal(values("LC4408_C_AHTHUK11"), np.insert(msynth.comp_index, 0, [unk]))
+  assert np.array_equal(values("LC4402_C_CENHEATHUK11"), msynth.ch_index)
+
+  # occupied/unoccupied/communal dwelling and occupant totals correct
+  assert totals["occupied"] == total_occ_dwellings
+  assert totals["unoccupied"] == total_households - total_occ_dwellings
+  assert totals["communal"] == total_communal
+  assert totals["occupied_pop"] == total_household_poplb
+  assert totals["unoccupied_pop"] == 0
+  if not scotland:
+    assert totals["communal_pop"] == total_communal_pop
+
+  # category totals (occupied only)
+  for i in msynth.type_index:
+    assert _tally_count(tallies, "LC4402_C_TYPACCOM_occupied", i) == sum(msynth.lc4402[msynth.lc4402.C_TYPACCOM == i].OBS_VALUE)
+  for i in msynth.tenure_index:
+    assert _tally_count(tallies, "LC4402_C_TENHUK11_occupied", i) == sum(msynth.lc4402[msynth.lc4402.C_TENHUK11 == i].OBS_VALUE)
+  for i in msynth.ch_index:
+    assert _tally_count(tallies, "LC4402_C_CENHEATHUK11_occupied", i) \
+      == sum(msynth.lc4402[msynth.lc4402.C_CENHEATHUK11 == i].OBS_VALUE)
+
+  # Rooms
+  assert np.array_equal(values("LC4404_C_ROOMS_built"), msynth.lc4404["C_ROOMS"].unique())
+  for i in msynth.lc4404["C_ROOMS"].unique():
+    assert _tally_count(tallies, "LC4404_C_ROOMS_occupied", i) == sum(msynth.lc4404[msynth.lc4404.C_ROOMS == i].OBS_VALUE)
+  assert values("LC4404_C_ROOMS_communal") in ([], [unk])
+  assert totals["unoccupied_min_rooms"] > 0
+
+  # Bedrooms
+  assert np.array_equal(values("LC4405EW_C_BEDROOMS_built"), msynth.lc4405["C_BEDROOMS"].unique())
+  for i in msynth.lc4405["C_BEDROOMS"].unique():
+    assert _tally_count(tallies, "LC4405EW_C_BEDROOMS_occupied", i) \
+      == sum(msynth.lc4405[msynth.lc4405.C_BEDROOMS == i].OBS_VALUE)
+  assert values("LC4405EW_C_BEDROOMS_communal") in ([], [unk])
+  if not scotland:
+    assert totals["unoccupied_min_beds"] > 0
+
+  # Persons per bedroom (derived, see check_ppbroom)
+  if msynth.lc4408ppb is not None:
+    assert check_ppbroom(tallies["LC4408EW_C_PPBROOMHEW11_occupied"], msynth.lc4408ppb)
+
+  # Economic status (might be small diffs)
+  assert np.array_equal(values("LC4605_C_NSSEC", [unk]), msynth.lc4605["C_NSSEC"].unique())
+  for i in msynth.lc4605["C_NSSEC"].unique():
+    assert _tally_count(tallies, "LC4605_C_NSSEC_occupied", i) >= sum(msynth.lc4605[msynth.lc4605["C_NSSEC"] == i].OBS_VALUE)
+
+  # Ethnicity
+  assert np.array_equal(values("LC4202_C_ETHHUK11", [unk]),
+                        sorted(msynth.lc4202[msynth.lc4202.OBS_VALUE>0].C_ETHHUK11.unique()))
+  for i in msynth.lc4202["C_ETHHUK11"].unique():
+    assert _tally_count(tallies, "LC4202_C_ETHHUK11_occupied", i) \
+      == sum(msynth.lc4202[msynth.lc4202["C_ETHHUK11"] == i].OBS_VALUE)
+
+  # Cars
+  assert np.array_equal(values("LC4202_C_CARSNO", [unk]), msynth.lc4202["C_CARSNO"].unique())
+  for i in msynth.lc4202["C_CARSNO"].unique():
+    assert _tally_count(tallies, "LC4202_C_CARSNO_occupied", i) == sum(msynth.lc4202[msynth.lc4202["C_CARSNO"] == i].OBS_VALUE)
+
+  return True
@@ -18,5 +18,5 @@ fi
 #$ -l h_vmem=2G
 #$ -pe smp 1 
 ##$ -l node_type=256thread-112G 
-python3 scripts/run_microsynth.py $REGION OA11
+python3 scripts/run_microsynth.py $REGION OA11 --max-memory 1024
 
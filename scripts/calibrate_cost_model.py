@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+
+"""
+calibrates the cost model used by run_microsynth.py --estimate from the progress events of past runs, e.g.
+scripts/calibrate_cost_model.py logs/*_progress.jsonl
+"""
+
+import argparse
+import pandas as pd
+import household_microsynth.estimate as estimate
+import household_microsynth.progress as progress
+
+def main(params):
+  """ Entry point """
+  history = pd.concat([estimate.runs(progress.read_events(f)) for f in params.events], ignore_index=True)
+  print(history.to_string(index=False))
+  estimate.save(estimate.calibrate(history), params.output)
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser(description="household microsynthesis cost model calibration")
+  parser.add_argument("events", type=str, nargs="+",
+                      help="progress event files (see run_microsynth.py --progress) of past runs")
+  parser.add_argument("--output", type=str, default="./data/cost_model.json", help="the cost model file to write")
+
+  args = parser.parse_args()
+
+  main(args)
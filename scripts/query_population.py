@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+
+"""
+query script for synthetic populations, e.g. owner-occupied semis without central heating by LSOA:
+scripts/query_population.py data/hh_*_OA11_2011.csv --where LC4402_C_TENHUK11=2 LC4402_C_TYPACCOM=3 \
+  LC4402_C_CENHEATHUK11=1 --by LSOA11
+"""
+
+import argparse
+import household_microsynth.query as query
+
+def main(params):
+  """ Entry point """
+  where = {}
+  for predicate in params.where:
+    col, values = predicate.split("=", 1)
+    where[col] = values.split(",")
+  population = query.Query(params.files)
+  if params.by:
+    print(population.crosstab(params.by, where).to_csv(index=False), end="")
+  else:
+    print(population.count(where))
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser(description="synthetic population query")
+  parser.add_argument("files", type=str, nargs="+", help="population csv files (each is indexed the first time it is queried)")
+  parser.add_argument("--where", type=str, nargs="*", default=[],
+                      help="predicates, e.g. LC4402_C_TENHUK11=2,3 (any of the values)")
+  parser.add_argument("--by", type=str, nargs="*", default=[],
+                      help="columns to cross-tabulate by (otherwise the total count is printed)")
+
+  args = parser.parse_args()
+
+  main(args)
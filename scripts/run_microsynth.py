@@ -6,13 +6,24 @@ run script for Household microsynthesis
 
 import sys
 import time
+import json
 import argparse
 import traceback
+import numpy as np
+import pandas as pd
 import humanleague
 #import ukcensusapi.Nomisweb as Api
 import household_microsynth.household as hh_msynth
 import household_microsynth.ref_person as hrp_msynth
 import household_microsynth.utils as Utils
+import household_microsynth.linkage as linkage
+import household_microsynth.store as store
+import household_microsynth.memprof as memprof
+import household_microsynth.geography as geography
+import household_microsynth.pipeline as pipeline
+import household_microsynth.fit as fit
+import household_microsynth.estimate as estimate
+import household_microsynth.preview as preview
 
 assert int(humanleague.version().split(".")[0]) > 1
 CACHE_DIR = "./cache"
@@ -33,28 +44,134 @@ OUTPUT_DIR = "./data"
 
 def main(params):
   """ Entry point """
-  if not params.no_hh:
-    do_hh(params.region, params.resolution)
-  if params.do_hrp:
-    do_hrp(params.region, params.resolution)
-
-def do_hh(region, resolution):
-  """ Do households """
+  if params.estimate:
+    do_estimate(params.region.split(","), params.resolution, params.cost_model, params.job_hours, params.engine,
+                params.aggregate)
+    return
+  hh = hrp = None
+  solver_settings = None
+  if params.solver_config is not None:
+    with open(params.solver_config) as config:
+      solver_settings = json.load(config)
+  hierarchy = None
+  if params.geography is not None:
+    if params.resolution != geography.LEVELS[0]:
+      raise ValueError("--geography requires resolution " + geography.LEVELS[0])
+    if params.max_memory is not None:
+      raise ValueError("--geography cannot be used with --max-memory")
+    hierarchy = geography.load(params.geography, CACHE_DIR)
+  # progress events as JSON lines (appended, so that a scheduler can follow the file)
+  events = None if params.progress is None else open(params.progress, "a")
+  if params.preview is not None:
+    do_preview(params.region, params.resolution, params.preview, params.preview_compare, params.seed, params.engine,
+               solver_settings)
+  elif params.replicates:
+    if params.max_memory is not None or params.do_hrp:
+      raise ValueError("--replicates cannot be used with --max-memory or --do-hrp")
+    do_replicates(params.region, params.resolution, params.replicates, params.workers, params.seed, params.engine,
+                  solver_settings, hierarchy)
+  elif not params.no_hh and params.do_hrp:
+    hh, hrp = do_both(params.region, params.resolution, params.workers, params.max_memory, params.seed, params.aggregate,
+                      params.engine, solver_settings, params.autotune, events, params.memory_profile, hierarchy)
+  elif not params.no_hh:
+    hh = do_hh(params.region, params.resolution, params.workers, params.max_memory, params.seed, params.aggregate,
+               params.engine, solver_settings, params.autotune, events, params.memory_profile, hierarchy)
+  elif params.do_hrp:
+    hrp = do_hrp(params.region, params.resolution, params.seed, solver_settings, params.autotune, events, params.memory_profile,
+                 hierarchy)
+  if events is not None:
+    events.close()
+  if params.link:
+    do_link(params.region, params.resolution, hh, hrp, params.seed, params.aggregate)
+
+def do_hh(region, resolution, workers=1, max_memory=None, seed=0, aggregate=False, engine="joint", solver_settings=None,
+          autotune=0, events=None, memory_profile=False, hierarchy=None):
+  """
+  Do households (holding the population in a memory-mapped store if max_memory (MB) is specified, or as distinct dwellings
+  with counts if aggregate is set). If a geography hierarchy is given, the output has the parent codes of each OA
+  """
 
   # # start timing
   start_time = time.time()
+  memory = memprof.MemoryProfile() if memory_profile else None
 
   print("Microsynthesis target: households")
   print("Microsynthesis region:", region)
   print("Microsynthesis resolution:", resolution)
   # init microsynthesis
   try:
-    msynth = hh_msynth.Household(region, resolution, CACHE_DIR)
+    store_dir = None if max_memory is None else OUTPUT_DIR + "/store_" + region + "_" + resolution
+    msynth = hh_msynth.Household(region, resolution, CACHE_DIR, workers, store_dir, seed, aggregate, engine, solver_settings)
   except Exception as error:
     print(traceback.format_exc())
     return
-  
-  # Do some basic checks on totals
+  if memory is not None:
+    memory.stage("census")
+
+  totals = check_hh_inputs(msynth)
+
+  # generate the population
+  try:
+    if autotune:
+      msynth.autotune(autotune)
+    msynth.run(events, memory)
+  except Exception as error:
+    print(traceback.format_exc())
+    raise error
+  if memory is not None:
+    memory.stage("synthesis")
+
+  print("Done. Exec time(s): ", time.time() - start_time)
+  write_hh(msynth, totals, region, resolution, max_memory, aggregate, memory, hierarchy)
+  return msynth
+
+def do_replicates(region, resolution, replicates, workers=1, seed=0, engine="joint", solver_settings=None, hierarchy=None):
+  """
+  Generates replicates of the household population (see Household.replicates), checking each, and writes them as
+  aggregated rows with a Replicate column
+  """
+  start_time = time.time()
+  print("Microsynthesis target: households (%d replicates)" % replicates)
+  print("Microsynthesis region:", region)
+  print("Microsynthesis resolution:", resolution)
+  msynth = hh_msynth.Household(region, resolution, CACHE_DIR, workers, None, seed, True, engine, solver_settings)
+  totals = check_hh_inputs(msynth)
+  population = msynth.replicates(replicates, workers)
+  print("Done. Exec time(s): ", time.time() - start_time)
+
+  print("Checking consistency")
+  for r, replicate in population.groupby("Replicate", sort=True):
+    msynth.dwellings = replicate.drop("Replicate", axis=1)
+    if not Utils.check_hh(msynth, *totals, msynth.scotland):
+      raise RuntimeError("Consistency check failed for replicate %d" % r)
+  msynth.reset()
+  print("ok")
+  output = OUTPUT_DIR + "/hh_" + region + "_" + resolution + "_2011_replicates.csv"
+  print("Writing %d replicates to %s" % (replicates, output))
+  if hierarchy is not None:
+    population = hierarchy.annotate(population)
+  population.to_csv(output, index_label="HID")
+  print("DONE")
+
+def do_preview(region, resolution, fraction=1.0, compare=False, seed=0, engine="joint", solver_settings=None):
+  """
+  Previews the households of a fraction of the areas (see preview.py), printing the fit (and, if compare is set, the
+  loss against the full method) and writing the (aggregated) preview
+  """
+  print("Microsynthesis target: households (preview of %.0f%% of areas)" % (100 * fraction))
+  print("Microsynthesis region:", region)
+  print("Microsynthesis resolution:", resolution)
+  msynth = hh_msynth.Household(region, resolution, CACHE_DIR, seed=seed, aggregate=True, engine=engine,
+                               solver_settings=solver_settings)
+  households, summary = preview.preview(msynth, fraction, compare)
+  print(summary.to_string(index=False))
+  output = OUTPUT_DIR + "/preview_hh_" + region + "_" + resolution + ".csv"
+  print("Writing preview to", output)
+  households.to_csv(output, index_label="HID")
+  print("DONE")
+
+def check_hh_inputs(msynth):
+  """ Basic checks on the household table totals, which are returned for checking the population """
   total_occ_dwellings = sum(msynth.lc4402.OBS_VALUE)
   if not sum(msynth.lc4404.OBS_VALUE) == total_occ_dwellings:
     raise RuntimeError("LC4404 sum mismatch")
@@ -91,46 +208,79 @@ def do_hh(region, resolution):
     print("Count mismatch in table LC4605 ("+str(lc4605_hrps)+ ") will be adjusted. (Likely missing HRPs aged under 16)")
 
   print("Number of geographical areas: ", len(msynth.lc4402.GEOGRAPHY_CODE.unique()))
+  return total_occ_dwellings, total_households, total_communal, occ_pop_lbound, communal_pop
 
-  # generate the population
-  try:
-    msynth.run()
-  except Exception as error:
-    print(traceback.format_exc())
-    raise error
-
-  print("Done. Exec time(s): ", time.time() - start_time)
+def write_hh(msynth, totals, region, resolution, max_memory=None, aggregate=False, memory=None, hierarchy=None):
+  """ Checks the household population against the table totals and writes it (and the solver and memory reports) """
+  write_solver_report(msynth, OUTPUT_DIR + "/solver_hh_" + region + "_" + resolution + ".csv")
 
   print("Checking consistency")
-  success = Utils.check_hh(msynth, total_occ_dwellings, total_households, total_communal, occ_pop_lbound, communal_pop, msynth.scotland)
+  if max_memory is None:
+    success = Utils.check_hh(msynth, *totals, msynth.scotland)
+  else:
+    block_size = store.block_size(max_memory, len(msynth.columns))
+    print("Processing population in blocks of", block_size)
+    success = Utils.check_hh_store(msynth, *totals, block_size, msynth.scotland)
   if success:
     print("ok")
   else:
     print("failed")
     raise RuntimeError("Consistency check failed")
-  output = OUTPUT_DIR + "/hh_" + region + "_" + resolution + "_2011.csv"
+  write_fit(msynth, OUTPUT_DIR + "/fit_hh_" + region + "_" + resolution + ".csv", None if max_memory is None else block_size)
+  if memory is not None:
+    memory.stage("check")
+  output = Utils.hh_file(OUTPUT_DIR, region, resolution, aggregate)
   print("Writing synthetic population to", output)
-  msynth.dwellings.to_csv(output, index_label="HID")
+  if hierarchy is not None:
+    hierarchy.annotate(msynth.dwellings).to_csv(output, index_label="HID")
+  elif max_memory is None:
+    msynth.dwellings.to_csv(output, index_label="HID")
+  else:
+    msynth.store.to_csv(output, block_size, index_label="HID")
+    msynth.store.remove()
+  if memory is not None:
+    memory.stage("write")
+    memory.write(output[:-len(".csv")] + "_memory.json")
   print("DONE")
-  return True
 
-def do_hrp(region, resolution):
-  """ Do household ref persons """
+def do_hrp(region, resolution, seed=0, solver_settings=None, autotune=0, events=None, memory_profile=False, hierarchy=None):
+  """ Do household ref persons (with the parent codes of each OA if a geography hierarchy is given) """
 
   # # start timing
   start_time = time.time()
+  memory = memprof.MemoryProfile() if memory_profile else None
 
   print("Microsynthesis target: household ref persons")
   print("Microsynthesis region:", region)
   print("Microsynthesis resolution:", resolution)
   # init microsynthesis
   try:
-    msynth = hrp_msynth.ReferencePerson(region, resolution, CACHE_DIR)
+    msynth = hrp_msynth.ReferencePerson(region, resolution, CACHE_DIR, seed, solver_settings)
+  except Exception as error:
+    print(error)
+    raise error
+  if memory is not None:
+    memory.stage("census")
+
+  total_hrps = check_hrp_inputs(msynth)
+
+  # generate the population
+  try:
+    if autotune:
+      msynth.autotune(autotune)
+    msynth.run(events, memory)
   except Exception as error:
     print(error)
     raise error
+  if memory is not None:
+    memory.stage("synthesis")
 
-  # Do some basic checks on totals
+  print("Done. Exec time(s): ", time.time() - start_time)
+  write_hrp(msynth, total_hrps, region, resolution, memory, hierarchy)
+  return msynth
+
+def check_hrp_inputs(msynth):
+  """ Basic checks on the household ref person table totals, returning the number of household ref persons """
   # TODO this should probably be in ref_person.py (and use raise not assert)
   total_hrps = sum(msynth.lc4201.OBS_VALUE)
   assert sum(msynth.qs111.OBS_VALUE) == total_hrps
@@ -143,15 +293,11 @@ def do_hrp(region, resolution):
   print("Households: ", total_hrps)
 
   print("Number of geographical areas: ", len(msynth.lc4605.GEOGRAPHY_CODE.unique()))
+  return total_hrps
 
-  # generate the population
-  try:
-    msynth.run()
-  except Exception as error:
-    print(error)
-    raise error
-
-  print("Done. Exec time(s): ", time.time() - start_time)
+def write_hrp(msynth, total_hrps, region, resolution, memory=None, hierarchy=None):
+  """ Checks the household ref person population and writes it (and the solver and memory reports) """
+  write_solver_report(msynth, OUTPUT_DIR + "/solver_hrp_" + region + "_" + resolution + ".csv")
 
   print("Checking consistency")
   success = Utils.check_hrp(msynth, total_hrps)
@@ -159,20 +305,186 @@ def do_hrp(region, resolution):
     print("ok")
   else:
     print("failed")
+  if memory is not None:
+    memory.stage("check")
   output = OUTPUT_DIR + "/hrp_" + region + "_" + resolution + "_2011.csv"
   print("Writing synthetic population to", output)
-  msynth.hrps.to_csv(output)
+  if hierarchy is not None:
+    hierarchy.annotate(msynth.hrps).to_csv(output)
+  else:
+    msynth.hrps.to_csv(output)
+  if memory is not None:
+    memory.stage("write")
+    memory.write(output[:-len(".csv")] + "_memory.json")
+  print("DONE")
+
+def do_both(region, resolution, workers=1, max_memory=None, seed=0, aggregate=False, engine="joint", solver_settings=None,
+            autotune=0, events=None, memory_profile=False, hierarchy=None):
+  """ Do households and household ref persons in a single pass over the areas, sharing the table loading (see do_hh) """
+
+  # # start timing
+  start_time = time.time()
+  memory = memprof.MemoryProfile() if memory_profile else None
+
+  print("Microsynthesis target: households and household ref persons")
+  print("Microsynthesis region:", region)
+  print("Microsynthesis resolution:", resolution)
+  # init microsynthesis
+  try:
+    store_dir = None if max_memory is None else OUTPUT_DIR + "/store_" + region + "_" + resolution
+    msynth = pipeline.Pipeline(region, resolution, CACHE_DIR, workers, store_dir, seed, aggregate, engine, solver_settings)
+  except Exception as error:
+    print(traceback.format_exc())
+    raise error
+  if memory is not None:
+    memory.stage("census")
+
+  hh_totals = check_hh_inputs(msynth.households)
+  total_hrps = check_hrp_inputs(msynth.hrps)
+
+  # generate the populations
+  try:
+    if autotune:
+      msynth.households.autotune(autotune)
+      msynth.hrps.autotune(autotune)
+    msynth.run(events, memory)
+  except Exception as error:
+    print(traceback.format_exc())
+    raise error
+  if memory is not None:
+    memory.stage("synthesis")
+
+  print("Done. Exec time(s): ", time.time() - start_time)
+  # the memory report (of the whole run) is written with the households
+  write_hrp(msynth.hrps, total_hrps, region, resolution, None, hierarchy)
+  write_hh(msynth.households, hh_totals, region, resolution, max_memory, aggregate, memory, hierarchy)
+  return msynth.households, msynth.hrps
+
+def write_solver_report(msynth, output):
+  """ Summarises the solver calls by call site and writes the per-area details """
+  report = msynth.solver.summary()
+  if not len(report):
+    return
+  print(report.groupby("Site").agg({"Time": "sum", "Attempts": "max", "Converged": "mean"}))
+  print("Writing solver report to", output)
+  report.to_csv(output, index=False)
+
+def write_fit(msynth, output, block_size=None):
+  """ Writes the fit of each area to each table, and a summary of each table (see fit.py) """
+  per_area, summary = fit.household_fit(msynth, None if block_size is None else msynth.store.blocks(block_size))
+  print(summary.to_string(index=False))
+  print("Writing fit statistics to", output)
+  per_area.to_csv(output, index=False)
+  summary.to_csv(output[:-len(".csv")] + "_summary.csv", index=False)
+
+def do_estimate(regions, resolution, model_file, job_hours=6.0, engine="joint", aggregate=False):
+  """ Predicts the time and peak memory of the household microsynthesis of each region, and packs them into jobs """
+  model = estimate.load(model_file)
+  rows = []
+  for region in regions:
+    msynth = hh_msynth.Household(region, resolution, CACHE_DIR, engine=engine, aggregate=aggregate)
+    features = estimate.features(msynth)
+    time_s, memory = estimate.predict(model, features)
+    features.update(region=region, time=time_s, memory=memory)
+    rows.append(features)
+  estimates = pd.DataFrame(rows, columns=["region"] + estimate.FEATURES + ["time", "memory"])
+  planned = estimate.plan(estimates, job_hours * 3600)
+  print(planned.to_string(index=False))
+  # resources per job, with a margin for error
+  for job, regions_in_job in planned.groupby("job"):
+    print("job %d: %s -l h_rt=%s -l h_vmem=%dM" % (job, " ".join(regions_in_job.region), _hms(1.25 * regions_in_job.time.sum()),
+                                                  max(1, int(np.ceil(1.25 * regions_in_job.memory.max() / 2**20)))))
+  output = OUTPUT_DIR + "/plan_" + resolution + ".csv"
+  print("Writing job plan to", output)
+  planned.to_csv(output, index=False)
+
+def _hms(seconds):
+  seconds = int(np.ceil(seconds))
+  return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+def do_link(region, resolution, hh=None, hrp=None, seed=0, aggregate=False):
+  """
+  Link household ref persons to households, loading either from previous output if not supplied (the aggregated
+  household output if aggregate is set)
+  """
+
+  start_time = time.time()
+  print("Linking household ref persons to households")
+  if hh is None or hh.dwellings is None:
+    dwellings = pd.read_csv(Utils.hh_file(OUTPUT_DIR, region, resolution, aggregate), index_col="HID")
+  else:
+    dwellings = hh.dwellings
+  # linkage requires one row per dwelling
+  if "Count" in dwellings.columns:
+    dwellings = Utils.expand(dwellings)
+    dwellings.index.name = "HID"
+  if hrp is None:
+    hrps = pd.read_csv(OUTPUT_DIR + "/hrp_" + region + "_" + resolution + "_2011.csv", index_col=0)
+  else:
+    hrps = hrp.hrps
+
+  linked = linkage.link(dwellings, hrps, seed)
+
+  print("Done. Exec time(s): ", time.time() - start_time)
+  output = OUTPUT_DIR + "/hh_hrp_" + region + "_" + resolution + "_2011.csv"
+  print("Writing linked population to", output)
+  linked.to_csv(output, index_label="HID")
   print("DONE")
 
 
 if __name__ == "__main__":
 
   parser = argparse.ArgumentParser(description="household microsynthesis")
-  parser.add_argument("region", type=str, help="the ONS code of the local authority district (LAD) to be covered by the microsynthesis, e.g. E09000001")
-  parser.add_argument("resolution", type=str, help="the geographical resolution of the microsynthesis (e.g. OA11, LSOA11, MSOA11)")
+  parser.add_argument("region", type=str,
+                      help="the ONS code of the local authority district (LAD) to be covered by the "
+                           "microsynthesis, e.g. E09000001 (with --estimate, a comma-separated list)")
+  parser.add_argument("resolution", type=str,
+                      help="the geographical resolution of the microsynthesis (e.g. OA11, LSOA11, MSOA11)")
   # flags for omitting hh and or hrp
   parser.add_argument("--no-hh", action='store_const', const=True, default=False, help="skip household generation")
   parser.add_argument("--do-hrp", action='store_const', const=True, default=False, help="do household ref person generation")
+  parser.add_argument("--link", action='store_const', const=True, default=False,
+                      help="link household ref persons to households (using previous output if not generated in this run)")
+  parser.add_argument("--max-memory", type=int, default=None,
+                      help="hold the household population in memory-mapped files and "
+                           "process it in blocks sized to fit in this many MB")
+  parser.add_argument("--aggregate", action='store_const', const=True, default=False,
+                      help="output one row per distinct dwelling in each area, with a "
+                           "Count column, rather than one row per dwelling")
+  parser.add_argument("--engine", type=str, choices=hh_msynth.Household.ENGINES, default="joint",
+                      help="joint: synthesise all household attributes in one step, conditional: synthesise the core "
+                           "attributes then attach the others within tenure (uses far less memory)")
+  parser.add_argument("--solver-config", type=str, default=None,
+                      help="JSON file of solver settings by call site, e.g. {\"p0\": "
+                           "{\"attempts\": 3}, \"*\": {\"max_skip\": 8}}")
+  parser.add_argument("--autotune", type=int, default=0,
+                      help="benchmark the solver settings on this many sample areas and use the fastest that succeeds")
+  parser.add_argument("--progress", type=str, default=None, help="append progress events (JSON lines) to this file")
+  parser.add_argument("--geography", type=str, default=None,
+                      help="OA11 to LSOA11/MSOA11/LAD lookup csv (from ONS): add the parent codes "
+                           "of each OA to the output (resolution must be OA11)")
+  parser.add_argument("--memory-profile", action='store_const', const=True, default=False,
+                      help="record peak memory and the top allocators at each stage and for the "
+                           "largest areas, written alongside the output (slows the run)")
+  parser.add_argument("--estimate", action='store_const', const=True, default=False,
+                      help="don't run, but predict the time and memory of each region "
+                           "using the cost model and pack them into jobs")
+  parser.add_argument("--cost-model", type=str, default=OUTPUT_DIR + "/cost_model.json",
+                      help="the cost model file (see scripts/calibrate_cost_model.py) used by --estimate")
+  parser.add_argument("--job-hours", type=float, default=6.0,
+                      help="the maximum (expected) run time of a job in the --estimate packing plan")
+  parser.add_argument("--preview", type=float, default=None,
+                      help="quickly synthesise an approximate population for this fraction (0-1] of "
+                           "the areas and report its fit, instead of a full run")
+  parser.add_argument("--preview-compare", action='store_const', const=True, default=False,
+                      help="with --preview, also run the full method on the same areas "
+                           "and report the loss of fit of the preview")
+  parser.add_argument("--replicates", type=int, default=0,
+                      help="generate this many independent replicates of the household population (aggregated, with a "
+                           "Replicate column) from one preparation of the tables, spread over the workers")
+  parser.add_argument("--seed", type=int, default=0,
+                      help="seed for the random streams (results are reproducible for a given seed)")
+  parser.add_argument("--workers", type=int, default=1, help="number of worker processes for parallelisable stages")
 
   args = parser.parse_args()
 
@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+"""
+run script for household projection: applies newbuild counts to an existing (2011) synthetic population
+"""
+
+import time
+import argparse
+import pandas as pd
+import household_microsynth.projection as projection
+import household_microsynth.utils as utils
+
+OUTPUT_DIR = "./data"
+
+def main(params):
+  """ Entry point """
+  start_time = time.time()
+
+  population = utils.hh_file(OUTPUT_DIR, params.region, params.resolution, params.aggregate)
+  print("Loading synthetic population from", population)
+  dwellings = pd.read_csv(population, index_col="HID")
+  print("Dwellings: ", len(dwellings))
+
+  dwellings = projection.apply_newbuilds(dwellings, params.newbuilds, params.seed)
+
+  period = max(projection.get_period(f) for f in params.newbuilds)
+  output = utils.hh_file(OUTPUT_DIR, params.region, params.resolution, params.aggregate, period)
+  print("Dwellings: ", len(dwellings))
+  print("Done. Exec time(s): ", time.time() - start_time)
+  print("Writing projected population to", output)
+  dwellings.to_csv(output, index_label="HID")
+  print("DONE")
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser(description="household projection")
+  parser.add_argument("region", type=str,
+                      help="the ONS code of the local authority district (LAD) of the synthetic population, e.g. E09000001")
+  parser.add_argument("resolution", type=str,
+                      help="the geographical resolution of the synthetic population (must match the newbuild data, i.e. OA11)")
+  parser.add_argument("--aggregate", action='store_const', const=True, default=False,
+                      help="project the aggregated population (as written with --aggregate), "
+                           "adding newbuilds as rows with a Count of 1")
+  parser.add_argument("--seed", type=int, default=0,
+                      help="seed for the random streams (results are reproducible for a given seed)")
+  parser.add_argument("newbuilds", type=str, nargs="+", help="newbuild files, e.g. data/newbuilds_201607.csv")
+
+  args = parser.parse_args()
+
+  main(args)
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+
+"""
+run script for the synthesis service: keeps census tables loaded and runs jobs submitted over HTTP, e.g.
+curl -d '{"region": "E09000001", "resolution": "OA11"}' http://127.0.0.1:8080/jobs > hh.csv
+"""
+
+import argparse
+import household_microsynth.service as service
+
+CACHE_DIR = "./cache"
+
+def main(params):
+  """ Entry point """
+  server = service.make_server(params.host, params.port, params.workers, CACHE_DIR)
+  print("Synthesis service listening on %s:%d with %d workers" % (params.host, params.port, len(server.pools)))
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    service.shutdown(server)
+
+if __name__ == "__main__":
+
+  parser = argparse.ArgumentParser(description="household microsynthesis service")
+  parser.add_argument("--host", type=str, default="127.0.0.1", help="address to listen on")
+  parser.add_argument("--port", type=int, default=8080, help="port to listen on")
+  parser.add_argument("--workers", type=int, default=1,
+                      help="number of worker processes (each keeps the tables for the jobs it has run)")
+
+  args = parser.parse_args()
+
+  main(args)
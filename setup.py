@@ -17,6 +17,7 @@ setup(name='household_microsynth',
   packages=['household_microsynth'],
   zip_safe=False,
   install_requires=['distutils_pytest', 'humanleague', 'ukcensusapi'],
+  extras_require={'arrow': ['pyarrow']},
   dependency_links=['git+git://github.com/virgesmith/humanleague.git#egg=humanleague',
                     'git+git://github.com/virgesmith/UKCensusAPI.git#egg=ukcensusapi'],
   test_suite='nose.collector',
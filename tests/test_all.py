@@ -1,9 +1,62 @@
+import io
+import os
+import json
+import time
+import functools
+import socketserver
+import http.server
+import tempfile
+import threading
+import urllib.request
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
 from unittest import TestCase
+import numpy as np
+import pandas as pd
 
 #import ukcensusapi.Nomisweb as Api
 import household_microsynth.household as hh_msynth
 import household_microsynth.ref_person as hrp_msynth
 import household_microsynth.utils as Utils
+import household_microsynth.projection as projection
+import household_microsynth.linkage as linkage
+import household_microsynth.store as store
+import household_microsynth.analyzer as analyzer
+import household_microsynth.seed as seed
+import household_microsynth.solver as solver
+import household_microsynth.service as service
+import household_microsynth.progress as progress
+import household_microsynth.memprof as memprof
+import household_microsynth.geography as geography
+import household_microsynth.query as query
+import household_microsynth.fetch as fetch
+import household_microsynth.fit as fit
+import household_microsynth.estimate as estimate
+import household_microsynth.handoff as handoff
+import household_microsynth.planner as planner
+import household_microsynth.preview as preview
+
+def _reference_person():
+  """ A reference person microsynthesis of two small areas (A and B), with its tables given rather than downloaded """
+  msynth = object.__new__(hrp_msynth.ReferencePerson)
+  msynth.lc4605 = pd.DataFrame({"GEOGRAPHY_CODE": ["A", "A", "B", "B"], "C_TENHUK11": [2, 3, 2, 3], "C_NSSEC": [1, 1, 1, 1],
+                                "OBS_VALUE": [2, 1, 0, 3]})
+  msynth.lc4201 = pd.DataFrame({"GEOGRAPHY_CODE": ["A", "A", "A", "B"], "C_AGE": [1, 2, 1, 2], "C_ETHPUK11": [5, 5, 4, 5],
+                                "C_TENHUK11": [2, 2, 3, 3], "OBS_VALUE": [1, 1, 1, 3]})
+  msynth.qs111 = pd.DataFrame({"GEOGRAPHY_CODE": ["A", "B", "B"], "C_HHLSHUK11": [7, 7, 1], "OBS_VALUE": [3, 1, 2]})
+  msynth.lc1102 = pd.DataFrame({"GEOGRAPHY_CODE": ["A", "A", "B"], "C_AGE": [1, 2, 2], "C_LARPUK11": [3, 3, 5],
+                                "OBS_VALUE": [1, 2, 3]})
+  msynth.nssec_index, msynth.tenure_index, msynth.age_index = [1], [2, 3], [1, 2]
+  msynth.eth_index, msynth.lifestage_index, msynth.livarr_index = [5, 4], [7, 1], [3, 5]
+  msynth.region = "E09000001"
+  msynth.seed = 0
+  msynth.solver = solver.Solver()
+  msynth.columns = ["Area", "LC4605_C_NSSEC", "LC4605_C_TENHUK11", "LC4201_C_AGE", "LC4201_C_ETHPUK11",
+                    "QS111_C_HHLSHUK11", "LC1102_C_LARPUK11"]
+  msynth.hrps = msynth._ReferencePerson__frame()
+  msynth.progress = None
+  msynth.callback = None
+  return msynth
 
 class Test(TestCase):
 
@@ -53,4 +106,722 @@ class Test(TestCase):
 
   #   self.assertTrue(Utils.check_hrp(microsynth, num_occ_dwellings))
 
+  def test_projection(self):
+    dwellings = pd.DataFrame({"Area": ["A", "A", "A", "B"],
+                              "LC4402_C_TYPACCOM": [2, 2, 3, hh_msynth.Household.NOTAPPLICABLE],
+                              "LC4404_C_ROOMS": [1, 2, 3, 4]})
+    newbuilds = pd.DataFrame({"Area": ["A", "B", "C"], "LC4402_C_TYPACCOM": [2, 3, 2], "Count": [3, 2, 1]})
+
+    new = projection.project(dwellings, newbuilds)
+    # area C is not in the population
+    self.assertEqual(len(new), 5)
+    self.assertEqual(list(new.Area), ["A", "A", "A", "B", "B"])
+    self.assertEqual(list(new.LC4402_C_TYPACCOM), [2, 2, 2, 3, 3])
+    # donors for A are from A, donors for B fall back to the whole population
+    self.assertTrue(new.LC4404_C_ROOMS[:3].isin([1, 2]).all())
+    self.assertTrue((new.LC4404_C_ROOMS[3:] == 3).all())
+
+    # aggregated donors are drawn in proportion to their counts, and each new row is one dwelling
+    aggregated = dwellings.assign(Count=[1, 99, 1, 5])
+    new = projection.project(aggregated, pd.DataFrame({"Area": ["A"], "LC4402_C_TYPACCOM": [2], "Count": [200]}))
+    self.assertEqual(len(new), 200)
+    self.assertTrue((new.Count == 1).all())
+    self.assertTrue((new.LC4404_C_ROOMS == 2).sum() > 180)
+    # (the same draws as before for unaggregated donors)
+    self.assertEqual(list(projection.project(dwellings.assign(Count=1), newbuilds).LC4404_C_ROOMS),
+                     list(projection.project(dwellings, newbuilds).LC4404_C_ROOMS))
+    # aggregated populations are written (and read back for projection and linkage) with a suffix
+    self.assertEqual(Utils.hh_file("data", "E09000001", "OA11"), "data/hh_E09000001_OA11_2011.csv")
+    self.assertEqual(Utils.hh_file("data", "E09000001", "OA11", True, "201608"), "data/hh_E09000001_OA11_201608_agg.csv")
+
+  def test_linkage(self):
+    NA = hh_msynth.Household.NOTAPPLICABLE
+    dwellings = pd.DataFrame({"Area": ["A", "A", "A", "A", "B", "B"],
+                              "QS420_CELL": [NA, NA, NA, 22, NA, NA],
+                              "LC4404_C_SIZHUK11": [1, 2, 0, -1, 1, 3],
+                              "LC4402_C_TENHUK11": [2, 3, -1, NA, 5, 6],
+                              "LC4605_C_NSSEC": [1, 2, -1, 8, 3, 4]})
+    hrps = pd.DataFrame({"Area": ["A", "A", "B", "B"],
+                         "LC4605_C_NSSEC": [2, 1, 3, 9],
+                         "LC4605_C_TENHUK11": [3, 2, 5, 2],
+                         "LC4201_C_ETHPUK11": [1, 2, 3, 4]})
+
+    linked = linkage.link(dwellings, hrps)
+    self.assertEqual(list(linked.HRPID), [1, 0, NA, NA, 2, 3])
+    self.assertEqual(list(linked.LinkLevel), [0, 0, NA, NA, 0, 2])
+    self.assertEqual(list(linked.LC4201_C_ETHPUK11), [2, 1, NA, NA, 3, 4])
+
+  def test_store(self):
+    with tempfile.TemporaryDirectory() as directory:
+      population = store.ColumnStore(["Area", "LC4404_C_ROOMS"], 5, directory)
+      population.append(pd.DataFrame({"Area": ["A", "A"], "LC4404_C_ROOMS": [1, 2]}))
+      population.append(pd.DataFrame({"Area": ["B", "A", "B"], "LC4404_C_ROOMS": [3, 4, 5]}))
+      self.assertRaises(RuntimeError, population.append, pd.DataFrame({"Area": ["C"], "LC4404_C_ROOMS": [6]}))
+
+      blocks = list(population.blocks(2))
+      self.assertEqual([len(b) for b in blocks], [2, 2, 1])
+      self.assertEqual(list(pd.concat(blocks).Area), ["A", "A", "B", "A", "B"])
+
+      output = os.path.join(directory, "out.csv")
+      population.to_csv(output, 2)
+      result = pd.read_csv(output, index_col="HID")
+      self.assertEqual(list(result.index), [0, 1, 2, 3, 4])
+      self.assertEqual(list(result.LC4404_C_ROOMS), [1, 2, 3, 4, 5])
+      population.remove()
+
+  def test_area_streams(self):
+    # values for an area don't depend on the other areas or their order
+    a = Utils.area_random(1, "stage", ["A", "B", "A", "C"])
+    b = Utils.area_random(1, "stage", ["C", "A", "A"])
+    self.assertEqual(list(a[[3, 0, 2]]), list(b))
+    # but do depend on seed and stage
+    self.assertNotEqual(list(a), list(Utils.area_random(2, "stage", ["A", "B", "A", "C"])))
+    self.assertNotEqual(list(a), list(Utils.area_random(1, "other", ["A", "B", "A", "C"])))
+
+  def test_aggregate(self):
+    tensor = np.zeros((2, 3), dtype=int)
+    tensor[0, 1] = 2
+    tensor[1, 2] = 1
+    index, counts = Utils.nonzero(tensor)
+    self.assertEqual([list(i) for i in index], [[0, 1], [1, 2]])
+    self.assertEqual(list(counts), [2, 1])
+    self.assertEqual([list(i) for i in Utils.flatten(tensor)], [[0, 0, 1], [1, 1, 2]])
+    self.assertEqual(list(Utils.remap([2, 0], [5, 6, 7])), [7, 5])
+
+    table = pd.DataFrame({"Area": ["A", "A", "B", "A"], "LC4404_C_ROOMS": [1, 2, 1, 1]})
+    aggregated = Utils.aggregate(table)
+    self.assertEqual(len(aggregated), 3)
+    self.assertEqual(aggregated.Count.sum(), 4)
+    expanded = Utils.expand(aggregated)
+    self.assertEqual(list(expanded.columns), ["Area", "LC4404_C_ROOMS"])
+    self.assertEqual(sorted(zip(expanded.Area, expanded.LC4404_C_ROOMS)), sorted(zip(table.Area, table.LC4404_C_ROOMS)))
+
+  def test_attach(self):
+    rng = np.random.RandomState(0)
+    tenure = np.array([1, 0, 1, 1, 0])
+    # 2 tenures x 3 categories
+    table = np.array([[0, 2, 0], [1, 1, 1]])
+    values = Utils.attach(tenure, table, rng)[0]
+    self.assertEqual(sorted(values[tenure == 0]), [1, 1])
+    self.assertEqual(sorted(values[tenure == 1]), [0, 1, 2])
+    # no tenure dimension
+    values = Utils.attach(tenure, np.array([3, 0, 2]), rng, False)[0]
+    self.assertEqual(sorted(values), [0, 0, 0, 2, 2])
+    # inconsistent totals
+    self.assertRaises(ValueError, Utils.attach, tenure, np.array([[1, 2, 0], [1, 1, 0]]), rng)
+
+  def test_analyzer(self):
+    # bedrooms (rows) can't exceed rooms (columns)
+    support = np.array([[True, True], [False, True]])
+    self.assertTrue(analyzer.transport_feasible(support, np.array([1, 1]), np.array([1, 1])))
+    self.assertFalse(analyzer.transport_feasible(support, np.array([0, 2]), np.array([1, 1])))
+    self.assertFalse(analyzer.transport_feasible(support, np.array([1, 1]), np.array([1, 2])))
+    # feasible only by leaving a supported state empty
+    self.assertFalse(analyzer.transport_feasible(support, np.array([1, 1]), np.array([1, 1]), strict=True))
+    self.assertTrue(analyzer.transport_feasible(support, np.array([2, 1]), np.array([1, 2]), strict=True))
+    # vectorised
+    self.assertEqual(list(analyzer.transport_feasible(support, np.array([[1, 1], [0, 2]]), np.array([[1, 1], [1, 1]]))),
+                     [True, False])
+
+    structural = seed.get_impossible_TROBH() > 0
+    areas = ["A", "B"]
+    # one single-occupant, 1-room, 1-bedroom owner-occupied household in each area
+    m4404 = np.zeros((2, 4, 6, 4), dtype=int)
+    m4404[:, 0, 0, 0] = 1
+    m4405 = np.zeros((2, 4, 4, 4), dtype=int)
+    m4405[:, 0, 0, 0] = 1
+    m4408 = np.zeros((2, 4, 5), dtype=int)
+    m4408[:, 0, 0] = 1
+    m4402 = np.zeros((2, 4, 2, 2), dtype=int)
+    m4402[:, 0, 0, 0] = 1
+    m4202 = np.zeros((2, 4, 2, 2), dtype=int)
+    m4202[:, 0, 0, 0] = 1
+    observed = structural.copy()
+    observed[0, 0, 0, 0, 0] = False
+    self.assertEqual(list(analyzer.analyse(areas, m4404, m4405, m4408, m4402, m4202, observed, structural)), [True, True])
+    self.assertEqual(list(analyzer.analyse(areas, m4404, m4405, m4408, m4402, m4202, structural, structural)), [False, False])
+    # 2 bedrooms in a 1-room dwelling in area B
+    m4405[1, 0, 0, 0] = 0
+    m4405[1, 0, 1, 0] = 1
+    self.assertRaises(RuntimeError, analyzer.analyse, areas, m4404, m4405, m4408, m4402, m4202, structural, structural)
+
+  def test_solver(self):
+    settings = solver.Solver(0, {"*": {"max_skip": 4}, "p0": {"attempts": 3}})
+    self.assertEqual(settings.config("p0"), {"max_skip": 4, "attempts": 3})
+    self.assertEqual(settings.config("p1"), {"max_skip": 4, "attempts": 1})
+    self.assertRaises(ValueError, solver.Solver(0, {"p0": {"tol": 1e-3}}).config, "p0")
+    self.assertEqual(solver.Solver().config("p0"), {"max_skip": 0, "attempts": 1})
+
+    # the library's own sequence by default, with a real statistic in the report
+    default = solver.Solver()
+    result = default.qis("p1", "E00000001", [np.array([0]), np.array([1])], [np.array([3, 2]), np.array([1, 4])])
+    self.assertTrue(solver.converged(result))
+    self.assertEqual(result["result"].sum(), 5)
+    report = default.summary()
+    self.assertEqual(list(report.columns), ["Area", "Site", "Time", "Attempts", "Converged", "ChiSq"])
+    self.assertFalse(report.ChiSq.isnull().any())
+
+    # fails to converge unless skips are drawn from a small range
+    def trial(area):
+      converged = settings.config("p0")["max_skip"] <= 4
+      settings.report.append({"Area": area, "Site": "p0", "Converged": converged})
+    self.assertEqual(solver.autotune(settings, trial, ["A", "B"], [{"max_skip": 12}, {"max_skip": 2}]), {"*": {"max_skip": 2}})
+    self.assertEqual(settings.report, [])
+
+  def test_reconcile(self):
+    # area x tenure x nssec
+    table = np.array([[[3, 1, 0], [0, 0, 0]], [[2, 2, 2], [1, 0, 1]]])
+    targets = np.array([[5, 2], [6, 2]])
+    adjusted = Utils.reconcile_areas("test", ["A", "B"], table, targets)
+    self.assertTrue(np.array_equal(adjusted.sum(axis=2), targets))
+    self.assertEqual(list(adjusted[0, 0]), [4, 1, 0])
+    # missing tenure takes the area's proportions
+    self.assertEqual(list(adjusted[0, 1]), [2, 0, 0])
+    self.assertTrue(np.array_equal(adjusted[1], table[1]))
+
+    table = pd.DataFrame({"C_TENHUK11": [2, 2, 3, 3, 3], "OBS_VALUE": [1, 3, 0, 0, 1]})
+    consistent = pd.DataFrame({"C_TENHUK11": [2, 3], "OBS_VALUE": [6, 1]})
+    self.assertEqual(list(Utils.adjust(table, consistent).OBS_VALUE), [2, 4, 0, 0, 1])
+
+  def test_service(self):
+    job = service.parse_job({"region": "E09000001", "resolution": "OA11"})
+    self.assertEqual(job["target"], "households")
+    self.assertEqual(job["seed"], 0)
+    self.assertRaises(ValueError, service.parse_job, {"region": "E09000001"})
+    self.assertRaises(ValueError, service.parse_job,
+                      {"target": "hrp", "region": "E09000001", "resolution": "OA11", "engine": "joint"})
+
+    # jobs differing only in their options share the loaded tables, and each runs a copy with its own options
+    other = service.parse_job({"region": "E09000001", "resolution": "OA11", "seed": 3, "aggregate": True,
+                               "engine": "conditional"})
+    self.assertEqual(service.job_key(job), service.job_key(other))
+    lsoa = service.parse_job({"region": "E09000001", "resolution": "LSOA11"})
+    self.assertNotEqual(service.job_key(job), service.job_key(lsoa))
+    # except in Scotland, where some tables are synthesised
+    scottish = service.parse_job({"region": "S12000013", "resolution": "OA11"})
+    self.assertNotEqual(service.job_key(scottish), service.job_key(dict(scottish, seed=3)))
+    template = object.__new__(hh_msynth.Household)
+    template.columns = ["Area", "LC4404_C_ROOMS"]
+    template.store = None
+    template.seed = 0
+    template.solver = solver.Solver()
+    template.runs = []
+    template.run = lambda: template.runs.append(True)
+    service._templates[service.job_key(job)] = template
+    try:
+      population = service.run_job(other)
+    finally:
+      service._templates.clear()
+    self.assertEqual(list(population.columns), ["Area", "LC4404_C_ROOMS", "Count"])
+    self.assertEqual(template.runs, [True])
+    self.assertEqual((template.seed, template.columns), (0, ["Area", "LC4404_C_ROOMS"]))
+
+    server = service.make_server(port=0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+      url = "http://127.0.0.1:%d" % server.server_address[1]
+      with urllib.request.urlopen(url + "/status") as response:
+        self.assertEqual(json.loads(response.read().decode("utf-8")), {"workers": 1, "jobs": 0})
+      request = urllib.request.Request(url + "/jobs", data=json.dumps({"target": "dogs"}).encode("utf-8"))
+      with self.assertRaises(urllib.error.HTTPError) as error:
+        urllib.request.urlopen(request)
+      self.assertEqual(error.exception.code, 400)
+    finally:
+      service.shutdown(server)
+      thread.join()
+
+  def test_service_hrp(self):
+    # an HRP job posted to the service, run by a thread (rather than a worker process) so that it finds the template
+    job = service.parse_job({"target": "hrp", "region": "E09000001", "resolution": "OA11", "seed": 1})
+    service._templates[service.job_key(job)] = _reference_person()
+    server = service.make_server(port=0)
+    for pool in server.pools:
+      pool.shutdown()
+    server.pools = [ThreadPoolExecutor(max_workers=1)]
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+      url = "http://127.0.0.1:%d" % server.server_address[1]
+      request = urllib.request.Request(url + "/jobs", data=json.dumps(job).encode("utf-8"))
+      with urllib.request.urlopen(request) as response:
+        self.assertEqual(response.status, 200)
+        population = pd.read_csv(io.StringIO(response.read().decode("utf-8")), index_col=0)
+      with urllib.request.urlopen(url + "/status") as response:
+        self.assertEqual(json.loads(response.read().decode("utf-8")), {"workers": 1, "jobs": 1})
+    finally:
+      service.shutdown(server)
+      thread.join()
+      service._templates.clear()
+    self.assertEqual(list(population.index), list(range(6)))
+    self.assertEqual(population.groupby("Area").size().to_dict(), {"A": 3, "B": 3})
+    self.assertEqual(list(population.columns), ["Area", "LC4605_C_NSSEC", "LC4605_C_TENHUK11", "LC4201_C_AGE",
+                                                "LC4201_C_ETHPUK11", "QS111_C_HHLSHUK11", "LC1102_C_LARPUK11"])
+
+  def test_progress(self):
+    # each call to the clock advances it by a second
+    ticks = iter(range(100))
+    events = io.StringIO()
+    log = io.StringIO()
+    status = progress.Progress("households", 2, events, progress.LogRenderer(log, interval=3600), clock=lambda: next(ticks))
+    status.area_start("A")
+    status.message("hello")
+    status.area_end(10, seed="survey")
+    status.area_start("B")
+    status.area_end(np.int64(30))
+    status.finish()
+
+    records = [json.loads(line) for line in events.getvalue().splitlines()]
+    self.assertEqual([r["event"] for r in records],
+                     ["start", "area_start", "message", "area_end", "area_start", "area_end", "finish"])
+    self.assertEqual(records[3]["seed"], "survey")
+    self.assertEqual(records[3]["eta"], 1.0 / records[3]["areas_per_s"])
+    self.assertEqual(records[5]["dwellings"], 30)
+    self.assertEqual(records[6]["dwellings"], 40)
+    # start, message, final area and finish only
+    self.assertEqual(len(log.getvalue().splitlines()), 4)
+
+  def test_memprof(self):
+    memory = memprof.MemoryProfile(top=3, areas=2)
+    status = progress.Progress("households", 3, render=progress.tee(memory))
+    blocks = []
+    for area, size in [("A", 1000), ("B", 100000), ("C", 10)]:
+      status.area_start(area)
+      blocks.append(np.zeros(size))
+      status.area_end(1)
+    memory.stage("synthesis")
+    report = memory.report()
+    self.assertEqual([s["stage"] for s in report["stages"]], ["synthesis"])
+    self.assertTrue(report["stages"][0]["traced_peak"] >= 800000)
+    self.assertTrue(len(report["stages"][0]["allocators"]) <= 3)
+    # the two largest areas, largest first
+    self.assertEqual([a["area"] for a in report["areas"]], ["B", "A"])
+
+  def test_geography(self):
+    lookup = pd.DataFrame({"OA11CD": ["E4", "E1", "E2", "E3"], "LSOA11CD": ["L2", "L1", "L1", "L2"],
+                           "MSOA11CD": ["M1", "M1", "M1", "M1"], "LAD11CD": ["D1", "D1", "D1", "D1"]})
+    hierarchy = geography.Hierarchy.from_table(lookup)
+    with tempfile.TemporaryDirectory() as tmp:
+      hierarchy.save(tmp + "/geog.npz")
+      hierarchy = geography.Hierarchy.load(tmp + "/geog.npz")
+    self.assertTrue(np.array_equal(hierarchy.codes["LSOA11"], ["L1", "L2"]))
+    self.assertTrue(np.array_equal(hierarchy.mapping("LSOA11", "MSOA11"), [0, 0]))
+
+    population = pd.DataFrame({"Area": ["E3", "E1", "E4", "E1"], "Tenure": [2, 2, 3, 3], "Count": [1, 2, 3, 4]})
+    annotated = hierarchy.annotate(population)
+    self.assertEqual(list(annotated.LSOA11), ["L2", "L1", "L2", "L1"])
+    self.assertEqual(str(annotated.MSOA11.dtype), "category")
+
+    totals = hierarchy.rollup(population, "LSOA11")
+    self.assertEqual(list(totals.LSOA11), ["L1", "L2"])
+    self.assertEqual(list(totals.Count), [6, 4])
+    by_tenure = hierarchy.rollup(population.drop("Count", axis=1), "LSOA11", ["Tenure"])
+    self.assertEqual(list(by_tenure.Count), [1, 1, 1, 1])
+    self.assertEqual(list(hierarchy.rollup(population, "LAD").Count), [10])
+
+    # e.g. OA x tenure marginals
+    summed, codes = hierarchy.rollup_tensor(np.array([[1, 2], [3, 4], [5, 6]]), ["E1", "E3", "E4"], "LSOA11")
+    self.assertTrue(np.array_equal(codes, ["L1", "L2"]))
+    self.assertTrue(np.array_equal(summed, [[1, 2], [8, 10]]))
+
+    restricted = hierarchy.restrict(["E1", "E2"])
+    self.assertTrue(np.array_equal(restricted.codes["LSOA11"], ["L1"]))
+    self.assertRaises(ValueError, hierarchy.annotate, pd.DataFrame({"Area": ["E9"]}))
+
+  def test_query(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      pd.DataFrame({"Area": ["E1", "E1", "E2", "E2", "E2"], "Tenure": [2, 3, 2, 2, 3], "Type": [3, 3, 2, 3, 3]}) \
+        .to_csv(tmp + "/hh_a.csv", index_label="HID")
+      pd.DataFrame({"Area": ["E3", "E3"], "Tenure": [2, 5], "Type": [3, 3], "Count": [4, 5]}) \
+        .to_csv(tmp + "/hh_b.csv", index_label="HID")
+      population = query.Query([tmp + "/hh_a.csv", tmp + "/hh_b.csv"])
+      self.assertEqual(population.count(), 14)
+      self.assertEqual(population.count({"Tenure": 2, "Type": 3}), 6)
+      self.assertEqual(population.count({"Tenure": [3, 5]}), 7)
+      self.assertEqual(population.count({"Tenure": "2", "Area": "E2"}), 2)
+      self.assertEqual(population.count({"Tenure": 6}), 0)
+      table = population.crosstab(["Area", "Tenure"], {"Type": 3})
+      self.assertEqual(list(table.Area), ["E1", "E1", "E2", "E2", "E3", "E3"])
+      self.assertEqual(list(table.Count), [1, 1, 1, 1, 4, 5])
+      # partitions that cannot match are skipped
+      self.assertEqual(len(list(population.partitions({"Area": "E3"}))), 1)
+      self.assertRaises(ValueError, population.count, {"Rooms": 1})
+      # indexes are reused
+      self.assertTrue(os.path.isfile(query.index_file(tmp + "/hh_a.csv")))
+      self.assertEqual(query.Query([tmp + "/hh_a.csv"]).count({"Area": "E2"}), 3)
+
+  def test_fetch(self):
+    # local stand-in for a census API: each table takes a while, one fails transiently and one doesn't exist
+    class Handler(http.server.BaseHTTPRequestHandler):
+      failed = []
+      def do_GET(self):
+        time.sleep(0.3)
+        if self.path == "/missing" or (self.path == "/flaky" and not Handler.failed):
+          Handler.failed.append(self.path)
+          self.send_error(404 if self.path == "/missing" else 503)
+          return
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(("GEOGRAPHY_CODE,OBS_VALUE\nE00000001," + str(len(self.path)) + "\n").encode("utf-8"))
+      def log_message(self, *args):
+        pass
+    class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+      daemon_threads = True
+    server = Server(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:%d/" % server.server_address[1]
+    def get_data(table):
+      return pd.read_csv(io.StringIO(urllib.request.urlopen(url + table).read().decode("utf-8")))
+    try:
+      tables = ["LC4402EW", "LC4404EW", "LC4405EW", "flaky"]
+      start = time.time()
+      result = fetch.fetch_all({t: functools.partial(get_data, t) for t in tables}, workers=4, backoff=0.01)
+      elapsed = time.time() - start
+      self.assertEqual(sorted(result), sorted(tables))
+      self.assertEqual(result["flaky"].OBS_VALUE[0], 6)
+      # concurrent: about two requests' latency (the flaky table is retried), not five
+      self.assertTrue(elapsed < 1.2)
+      # client errors are not retried
+      self.assertRaises(urllib.error.HTTPError, fetch.fetch_all, {"missing": functools.partial(get_data, "missing")}, 4, 3,
+                        0.01)
+      self.assertEqual(Handler.failed, ["/flaky", "/missing"])
+    finally:
+      server.shutdown()
+      server.server_close()
+
+    # queries on the same table are not run concurrently
+    active = {}
+    overlaps = []
+    lock = threading.Lock()
+    def query(table, params):
+      with lock:
+        active[table] = active.get(table, 0) + 1
+        overlaps.append(active[table] > 1)
+      time.sleep(0.05)
+      with lock:
+        active[table] -= 1
+      return params
+    requests = {"LC4408EW": functools.partial(query, "LC4408EW", "C_AHTHUK11"),
+                "LC4408EW_PPBROOM": functools.partial(query, "LC4408EW", "C_PPBROOMHEW11"),
+                "LC4404EW": functools.partial(query, "LC4404EW", "C_ROOMS")}
+    result = fetch.fetch_all(requests, workers=4)
+    self.assertEqual(list(result), list(requests))
+    self.assertEqual(result["LC4408EW_PPBROOM"], "C_PPBROOMHEW11")
+    self.assertEqual(len(overlaps), 3)
+    self.assertFalse(any(overlaps))
+
+  def test_fit(self):
+    NA = hh_msynth.Household.NOTAPPLICABLE
+    maps = {"tenure": [2, 3], "rooms": [1, 2], "occupants": [1, 2], "bedrooms": [1, 2], "hhtype": [1, 2], "ch": [1, 2],
+            "buildtype": [2, 3], "eth": [2, 3], "cars": [1, 2], "econ": [1, 2]}
+    dwellings = pd.DataFrame({"Area": ["A", "A", "B", "B", "B"], "LC4402_C_TENHUK11": [2, 3, 2, 2, -1],
+                              "LC4404_C_ROOMS": [1, 2, 2, 2, 1], "LC4404_C_SIZHUK11": [1, 2, 1, 1, 0],
+                              "LC4405EW_C_BEDROOMS": [1, 2, 1, 1, 1], "LC4408_C_AHTHUK11": [1, 2, 1, 1, -1],
+                              "LC4402_C_CENHEATHUK11": [2, 2, 2, 1, 2], "LC4402_C_TYPACCOM": [2, 2, 3, 3, NA],
+                              "LC4202_C_ETHHUK11": [2, 2, 3, 3, -1], "LC4202_C_CARSNO": [1, 2, 1, 1, 1],
+                              "LC4605_C_NSSEC": [1, 2, 1, 2, -1], "QS420_CELL": [NA] * 5, "Count": [1, 1, 1, 2, 3]})
+    msynth = type("Msynth", (), {})()
+    msynth.lc4404 = pd.DataFrame({"GEOGRAPHY_CODE": ["A", "B"]})
+    msynth.scotland = False
+    msynth.NOTAPPLICABLE = NA
+    msynth.maps = maps
+    msynth.dwellings = dwellings
+    for name in fit.TABLES:
+      attr, dims = fit.TABLES[name]
+      setattr(msynth, attr, Utils.area_tensor(dwellings, ["A", "B"], [c for c, _ in dims], [maps[m] for _, m in dims],
+                                              "Count", "Area"))
+    # the rooms of one household in B are wrong
+    msynth.m4404[1, 0, :, 0] = [1, 2]
+    per_area, summary = fit.household_fit(msynth, survey=np.ones([2, 2, 2, 2, 2]))
+    self.assertEqual(list(summary.Table[:6]), list(fit.TABLES))
+    lc4404 = per_area[per_area.Table == "LC4404"]
+    self.assertEqual(list(lc4404.Total), [2, 3])
+    self.assertEqual(list(lc4404.TAE), [0, 2])
+    self.assertAlmostEqual(lc4404.SRMSE.values[1], np.sqrt(2.0 / 8) / (3.0 / 8))
+    self.assertEqual(per_area[per_area.Table == "LC4605"].TAE.sum(), 0)
+    # uniform seed: 2 households in A spread over 4 rooms x bedrooms cells, both on the diagonal
+    self.assertEqual(per_area[(per_area.Table == "Rooms x Bedrooms") & (per_area.Area == "A")].TAE.values[0], 2.0)
+    # the same in blocks
+    blocked, _ = fit.household_fit(msynth, [dwellings[:2], dwellings[2:]], survey=np.ones([2, 2, 2, 2, 2]))
+    self.assertTrue(np.allclose(blocked.TAE, per_area.TAE))
+
+  def test_estimate(self):
+    events = io.StringIO()
+    for r in range(6):
+      ticks = iter(range(1000))
+      status = progress.Progress("households", 2, events, clock=lambda: next(ticks) * (r + 1), region="E0" + str(r))
+      for area in ["A", "B"]:
+        status.area_start(area)
+        status.area_end(100 * r + 10, communal=r % 2, seed="structural" if r % 3 == 0 and area == "A" else "survey")
+      status.finish(peak_rss=1000 * r)
+    events.seek(0)
+    history = estimate.runs([json.loads(line) for line in events])
+    self.assertEqual(list(history.region), ["E0" + str(r) for r in range(6)])
+    self.assertEqual(list(history.dwellings), [200 * r + 20 for r in range(6)])
+    self.assertEqual(list(history.structural), [1, 0, 0, 1, 0, 0])
+    self.assertEqual(list(history.time), [10 * (r + 1) for r in range(6)])
+
+    model = estimate.calibrate(history)
+    time_s, memory = estimate.predict(model, history.iloc[2])
+    self.assertAlmostEqual(time_s, 30.0)
+    self.assertAlmostEqual(memory, 2000.0)
+    self.assertRaises(ValueError, estimate.calibrate, history[:3])
+
+    # longest first to the least loaded job
+    self.assertEqual(list(estimate.pack([5, 4, 3, 3], 2)), [0, 1, 1, 0])
+    planned = estimate.plan(pd.DataFrame({"region": list("abcd"), "time": [5.0, 4.0, 3.0, 3.0], "memory": 1.0}), 8.0)
+    self.assertEqual(planned.job.max(), 1)
+    self.assertEqual(list(planned.groupby("job").time.sum()), [8.0, 7.0])
+
+  def test_handoff(self):
+    table = pd.DataFrame({"Area": ["E1", "E2", "E1"], "X": np.array([1, 2, 3], dtype=np.int64),
+                          "Y": np.array([4, 5, 6], dtype=object)})
+    columns, dictionaries = handoff.from_frame(table)
+    self.assertEqual(list(columns["Area"]), [0, 1, 0])
+    self.assertEqual(list(dictionaries["Area"]), ["E1", "E2"])
+    self.assertTrue(np.shares_memory(columns["X"], table.X.values))
+    self.assertEqual(columns["Y"].dtype, np.int64)
+
+    population = store.ColumnStore(["Area", "X"], 3)
+    population.append(pd.DataFrame({"Area": ["E1", "E2"], "X": [7, 8]}))
+    columns, dictionaries = handoff.from_store(population)
+    self.assertEqual(list(columns["X"]), [7, 8])
+    self.assertTrue(np.shares_memory(columns["X"], population.arrays["X"]))
+    self.assertEqual(list(dictionaries["Area"]), ["E1", "E2"])
+
+    try:
+      import pyarrow
+    except ImportError:
+      return
+    arrow = handoff.to_arrow(*handoff.from_frame(table))
+    self.assertEqual(arrow.column("Area").to_pylist(), ["E1", "E2", "E1"])
+    self.assertEqual(arrow.column("X").to_pylist(), [1, 2, 3])
+
+  def test_handoff_household(self):
+    # a Household's population as it is built up area by area, from chunks with object columns
+    msynth = object.__new__(hh_msynth.Household)
+    msynth.columns = ["Area", "LC4404_C_ROOMS", "LC4404_C_SIZHUK11"]
+    msynth.aggregate = False
+    msynth.store = None
+    msynth.index = 0
+    msynth.dwellings = msynth._Household__frame()
+    for area in ["E00000001", "E00000002"]:
+      chunk = pd.DataFrame(columns=msynth.columns)
+      chunk.Area = np.repeat(area, 3)
+      chunk.LC4404_C_ROOMS = np.array([1, 2, 3])
+      chunk.LC4404_C_SIZHUK11 = np.array([1, 2, 1], dtype=object)
+      first = len(msynth.dwellings)
+      msynth._Household__append(chunk)
+    self.assertEqual(msynth.index, 6)
+    columns, dictionaries = handoff.population(msynth, first)
+    self.assertEqual(list(dictionaries["Area"]), ["E00000002"])
+    self.assertEqual(list(columns["LC4404_C_SIZHUK11"]), [1, 2, 1])
+    for col in ["LC4404_C_ROOMS", "LC4404_C_SIZHUK11"]:
+      self.assertTrue(np.shares_memory(columns[col], msynth.dwellings[col].values))
+
+  def test_communal(self):
+    # one row per communal establishment, its occupants divided as evenly as possible
+    msynth = object.__new__(hh_msynth.Household)
+    msynth.columns = ["Area", "LC4402_C_TYPACCOM", "QS420_CELL", "LC4402_C_TENHUK11", "LC4408_C_AHTHUK11", "CommunalSize",
+                      "LC4404_C_SIZHUK11", "LC4404_C_ROOMS", "LC4405EW_C_BEDROOMS", "LC4408EW_C_PPBROOMHEW11",
+                      "LC4402_C_CENHEATHUK11", "LC4605_C_NSSEC", "LC4202_C_ETHHUK11", "LC4202_C_CARSNO"]
+    msynth.aggregate = False
+    msynth.store = None
+    msynth.index = 0
+    msynth.dwellings = msynth._Household__frame()
+    msynth.communal = pd.DataFrame({"GEOGRAPHY_CODE": ["A", "A", "A", "B"], "CELL": [2, 23, 26, 2], "OBS_VALUE": [1, 3, 0, 1],
+                                    "CommunalSize": [5, 10, 0, 2]})
+    self.assertEqual(msynth._Household__add_communal("A"), 4)
+    self.assertEqual(msynth._Household__add_communal("C"), 0)
+    self.assertEqual(list(msynth.dwellings.QS420_CELL), [2, 23, 23, 23])
+    self.assertEqual(list(msynth.dwellings.CommunalSize), [5, 4, 3, 3])
+    self.assertEqual(list(msynth.dwellings.LC4605_C_NSSEC), [-1, 8, 8, 8])
+    self.assertTrue(all(msynth.dwellings[col].dtype == np.int64 for col in msynth.columns[1:]))
+
+  def test_planner(self):
+    sizes = {"tenure": 2, "rooms": 3, "occupants": 2, "bedrooms": 1, "hhtype": 1, "ch": 2, "buildtype": 1, "eth": 1,
+             "cars": 2, "econ": 2}
+    tables = planner.tables()
+    # joint reproduces the single QIS over all the dimensions
+    joint = planner.plan(tables, sizes, joint=True)
+    self.assertEqual([s["solve"] for s in joint], ["qisi", "qis"])
+    self.assertEqual(joint[1]["dims"], [d for d, _ in planner.DIMS])
+    # otherwise each table is used as is within tenure, so the peak is the seed
+    stages = planner.plan(tables, sizes)
+    self.assertEqual([s["solve"] for s in stages], ["qisi", None, None, None])
+    self.assertEqual(planner.peak(stages), 12)
+    self.assertEqual(planner.peak(joint), 96)
+    self.assertTrue(all(s["link"] == ["tenure"] for s in stages[1:]))
+    # tables sharing an unseeded dimension are solved together
+    grouped = planner.plan(tables + [("LC9999", "m9999", ["rooms", "cars", "econ"])], sizes)
+    self.assertEqual([s["tables"] for s in grouped if s["solve"] == "qis"],
+                     [[("LC4202", ["tenure", "eth", "cars"]), ("LC4605", ["tenure", "econ"]),
+                       ("LC9999", ["rooms", "cars", "econ"])]])
+    self.assertEqual(grouped[-1]["dims"], ["tenure", "rooms", "eth", "cars", "econ"])
+    # no tenure for some tables in Scotland
+    self.assertEqual([s["link"] for s in planner.plan(planner.tables(True), sizes)], [[], [], [], ["tenure"]])
+
+    class Solver:
+      def qisi(self, site, area, seed, indices, marginals):
+        return {"result": core, "conv": True}
+    core = np.array([[2, 0, 1], [1, 3, 0]]).reshape(2, 3, 1, 1, 1) * np.array([1, 1]).reshape(1, 1, 2, 1, 1)
+    tensors = {"LC4404": core.sum(axis=(3, 4)), "LC4405": core.sum(axis=(1, 4)).transpose(0, 2, 1),
+               "LC4408": core.sum(axis=(1, 2, 3)), "LC4402": np.array([[[4], [2]], [[5], [3]]]),
+               "LC4202": np.array([[[1, 5]], [[8, 0]]]), "LC4605": np.array([[3, 3], [2, 6]])}
+    rng = lambda name: Utils.area_rng(0, "E00000001", name)
+    dims, population, counts = planner.execute(stages, tensors, Solver(), "E00000001", [core], rng)
+    self.assertIsNone(counts)
+    self.assertEqual(len(population), 10)
+    planner.validate("E00000001", dims, population, counts, tables, tensors)
+    tensors["LC4605"] = np.array([[4, 2], [2, 6]])
+    self.assertRaises(RuntimeError, planner.validate, "E00000001", dims, population, counts, tables, tensors)
+
+  def test_people_per_bedroom(self):
+    self.assertEqual(Utils.people_per_bedroom(1, 2), 1)
+    self.assertEqual(Utils.people_per_bedroom(3, 2), 3)
+    # 4 means 4 or more occupants/bedrooms, so some combinations are ambiguous
+    occupants = np.array([1, 2, 3, 4, 4, 4, 2, 3, 0, 1])
+    bedrooms = np.array([1, 1, 2, 1, 3, 4, 4, 4, 2, -1])
+    self.assertEqual(list(Utils.people_per_bedroom_category(occupants, bedrooms, -1)), [2, 4, 3, 4, -1, -1, 1, -1, -1, -1])
+
+    # the known categories are bounded by the census marginal
+    lc4408ppb = pd.DataFrame({"GEOGRAPHY_CODE": ["A"] * 4 + ["B"] * 4, "C_PPBROOMHEW11": [1, 2, 3, 4] * 2,
+                              "OBS_VALUE": [1, 1, 0, 1, 0, 1, 1, 1]})
+    self.assertTrue(Utils.check_ppbroom(pd.Series([1, 2, 1, 2], index=[1, 2, 3, 4]), lc4408ppb))
+    self.assertTrue(Utils.check_ppbroom(pd.Series([5, 1, 2], index=[-2, -1, 4]), lc4408ppb))
+    self.assertRaises(AssertionError, Utils.check_ppbroom, pd.Series([2, 1], index=[1, 4]), lc4408ppb)
+
+  def test_replicates(self):
+    self.assertEqual(Utils.replicate_seed(5, 0), 5)
+    self.assertEqual(len(set(Utils.replicate_seed(5, r) for r in range(20))), 20)
+    # replicates draw their skips from their own streams, over a range humanleague tells apart
+    first = solver.replicate(5, {"p0": {"max_skip": 2, "attempts": 2}}, 1)
+    self.assertEqual(first.seed, Utils.replicate_seed(5, 1))
+    self.assertEqual(first.config("p0"), {"max_skip": solver.REPLICATE_MAX_SKIP, "attempts": 2})
+    self.assertEqual(first.config("p1")["max_skip"], solver.REPLICATE_MAX_SKIP)
+
+    # the same tables give different dwellings in different replicates (with real humanleague, jointly)
+    # (with the dimensions of each table in ascending order, as this humanleague expects)
+    sizes = {"tenure": 2, "rooms": 4, "occupants": 4, "bedrooms": 3, "hhtype": 3, "ch": 2, "buildtype": 3}
+    tables = [("LC4404", "m4404", ["tenure", "rooms", "occupants"]), ("LC4405", "m4405", ["tenure", "occupants", "bedrooms"]),
+              ("LC4408", "m4408", ["tenure", "hhtype"]), ("LC4402", "m4402", ["tenure", "ch", "buildtype"])]
+    stages = planner.plan(tables, sizes, joint=True)
+    rng = np.random.RandomState(0)
+    dwellings = {1: [], 2: []}
+    for i in range(5):
+      area = "E0000000" + str(i)
+      core = rng.randint(0, 3, size=(2, 4, 4, 3, 3))
+      tensors = {"LC4404": core.sum(axis=(3, 4)), "LC4405": core.sum(axis=(1, 4)), "LC4408": core.sum(axis=(1, 2, 3)),
+                 "LC4402": np.array([rng.multinomial(n, [1.0 / 6] * 6).reshape(2, 3) for n in core.sum(axis=(1, 2, 3, 4))])}
+      # a non-uniform seed, like the survey seeds
+      seed = rng.uniform(0.1, 1.0, size=core.shape)
+      for r in dwellings:
+        streams = lambda name: Utils.area_rng(Utils.replicate_seed(5, r), area, name)
+        dims, population, counts = planner.execute(stages, tensors, solver.replicate(5, None, r), area, [seed], streams)
+        planner.validate(area, dims, population, counts, tables, tensors)
+        dwellings[r].append(np.array(population))
+    self.assertFalse(all(np.array_equal(a, b) for a, b in zip(dwellings[1], dwellings[2])))
+
+  def test_derive_sc(self):
+    # tenure, rooms, size and household type marginals of one Scottish geography
+    m4402 = np.array([3, 2, 0, 4])
+    m407 = np.array([1, 2, 3, 3])
+    m406 = np.array([4, 4, 1])
+    m116 = np.array([2, 0, 5, 1, 1])
+    a4404, a4408, report = hh_msynth._derive_area_sc(m4402, m407, m406, m116, "S00000001", 0)
+    self.assertTrue(np.array_equal(a4404.sum(axis=(1, 2)), m4402))
+    self.assertTrue(np.array_equal(a4404.sum(axis=(0, 2)), m407))
+    self.assertTrue(np.array_equal(a4404.sum(axis=(0, 1)), m406))
+    self.assertTrue(np.array_equal(a4408.sum(axis=1), m4402))
+    self.assertTrue(np.array_equal(a4408.sum(axis=0), m116))
+    self.assertEqual([r["Site"] for r in report], list(hh_msynth.SC_SITES))
+    # geographies with no households
+    zeros = np.zeros(4, dtype=int)
+    a4404, a4408, report = hh_msynth._derive_area_sc(zeros, np.zeros(4, dtype=int), np.zeros(3, dtype=int),
+                                                     np.zeros(5, dtype=int), "S00000002", 0)
+    self.assertEqual((a4404.shape, a4404.sum(), a4408.shape, a4408.sum(), report), ((4, 4, 3), 0, (4, 5), 0, []))
+
+    # the derived tables are cached by region, resolution, seed and solver settings
+    with tempfile.TemporaryDirectory() as tmp:
+      files = hh_msynth._derived_files_sc(tmp, "S12000013", "OA11", 0, solver.Solver(0))
+      self.assertEqual(files, hh_msynth._derived_files_sc(tmp, "S12000013", "OA11", 0,
+                                                          solver.Solver(0, {"p0": {"attempts": 2}})))
+      self.assertNotEqual(files, hh_msynth._derived_files_sc(tmp, "S12000013", "OA11", 1, solver.Solver(1)))
+      self.assertNotEqual(files, hh_msynth._derived_files_sc(tmp, "S12000013", "OA11", 0,
+                                                             solver.Solver(0, {"sc_lc4404": {"max_skip": 4}})))
+      self.assertIsNone(hh_msynth._load_derived_sc(files))
+      lc4404 = Utils.listify(np.stack([a4404, a4404 + 1]), "OBS_VALUE",
+                             ["GEOGRAPHY_CODE", "C_TENHUK11", "C_ROOMS", "C_SIZHUK11"])
+      lc4404.GEOGRAPHY_CODE = Utils.remap(lc4404.GEOGRAPHY_CODE, ["S00000001", "S00000002"])
+      lc4408 = Utils.listify(np.stack([a4408, a4408]), "OBS_VALUE", ["GEOGRAPHY_CODE", "C_TENHUK11", "C_AHTHUK11"])
+      lc4408.GEOGRAPHY_CODE = Utils.remap(lc4408.GEOGRAPHY_CODE, ["S00000001", "S00000002"])
+      hh_msynth._save_derived_sc(files, (lc4404, lc4408))
+      cached = hh_msynth._load_derived_sc(files)
+      self.assertTrue(cached[0].equals(lc4404))
+      self.assertTrue(cached[1].equals(lc4408))
+
+  def test_tensors_sc(self):
+    # Scottish LC4202 has no owned outright tenure (2), so LC4605 is reconciled to the area totals rather than by tenure
+    msynth = object.__new__(hh_msynth.Household)
+    msynth.scotland = True
+    msynth.tables = planner.tables(True)
+    msynth.lc4408ppb = None
+    area = {"GEOGRAPHY_CODE": ["A"] * 4, "C_TENHUK11": [2, 3, 5, 6]}
+    msynth.lc4402 = pd.DataFrame(dict(area, C_CENHEATHUK11=2, C_TYPACCOM=2, OBS_VALUE=[0, 2, 1, 1]))
+    msynth.lc4404 = pd.DataFrame(dict(area, C_ROOMS=1, C_SIZHUK11=1, OBS_VALUE=[0, 2, 1, 1]))
+    msynth.lc4405 = pd.DataFrame(dict(area, C_BEDROOMS=-1, C_SIZHUK11=1, OBS_VALUE=[0, 2, 1, 1]))
+    msynth.lc4408 = pd.DataFrame(dict(area, C_AHTHUK11=1, OBS_VALUE=[0, 2, 1, 1]))
+    msynth.lc4202 = pd.DataFrame({"GEOGRAPHY_CODE": ["A"] * 3, "C_TENHUK11": [3, 5, 6], "C_ETHHUK11": 2, "C_CARSNO": 1,
+                                  "OBS_VALUE": [2, 1, 1]})
+    msynth.lc4605 = pd.DataFrame({"GEOGRAPHY_CODE": ["A"] * 3, "C_TENHUK11": [2, 3, 5], "C_NSSEC": [1, 2, 2],
+                                  "OBS_VALUE": [2, 1, 0]})
+    msynth._Household__get_tensors(["A"])
+    self.assertEqual(planner.area_tensors(msynth, 0)["LC4605"].tolist(), [3, 1])
+
+  def test_hrp_tensors(self):
+    # the per-area tables of the reference person synthesis, built once for all areas
+    msynth = _reference_person()
+    msynth._ReferencePerson__prepare(["B", "A"])
+    # tenure by ethnicity, summed over age
+    self.assertEqual(msynth.m4201.tolist(), [[[0, 0], [3, 0]], [[2, 0], [0, 1]]])
+    self.assertEqual(msynth.mq111.tolist(), [[1, 2], [3, 0]])
+    self.assertEqual(msynth.m1102.tolist(), [[0, 3], [3, 0]])
+    self.assertEqual(msynth.m4605.shape, (2, 1, 2))
+
+  def test_hrp_areas(self):
+    # the reference persons of each area in turn (with real humanleague), handed off as they are completed
+    msynth = _reference_person()
+    handed = []
+    area_map = msynth.start(callback=lambda target, area, rows: handed.append((target, area, len(rows[0]["Area"]))))
+    for i, area in enumerate(area_map):
+      msynth.add_area(i, area)
+    msynth.finish()
+    self.assertEqual(handed, [("hrp", "A", 3), ("hrp", "B", 3)])
+    self.assertEqual(list(msynth.hrps.index), list(range(6)))
+    self.assertEqual(msynth.hrps.groupby(["Area", "LC4605_C_TENHUK11"]).size().to_dict(),
+                     {("A", 2): 2, ("A", 3): 1, ("B", 3): 3})
+    self.assertEqual(msynth.hrps.groupby("Area").LC4201_C_ETHPUK11.apply(sorted).to_dict(), {"A": [4, 5, 5], "B": [5, 5, 5]})
+    # integer columns are handed off without copying
+    columns, _ = handoff.population(msynth, 3)
+    for col in msynth.columns[1:]:
+      self.assertTrue(np.shares_memory(columns[col], msynth.hrps[col].values))
+
+  def test_preview(self):
+    rng = np.random.RandomState(0)
+    sample = preview.sample_areas(10, 0.3, rng)
+    self.assertEqual(list(sample), sorted(set(sample)))
+    self.assertEqual(len(sample), 3)
+    self.assertEqual(len(preview.sample_areas(10, 0.01, rng)), 1)
+    self.assertRaises(ValueError, preview.sample_areas, 10, 0.0, rng)
+
+    # two areas of a 2x3x2 table with marginals over dims (0, 1) and (2, 0)
+    population = rng.randint(0, 5, size=(2, 2, 3, 2))
+    marginals = [population.sum(axis=3), population.sum(axis=2).transpose(0, 2, 1)]
+    expected = preview.ipf(np.ones((2, 3, 2)), [np.array([0, 1]), np.array([2, 0])], marginals)
+    self.assertTrue(np.allclose(expected.sum(axis=3), marginals[0]))
+    self.assertTrue(np.allclose(expected.sum(axis=2).transpose(0, 2, 1), marginals[1]))
+    counts = preview.integerise(expected, population.sum(axis=(2, 3)), rng)
+    self.assertTrue(np.array_equal(counts.sum(axis=(2, 3)), population.sum(axis=(2, 3))))
+    self.assertTrue(np.all(np.abs(counts - expected) < 1))
+
   # TODO more tests